@@ -0,0 +1,319 @@
+"""
+End-to-end throughput benchmark for ChatGPTTelegramBot.
+
+Drives the bot's message handler with synthetic updates against a local fake OpenAI server and a local
+fake Telegram Bot API server (both started in subprocesses, so CPU time is only measured for the bot).
+Reports messages/sec, p50/p95/p99 time-to-first-edit and end-to-end latency and CPU time per message,
+for streaming and non-streaming mode, and stores the results as JSON so runs can be compared.
+
+Example:
+    python benchmarks/bot_throughput.py --messages 200 --concurrency 20 --output results.json
+    python benchmarks/bot_throughput.py --messages 200 --concurrency 20 --compare results.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir, 'bot'))
+
+import openai  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationBuilder, CallbackContext  # noqa: E402
+
+from main import load_config  # noqa: E402
+from openai_helper import OpenAIHelper  # noqa: E402
+from plugin_manager import PluginManager  # noqa: E402
+from plugins.plugin import Plugin  # noqa: E402
+from telegram_bot import ChatGPTTelegramBot  # noqa: E402
+from usage_tracker import UsageTracker  # noqa: E402
+
+TOKEN = '123456:benchmark'
+
+
+class EchoPlugin(Plugin):
+    """
+    Plugin without network access, used to benchmark function calls
+    """
+
+    def get_source_name(self) -> str:
+        return 'Benchmark'
+
+    def get_spec(self) -> [dict]:
+        return [{
+            'name': 'benchmark_echo',
+            'description': 'Echo the given query back',
+            'parameters': {
+                'type': 'object',
+                'properties': {'query': {'type': 'string', 'description': 'The query to echo'}},
+                'required': ['query'],
+            },
+        }]
+
+    async def execute(self, function_name, **kwargs) -> dict:
+        return {'result': kwargs.get('query', '')}
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Counts the errors logged by the bot while handling updates
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord):
+        self.count += 1
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_fake_openai(port: int, options: dict):
+    from aiohttp import web
+    from fake_openai import FakeOpenAI
+    web.run_app(FakeOpenAI(**options).app(), host='127.0.0.1', port=port, print=None)
+
+
+def run_fake_telegram(port: int, options: dict):
+    from aiohttp import web
+    from fake_telegram import FakeTelegram
+    web.run_app(FakeTelegram(**options).app(), host='127.0.0.1', port=port, print=None)
+
+
+async def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise TimeoutError(f'Fake server on port {port} did not start')
+
+
+def percentiles(values: list[float]) -> dict:
+    if len(values) == 0:
+        return {'p50': None, 'p95': None, 'p99': None}
+    ordered = sorted(values)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))] * 1000, 2)
+
+    return {'p50': rank(50), 'p95': rank(95), 'p99': rank(99)}
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Benchmark'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'},
+            'text': text,
+        },
+    }
+
+
+async def run_mode(args, stream: bool, openai_port: int, telegram_port: int, logs_dir: str) -> dict:
+    """
+    Runs the benchmark for one mode (streaming or not) and returns its results
+    """
+    os.environ.update({
+        'OPENAI_API_KEY': 'sk-benchmark',
+        'TELEGRAM_BOT_TOKEN': TOKEN,
+        'STREAM': str(stream).lower(),
+        'ENABLE_FUNCTIONS': str(args.function_call_ratio > 0).lower(),
+        'PLUGINS': '',
+        'OPENAI_MODEL': args.model,
+        'COALESCE_REQUESTS': str(args.coalesce).lower(),
+    })
+    openai_config, telegram_config, plugin_config, _, _ = load_config()
+    openai.api_base = f'http://127.0.0.1:{openai_port}/v1'
+
+    plugin_manager = PluginManager(config=plugin_config)
+    if args.function_call_ratio > 0:
+        plugin_manager.plugins.append(EchoPlugin())
+    bot = ChatGPTTelegramBot(config=telegram_config,
+                             openai=OpenAIHelper(config=openai_config, plugin_manager=plugin_manager))
+    # The usage trackers write their logs to a temporary directory instead of the working directory
+    for worker in range(args.concurrency):
+        bot.usage[100_000 + worker] = UsageTracker(100_000 + worker, 'Benchmark', logs_dir=logs_dir)
+    bot.usage['guests'] = UsageTracker('guests', 'all guest users in group chats', logs_dir=logs_dir)
+    application = ApplicationBuilder() \
+        .token(TOKEN) \
+        .base_url(f'http://127.0.0.1:{telegram_port}/bot') \
+        .concurrent_updates(True) \
+        .build()
+    await application.initialize()
+
+    async with aiohttp.ClientSession() as session:
+        await session.post(f'http://127.0.0.1:{telegram_port}/_reset')
+        openai_stats_before = await (await session.get(f'http://127.0.0.1:{openai_port}/_stats')).json()
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    timings: dict[int, list[tuple[float, float]]] = {}
+    messages_per_chat = max(1, args.messages // args.concurrency)
+
+    async def chat_worker(worker: int):
+        chat_id = 100_000 + worker
+        timings[chat_id] = []
+        for index in range(messages_per_chat):
+            update_id = worker * messages_per_chat + index + 1
+            update = Update.de_json(make_update(update_id, chat_id, f'{args.prompt} #{index}'), application.bot)
+            start = time.time()
+            await bot.prompt(update, CallbackContext.from_update(update, application))
+            timings[chat_id].append((start, time.time()))
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(chat_worker(worker) for worker in range(args.concurrency)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    logging.getLogger().removeHandler(errors)
+
+    async with aiohttp.ClientSession() as session:
+        chats = await (await session.get(f'http://127.0.0.1:{telegram_port}/_stats')).json()
+        openai_stats = await (await session.get(f'http://127.0.0.1:{openai_port}/_stats')).json()
+    await application.shutdown()
+
+    end_to_end, first_edit = [], []
+    for chat_id, chat_timings in timings.items():
+        visible = chats.get(str(chat_id), {}).get('visible', [])
+        for start, end in chat_timings:
+            end_to_end.append(end - start)
+            first = next((timestamp for timestamp in visible if start <= timestamp <= end), None)
+            if first is not None:
+                first_edit.append(first - start)
+
+    total = len(end_to_end)
+    return {
+        'messages': total,
+        'wall_seconds': round(wall, 3),
+        'messages_per_second': round(total / wall, 2) if wall > 0 else None,
+        'cpu_ms_per_message': round(cpu / total * 1000, 3) if total > 0 else None,
+        'time_to_first_edit_ms': percentiles(first_edit),
+        'end_to_end_ms': percentiles(end_to_end),
+        'telegram_retry_after': sum(chat.get('retry_after', 0) for chat in chats.values()),
+        'openai_requests': openai_stats['requests'] - openai_stats_before['requests'],
+        'openai_rate_limited': openai_stats['rate_limited'] - openai_stats_before['rate_limited'],
+        'errors': errors.count,
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Prints the relative change of each result compared to a baseline run
+    """
+    keys = [('messages_per_second', None), ('cpu_ms_per_message', None),
+            ('time_to_first_edit_ms', 'p50'), ('time_to_first_edit_ms', 'p95'), ('time_to_first_edit_ms', 'p99'),
+            ('end_to_end_ms', 'p50'), ('end_to_end_ms', 'p95'), ('end_to_end_ms', 'p99')]
+    for mode, mode_results in results['modes'].items():
+        if mode not in baseline.get('modes', {}):
+            continue
+        print(f'\n{mode}:')
+        for key, sub_key in keys:
+            new = mode_results[key] if sub_key is None else mode_results[key][sub_key]
+            old = baseline['modes'][mode][key] if sub_key is None else baseline['modes'][mode][key][sub_key]
+            name = key if sub_key is None else f'{key}.{sub_key}'
+            if not old or new is None:
+                print(f'  {name:<28} {old} -> {new}')
+                continue
+            print(f'  {name:<28} {old:>10} -> {new:>10} ({(new - old) / old * 100:+.1f}%)')
+
+
+async def run(args, logs_dir: str) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    openai_port, telegram_port = free_port(), free_port()
+    fake_openai = ctx.Process(target=run_fake_openai, daemon=True, args=(openai_port, {
+        'first_token_latency': args.openai_latency,
+        'token_interval': args.token_interval,
+        'answer_tokens': args.answer_tokens,
+        'function_call_ratio': args.function_call_ratio,
+        'rate_limit_ratio': args.rate_limit_ratio,
+    }))
+    fake_telegram = ctx.Process(target=run_fake_telegram, daemon=True, args=(telegram_port, {
+        'flood_rate': args.flood_rate,
+        'flood_burst': args.flood_burst,
+    }))
+    fake_openai.start()
+    fake_telegram.start()
+    try:
+        await wait_for_port(openai_port)
+        await wait_for_port(telegram_port)
+        results = {}
+        for mode in args.modes:
+            logging.info(f'Running {mode} benchmark...')
+            results[mode] = await run_mode(args, mode == 'stream', openai_port, telegram_port, logs_dir)
+        return results
+    finally:
+        fake_openai.terminate()
+        fake_telegram.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark for the Telegram bot')
+    parser.add_argument('--messages', type=int, default=100, help='Total number of messages to send')
+    parser.add_argument('--concurrency', type=int, default=10, help='Number of chats sending messages concurrently')
+    parser.add_argument('--modes', nargs='+', default=['stream', 'nostream'], choices=['stream', 'nostream'])
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    parser.add_argument('--prompt', default='Tell me something interesting')
+    parser.add_argument('--openai-latency', type=float, default=0.2, help='Seconds until the first token')
+    parser.add_argument('--token-interval', type=float, default=0.01, help='Seconds between streamed tokens')
+    parser.add_argument('--answer-tokens', type=int, default=200, help='Number of tokens per answer')
+    parser.add_argument('--function-call-ratio', type=float, default=0.0,
+                        help='Fraction of requests answered with a function call')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0,
+                        help='Fraction of OpenAI requests rejected with 429')
+    parser.add_argument('--flood-rate', type=float, default=1.0,
+                        help='Telegram sends/edits allowed per second and chat (0 disables flood limits)')
+    parser.add_argument('--flood-burst', type=int, default=5)
+    parser.add_argument('--coalesce', action='store_true',
+                        help='Let identical concurrent OpenAI requests share one call (all chats send the same prompt)')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the results with a previous JSON results file')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    logging.getLogger(__name__).setLevel(logging.INFO)
+
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'modes': asyncio.run(run(args, tempfile.mkdtemp(prefix='bot-benchmark-'))),
+    }
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
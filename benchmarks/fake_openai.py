@@ -0,0 +1,137 @@
+"""
+Local stand-in for the OpenAI chat completions API, used by the benchmarks.
+Supports streaming (SSE) and non-streaming answers, function calls, configurable latency and 429 injection.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+         'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua')
+
+
+class FakeOpenAI:
+    """
+    Fake chat completions endpoint
+    """
+
+    def __init__(self, first_token_latency: float = 0.2, token_interval: float = 0.01, answer_tokens: int = 200,
+                 function_call_ratio: float = 0.0, rate_limit_ratio: float = 0.0, retry_after: int = 1,
+                 seed: int = 42):
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.answer_tokens = answer_tokens
+        self.function_call_ratio = function_call_ratio
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.rate_limited = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_get('/_stats', self.stats)
+        return app
+
+    async def stats(self, _: web.Request) -> web.Response:
+        return web.json_response({'requests': self.requests, 'rate_limited': self.rate_limited})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+
+        if self.random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return web.json_response(
+                {'error': {'message': 'Rate limit reached for requests', 'type': 'requests', 'code': None}},
+                status=429, headers={'Retry-After': str(self.retry_after)}
+            )
+
+        functions = body.get('functions') or []
+        last_message = body['messages'][-1]
+        function_call = None
+        if functions and body.get('function_call', 'auto') != 'none' and last_message['role'] == 'user' \
+                and self.random.random() < self.function_call_ratio:
+            function_call = {'name': functions[0]['name'], 'arguments': json.dumps({'query': last_message['content']})}
+
+        words = [self.random.choice(WORDS) for _ in range(self.answer_tokens)]
+        prompt_tokens = sum(len(str(message.get('content', '')).split()) + 4 for message in body['messages'])
+        await asyncio.sleep(self.first_token_latency)
+
+        if body.get('stream'):
+            return await self.__stream(request, body, words, function_call)
+
+        if function_call is not None:
+            message = {'role': 'assistant', 'content': None, 'function_call': function_call}
+            finish_reason = 'function_call'
+            completion_tokens = 20
+        else:
+            await asyncio.sleep(self.token_interval * len(words))
+            message = {'role': 'assistant', 'content': ' '.join(words)}
+            finish_reason = 'stop'
+            completion_tokens = len(words)
+        return web.json_response({
+            'id': f'chatcmpl-{self.requests}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body['model'],
+            'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+    async def __stream(self, request: web.Request, body: dict, words: list[str], function_call: dict | None):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason: str | None = None):
+            chunk = {
+                'id': f'chatcmpl-{self.requests}',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body['model'],
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+
+        if function_call is not None:
+            await send({'role': 'assistant', 'content': None,
+                        'function_call': {'name': function_call['name'], 'arguments': ''}})
+            await send({'function_call': {'arguments': function_call['arguments']}})
+            await send({}, 'function_call')
+        else:
+            await send({'role': 'assistant', 'content': ''})
+            for index, word in enumerate(words):
+                await send({'content': word if index == 0 else f' {word}'})
+                if self.token_interval > 0:
+                    await asyncio.sleep(self.token_interval)
+            await send({}, 'stop')
+
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake OpenAI chat completions server')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--first-token-latency', type=float, default=0.2)
+    parser.add_argument('--token-interval', type=float, default=0.01)
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    parser.add_argument('--function-call-ratio', type=float, default=0.0)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeOpenAI(args.first_token_latency, args.token_interval, args.answer_tokens,
+                      args.function_call_ratio, args.rate_limit_ratio)
+    web.run_app(fake.app(), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Local stand-in for the Telegram Bot API, used by the benchmarks.
+Answers the methods used by the bot, simulates per-chat flood limits and records when
+messages became visible (sent or edited) in each chat.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import time
+
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot',
+            'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': True}
+VISIBLE_METHODS = ('sendMessage', 'editMessageText')
+
+
+class FakeTelegram:
+    """
+    Fake Telegram Bot API endpoint
+    """
+
+    def __init__(self, flood_rate: float = 1.0, flood_burst: int = 5):
+        """
+        :param flood_rate: Message sends/edits allowed per second and chat, 0 disables flood limits
+        :param flood_burst: Number of sends/edits a chat may burst before being limited
+        """
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        self.buckets: dict[str, tuple[float, float]] = {}
+        self.message_id = 0
+        self.chats: dict[str, dict] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_post('/_reset', self.reset)
+        return app
+
+    async def stats(self, _: web.Request) -> web.Response:
+        return web.json_response(self.chats)
+
+    async def reset(self, _: web.Request) -> web.Response:
+        self.chats.clear()
+        self.buckets.clear()
+        return web.json_response({'ok': True})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post()) if request.can_read_body else {}
+        chat_id = str(params.get('chat_id', ''))
+
+        if method in VISIBLE_METHODS and chat_id:
+            chat = self.chats.setdefault(chat_id, {'visible': [], 'retry_after': 0})
+            retry_after = self.__consume(chat_id)
+            if retry_after > 0:
+                chat['retry_after'] += 1
+                return web.json_response({
+                    'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                    'parameters': {'retry_after': retry_after}
+                }, status=429)
+            chat['visible'].append(time.time())
+
+        if method == 'getMe':
+            return self.__ok(BOT_USER)
+        if method in VISIBLE_METHODS:
+            return self.__ok(self.__message(params))
+        return self.__ok(True)
+
+    def __consume(self, chat_id: str) -> int:
+        if self.flood_rate <= 0:
+            return 0
+        now = time.monotonic()
+        tokens, last = self.buckets.get(chat_id, (float(self.flood_burst), now))
+        tokens = min(float(self.flood_burst), tokens + (now - last) * self.flood_rate)
+        if tokens < 1:
+            self.buckets[chat_id] = (tokens, now)
+            return max(1, math.ceil((1 - tokens) / self.flood_rate))
+        self.buckets[chat_id] = (tokens - 1, now)
+        return 0
+
+    def __message(self, params: dict) -> dict:
+        if params.get('message_id'):
+            message_id = int(params['message_id'])
+        else:
+            self.message_id += 1
+            message_id = self.message_id
+        chat_id = int(params.get('chat_id') or 0)
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+    @staticmethod
+    def __ok(result) -> web.Response:
+        return web.Response(text=json.dumps({'ok': True, 'result': result}), content_type='application/json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API server')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--flood-rate', type=float, default=1.0)
+    parser.add_argument('--flood-burst', type=int, default=5)
+    args = parser.parse_args()
+    web.run_app(FakeTelegram(args.flood_rate, args.flood_burst).app(), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
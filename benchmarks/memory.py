@@ -0,0 +1,109 @@
+"""
+Memory benchmark for the conversation histories kept in memory.
+
+Builds the histories of many chats on a fixed, seeded corpus, once with the messages as dicts (the form sent
+to the API, as they were stored before) and once as ChatMessage records, and reports the memory allocated
+per 1000 chats for both, as measured by tracemalloc.
+
+Example:
+    python benchmarks/memory.py --chats 1000 --messages 15
+    python benchmarks/memory.py --chats 10000 --messages 15 --output memory.json
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir, 'bot'))
+
+from chat_message import ChatMessage, from_dicts  # noqa: E402
+
+SEED = 1234
+WORDS = ('the', 'model', 'returns', 'a', 'stream', 'of', 'tokens', 'which', 'are', 'rendered', 'into',
+         'telegram', 'messages', 'with', 'markdown', 'formatting', 'and', 'code', 'blocks', 'for', 'users')
+
+
+def make_contents(chats: int, messages: int, content_length: int) -> list[list[tuple[str, str]]]:
+    """
+    Builds the roles and contents of the messages of every chat. Every content is a distinct string,
+    as in real conversations.
+    """
+    rng = random.Random(SEED)
+    histories = []
+    for _ in range(chats):
+        history = [('system', 'You are a helpful assistant.')]
+        for i in range(messages - 1):
+            length = rng.randint(content_length // 2, content_length * 3 // 2)
+            content = ' '.join(rng.choices(WORDS, k=length // 5 + 1))[:length]
+            # Roles are read from JSON (e.g. a Redis backend), every message has its own role string
+            history.append((json.loads('"user"' if i % 2 == 0 else '"assistant"'), content))
+        histories.append(history)
+    return histories
+
+
+def measure(build) -> int:
+    """
+    Returns the number of bytes still allocated by the objects built by a function.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del built
+    return after - before
+
+
+def run(chats: int, messages: int, content_length: int) -> dict:
+    contents = make_contents(chats, messages, content_length)
+    # The contents are shared by both forms, only the overhead of the messages is compared
+    results = {
+        'dict': measure(lambda: [[{'role': role, 'content': content} for role, content in history]
+                                 for history in contents]),
+        'record': measure(lambda: [[ChatMessage(role, content) for role, content in history]
+                                   for history in contents]),
+        'record_from_dicts': measure(lambda: [from_dicts([{'role': role, 'content': content}
+                                                          for role, content in history])
+                                              for history in contents]),
+    }
+    return {name: value * 1000 / chats for name, value in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory used by the conversation histories')
+    parser.add_argument('--chats', type=int, default=1000, help='Number of chats')
+    parser.add_argument('--messages', type=int, default=15, help='Number of messages per chat')
+    parser.add_argument('--content-length', type=int, default=300, help='Average length of a message')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = run(args.chats, args.messages, args.content_length)
+    print(f'{args.chats} chats, {args.messages} messages per chat, overhead of the messages per 1000 chats '
+          '(the contents are not counted):')
+    for name, value in results.items():
+        print(f'  {name:<20} {value / 1024:>10.1f} KiB ({value / results["dict"]:.0%} of dict)')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'chats': args.chats,
+                'messages': args.messages,
+                'content_length': args.content_length,
+                'bytes_per_1000_chats': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
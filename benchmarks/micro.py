@@ -0,0 +1,376 @@
+"""
+Micro-benchmarks for the hot paths that run on every message or stream delta.
+
+Every benchmark runs on a fixed, seeded corpus so results are comparable between runs.
+The benchmarks run in several rounds, each normalised by a calibration workload timed in the same round.
+Results are stored as JSON; the compare command exits with a non-zero status when the median of a benchmark
+regressed by more than the given threshold, widened by its noise, compared to a baseline.
+A benchmark whose inputs or loop change gets a new version, which makes its stored baseline out of date.
+
+Example:
+    python benchmarks/micro.py run --output benchmarks/baselines/micro.json
+    python benchmarks/micro.py compare benchmarks/baselines/micro.json --threshold 0.25
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import timeit
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir, 'bot'))
+
+from telegram import Chat, Message, MessageEntity, Update, User  # noqa: E402
+
+import utils  # noqa: E402
+
+SEED = 1234
+BENCHMARKS: dict[str, tuple[callable, int]] = {}  # {name: (setup, version)}
+WORDS = ('the', 'model', 'returns', 'a', 'stream', 'of', 'tokens', 'which', 'are', 'rendered', 'into',
+         'telegram', 'messages', 'with', 'markdown', 'formatting', 'and', 'code', 'blocks', 'for', 'users')
+
+
+class SkipBenchmark(Exception):
+    """
+    Raised by a benchmark setup when the benchmark can't run in this environment
+    """
+    pass
+
+
+def benchmark(name: str, version: int = 1):
+    """
+    Registers a benchmark. The decorated function builds the inputs and returns the callable to time.
+    The version must be increased whenever what is timed changes, so the benchmark is not compared
+    with a baseline of its previous form.
+    """
+
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, version)
+        return setup
+
+    return decorator
+
+
+def make_answer(length: int, rng: random.Random) -> str:
+    """
+    Builds a markdown answer of roughly the given length, with paragraphs, lists and code blocks
+    """
+    parts = []
+    size = 0
+    while size < length:
+        kind = rng.random()
+        if kind < 0.15:
+            lines = [f'    result_{i} = compute({i}, "{rng.choice(WORDS)}")' for i in range(rng.randint(5, 30))]
+            block = '```python\n' + '\n'.join(lines) + '\n```'
+        elif kind < 0.3:
+            block = '\n'.join(f'- *{rng.choice(WORDS)}*: ' + ' '.join(rng.choices(WORDS, k=rng.randint(5, 15)))
+                              for _ in range(rng.randint(3, 8)))
+        else:
+            block = ' '.join(rng.choices(WORDS, k=rng.randint(30, 120))) + '.'
+        parts.append(block)
+        size += len(block) + 2
+    return '\n\n'.join(parts)[:length]
+
+
+def make_update(text: str, chat_type: str = Chat.PRIVATE, entities: list[MessageEntity] | None = None) -> Update:
+    chat = Chat(id=-100 if chat_type != Chat.PRIVATE else 100, type=chat_type)
+    user = User(id=100, is_bot=False, first_name='Benchmark')
+    message = Message(message_id=1, date=datetime.datetime.now(), chat=chat, from_user=user, text=text,
+                      entities=entities)
+    return Update(update_id=1, message=message)
+
+
+def make_history(length: int, rng: random.Random) -> list[dict]:
+    history = [{'role': 'system', 'content': 'You are a helpful assistant.'}]
+    for i in range(length - 1):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        history.append({'role': role, 'content': make_answer(rng.randint(50, 1500), rng)})
+    return history
+
+
+@benchmark('split_into_chunks[30k]')
+def bench_split_into_chunks():
+    text = make_answer(30_000, random.Random(SEED))
+    return lambda: utils.split_into_chunks(text)
+
+
+@benchmark('split_into_chunks_nostream[30k]')
+def bench_split_into_chunks_nostream():
+    text = make_answer(30_000, random.Random(SEED))
+    return lambda: utils.split_into_chunks_nostream(text)
+
+
+def stream_loop(length: int):
+    """
+    Chunks a streamed answer delta by delta, like the streaming prompt handler
+    """
+    text = make_answer(length, random.Random(SEED))
+    update = make_update('hello')
+    deltas = [text[i:i + 20] for i in range(0, len(text), 20)]
+
+    def run():
+        chunker = utils.MarkdownChunker()
+        for delta in deltas:
+            chunker.append(delta)
+            utils.get_stream_cutoff_values(update, chunker.tail)
+        chunker.finish()
+
+    return run
+
+
+# Version 1 split the whole answer again on every delta, version 2 chunked it incrementally,
+# version 3 uses the Markdown-aware chunker of the prompt handler
+benchmark('stream_loop[30k]', version=3)(lambda: stream_loop(30_000))
+benchmark('stream_loop[120k]', version=3)(lambda: stream_loop(120_000))
+
+
+@benchmark('message_text[200 entities]')
+def bench_message_text():
+    rng = random.Random(SEED)
+    parts, entities, offset = [], [], 0
+    for i in range(200):
+        kind = MessageEntity.BOT_COMMAND if i % 4 == 0 else rng.choice(
+            [MessageEntity.BOLD, MessageEntity.MENTION, MessageEntity.URL])
+        word = '/chat' if kind == MessageEntity.BOT_COMMAND else f'@user{i}' if kind == MessageEntity.MENTION \
+            else f'https://example.com/{i}' if kind == MessageEntity.URL else rng.choice(WORDS)
+        entities.append(MessageEntity(type=kind, offset=offset, length=len(word)))
+        parts.append(word)
+        offset += len(word) + 1
+    message = make_update(' '.join(parts), entities=entities).message
+    return lambda: utils.message_text(message)
+
+
+@benchmark('message_text[100 plain messages]')
+def bench_message_text_plain():
+    rng = random.Random(SEED)
+    messages = [make_update(make_answer(rng.randint(10, 4_000), rng)).message for _ in range(100)]
+
+    def run():
+        for message in messages:
+            utils.message_text(message)
+
+    return run
+
+
+@benchmark('get_stream_cutoff_values[200 contents]')
+def bench_get_stream_cutoff_values():
+    private = make_update('hello')
+    group = make_update('hello', chat_type=Chat.SUPERGROUP)
+    rng = random.Random(SEED)
+    contents = [make_answer(rng.randint(10, 5_000), rng) for _ in range(100)]
+
+    def run():
+        for content in contents:
+            utils.get_stream_cutoff_values(private, content)
+            utils.get_stream_cutoff_values(group, content)
+
+    return run
+
+
+@benchmark('is_direct_result')
+def bench_is_direct_result():
+    responses = [
+        make_answer(2_000, random.Random(SEED)),
+        json.dumps({'direct_result': {'kind': 'photo', 'format': 'url', 'value': 'https://example.com/a.png'}}),
+        json.dumps({'results': [{'title': word, 'body': word * 20} for word in WORDS]}),
+        {'direct_result': {'kind': 'dice', 'format': 'dice', 'value': '🎲'}},
+    ]
+
+    def run():
+        for response in responses:
+            utils.is_direct_result(response)
+
+    return run
+
+
+@benchmark('count_tokens[100 messages]')
+def bench_count_tokens():
+    import tiktoken
+    from openai_helper import OpenAIHelper
+    from plugin_manager import PluginManager
+
+    try:
+        tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        raise SkipBenchmark(f'tiktoken encoding not available ({type(e).__name__})')
+
+    helper = OpenAIHelper(config={'api_key': 'sk-benchmark', 'model': 'gpt-3.5-turbo', 'proxy': None},
+                          plugin_manager=PluginManager(config={'plugins': []}))
+    history = make_history(100, random.Random(SEED))
+    return lambda: helper._OpenAIHelper__count_tokens(history)
+
+
+def prepare(func, min_time: float) -> tuple[timeit.Timer, int]:
+    """
+    Creates the timer of a callable, with the number of loops making one repetition last about min_time
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    return timer, max(1, round(number * min_time / max(elapsed, 1e-9)))
+
+
+def best_time(timer: timeit.Timer, number: int, repeat: int) -> float:
+    """
+    Times a callable, returning the best time of a call in microseconds
+    """
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def noise(values: list[float]) -> float:
+    """
+    Median absolute deviation of the values, relative to their median
+    """
+    median = statistics.median(values)
+    return statistics.median(abs(value - median) for value in values) / median
+
+
+def calibrate() -> None:
+    """
+    Fixed pure-Python workload, timed next to every benchmark to normalise for the speed of the machine
+    """
+    data = [(i * 7919) % 1000 for i in range(2_000)]
+    text = ''.join(str(value) for value in sorted(data))
+    text.replace('99', '').split('1')
+
+
+def run_benchmarks(pattern: str, rounds: int, repeat: int, min_time: float) -> dict:
+    """
+    Runs the benchmarks in rounds. In each round, every benchmark is timed right after the calibration
+    workload, so a slowdown of the machine during the run (another process, CPU frequency scaling) affects
+    both alike and cancels out in their ratio. The medians of the rounds are kept.
+    """
+    timers = {}
+    for name, (setup, version) in BENCHMARKS.items():
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        try:
+            func = setup()
+        except SkipBenchmark as e:
+            print(f'{name:<36} skipped ({str(e)})', file=sys.stderr)
+            continue
+        timers[name] = (version, *prepare(func, min_time))
+    calibration_timer = prepare(calibrate, min_time)
+
+    calibrations = []
+    timings = {name: [] for name in timers}
+    relative = {name: [] for name in timers}
+    for _ in range(rounds):
+        for name, (_, timer, number) in timers.items():
+            calibrations.append(best_time(*calibration_timer, repeat))
+            timings[name].append(best_time(timer, number, repeat))
+            relative[name].append(timings[name][-1] / calibrations[-1])
+
+    results = {}
+    for name, (version, _, number) in timers.items():
+        results[name] = {
+            'version': version,
+            'min_us': round(statistics.median(timings[name]), 3),
+            'relative': round(statistics.median(relative[name]), 5),
+            'noise': round(noise(relative[name]), 4),
+            'loops': number,
+        }
+        print(f'{name:<36} {results[name]["min_us"]:>14.3f} us  (noise {results[name]["noise"]:.1%})',
+              file=sys.stderr)
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'calibration_us': round(statistics.median(calibrations), 3),
+        'rounds': rounds,
+        'repeat': repeat,
+        'benchmarks': results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float, pattern: str = '*') -> bool:
+    """
+    Prints the change of each benchmark compared to the baseline. The time of a benchmark relative to the
+    calibration workload of the same round is compared, so results from machines (or CPU frequencies) of
+    different speeds are comparable. The threshold is widened by the noise of both measurements (the
+    deviation between their rounds), so a slowdown that is within the noise of this machine is not reported.
+    :return: False if a benchmark regressed by more than the threshold, or has no up-to-date baseline
+    """
+    ok = True
+    if current.get('calibration_us') and baseline.get('calibration_us'):
+        print(f'Machine speed relative to baseline: {baseline["calibration_us"] / current["calibration_us"]:.2f}x')
+    for name, result in current['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            ok = False
+            print(f'{name:<36} no baseline, record it again')
+            continue
+        if old.get('version', 1) != result.get('version', 1):
+            ok = False
+            print(f'{name:<36} baseline of version {old.get("version", 1)}, benchmark of version '
+                  f'{result.get("version", 1)}: the baseline is out of date, record it again')
+            continue
+        if 'relative' not in old:
+            ok = False
+            print(f'{name:<36} baseline recorded without rounds, record it again')
+            continue
+        change = result['relative'] / old['relative'] - 1
+        allowed = threshold + old['noise'] + result['noise']
+        status = ''
+        if change > allowed:
+            ok = False
+            status = 'REGRESSION'
+        print(f'{name:<36} {old["min_us"]:>14.3f} -> {result["min_us"]:>14.3f} us  '
+              f'({change:+.1%}, allowed {allowed:+.1%}) {status}')
+    for name in sorted(baseline['benchmarks'].keys() - current['benchmarks'].keys()):
+        if fnmatch.fnmatch(name, pattern):
+            print(f'{name:<36} missing from current results')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the bot hot paths')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--output', help='Write the results to this JSON file (e.g. to store a baseline)')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare results with a baseline')
+    compare_parser.add_argument('baseline', help='Baseline JSON file')
+    compare_parser.add_argument('current', nargs='?', help='Results JSON file, runs the benchmarks if omitted')
+    compare_parser.add_argument('--threshold', type=float, default=0.25,
+                                help='Maximum allowed relative slowdown (default: 0.25)')
+
+    for sub_parser in (run_parser, compare_parser):
+        sub_parser.add_argument('-k', '--filter', default='*', help='Only run benchmarks matching this glob')
+        sub_parser.add_argument('--rounds', type=int, default=7,
+                                help='Number of rounds, each timing the calibration and every benchmark (default: 7)')
+        sub_parser.add_argument('--repeat', type=int, default=3, help='Repetitions per round (default: 3)')
+        sub_parser.add_argument('--min-time', type=float, default=0.05,
+                                help='Minimum number of seconds per repetition (default: 0.05)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run_benchmarks(args.filter, args.rounds, args.repeat, args.min_time)
+        print(json.dumps(results, indent=2))
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as file:
+                json.dump(results, file, indent=2)
+                file.write('\n')
+        return
+
+    with open(args.baseline, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    if args.current:
+        with open(args.current, 'r', encoding='utf-8') as file:
+            current = json.load(file)
+    else:
+        current = run_benchmarks(args.filter, args.rounds, args.repeat, args.min_time)
+    if not compare(current, baseline, args.threshold, args.filter):
+        print('\nAt least one benchmark regressed by more than the threshold or has no up-to-date baseline')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import sys
+
+_FIELDS = ('role', 'content', 'name')
+
+
+class ChatMessage:
+    """
+    Compact message of a conversation history. Histories of many chats are kept in memory,
+    a slotted record takes a fraction of the memory of a dict. Roles and function names are interned,
+    and the token count of the message is cached once computed.
+    The record can be read like the dict sent to the API (message['role'], message.get('name')),
+    which is only built when a request is sent, with to_dict().
+    """
+    __slots__ = ('role', 'content', 'name', 'tokens')
+
+    def __init__(self, role: str, content: str, name: str | None = None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.name = sys.intern(name) if name is not None else None
+        self.tokens: int | None = None
+
+    @classmethod
+    def from_dict(cls, message) -> ChatMessage:
+        """
+        Converts a message in API form, e.g. a history read from the state backend or a snapshot, to a record.
+        Records are returned as is.
+        """
+        if isinstance(message, ChatMessage):
+            return message
+        record = cls(message['role'], message['content'], message.get('name'))
+        # Snapshots keep the token count of the messages
+        record.tokens = message.get('tokens')
+        return record
+
+    def to_dict(self) -> dict:
+        """
+        Returns the message in the form expected by the API.
+        """
+        if self.name is None:
+            return {'role': self.role, 'content': self.content}
+        return {'role': self.role, 'name': self.name, 'content': self.content}
+
+    def __getitem__(self, key: str):
+        value = getattr(self, key) if key in _FIELDS else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: str, default=None):
+        value = getattr(self, key) if key in _FIELDS else None
+        return value if value is not None else default
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+
+def to_dicts(messages: list) -> list[dict]:
+    """
+    Converts the messages of a request to the form expected by the API.
+    :param messages: The messages, records or dicts
+    """
+    return [message.to_dict() if isinstance(message, ChatMessage) else message for message in messages]
+
+
+def from_dicts(messages: list) -> list[ChatMessage]:
+    """
+    Converts a conversation history to records.
+    :param messages: The messages, records or dicts
+    """
+    return [ChatMessage.from_dict(message) for message in messages]
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import hashlib
+import json
+
+import metrics
+
+USAGE_POLICIES = ('full', 'split', 'leader')
+
+
+class _Flight:
+    """
+    One upstream call shared by concurrent identical requests.
+    """
+
+    def __init__(self):
+        self.members = []  # The requests waiting for the call, in the order they joined
+        self.payers = None  # The requests still waiting when the call ended, they are billed for it
+        self.task: asyncio.Task | None = None
+        # Streamed calls only: the items received so far, whether the stream ended and its error
+        self.items = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.changed = asyncio.Event()
+
+    def finish(self):
+        self.payers = list(self.members)
+
+    def usage_share(self, member, policy: str) -> tuple[float, bool]:
+        """
+        Returns the fraction of the usage attributed to a request, and whether it also gets the rounding remainder.
+        The leader is the first request that did not leave before the end of the call.
+        """
+        payers = self.payers if self.payers is not None else self.members
+        is_leader = len(payers) > 0 and payers[0] is member
+        if policy == 'leader':
+            return (1.0 if is_leader else 0.0), False
+        if policy == 'split':
+            return 1 / max(1, len(payers)), is_leader
+        return 1.0, False
+
+
+class Subscription:
+    """
+    Streamed response of a coalesced call: replays every item received from the upstream stream,
+    including the ones received before the request joined.
+    """
+
+    def __init__(self, coalescer: RequestCoalescer, key: str, flight: _Flight):
+        self.__coalescer = coalescer
+        self.__key = key
+        self.__flight = flight
+        self.__position = 0
+        self.__closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self.__flight
+        while self.__position >= len(flight.items):
+            if flight.done or self.__closed:
+                await self.aclose()
+                if flight.error is not None:
+                    raise flight.error
+                raise StopAsyncIteration
+            await flight.changed.wait()
+        item = flight.items[self.__position]
+        self.__position += 1
+        return item
+
+    async def wait_started(self):
+        """
+        Waits for the first item of the stream, raising the error of the call if it failed before sending any.
+        """
+        flight = self.__flight
+        while len(flight.items) == 0 and not flight.done:
+            await flight.changed.wait()
+        if len(flight.items) == 0 and flight.error is not None:
+            raise flight.error
+
+    @property
+    def usage_share(self) -> float:
+        """
+        The fraction of the usage of the call attributed to this request, final once the stream ended
+        """
+        return self.__flight.usage_share(self, self.__coalescer.usage_policy)[0]
+
+    async def aclose(self):
+        """
+        Stops receiving the stream. The upstream call is cancelled once no request receives it anymore.
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__coalescer.leave(self.__key, self.__flight, self)
+
+
+class RequestCoalescer:
+    """
+    Single-flight coalescing of OpenAI requests: concurrent requests with identical arguments
+    (messages, model, sampling parameters) share one upstream call.
+    """
+
+    def __init__(self, usage_policy: str = 'full'):
+        """
+        Initializes the coalescer.
+        :param usage_policy: How the usage of a shared call is attributed: 'full' (every request is billed the
+                             whole usage, as if it was alone), 'split' (the usage is divided between the requests)
+                             or 'leader' (the request that started the call is billed, the others are free)
+        """
+        if usage_policy not in USAGE_POLICIES:
+            raise ValueError(f"Unknown usage policy '{usage_policy}', expected one of {', '.join(USAGE_POLICIES)}")
+        self.usage_policy = usage_policy
+        self.flights: dict[str, _Flight] = {}
+
+    @staticmethod
+    def key(arguments: dict) -> str:
+        """
+        Builds the key of a request from its arguments.
+        :param arguments: The arguments of the request
+        """
+        return hashlib.sha256(json.dumps(arguments, sort_keys=True, default=str).encode()).hexdigest()
+
+    async def request(self, arguments: dict, call):
+        """
+        Sends a request, or joins the identical request in flight.
+        :param arguments: The arguments of the request, including 'stream'
+        :param call: Coroutine function sending the request with the given arguments
+        :return: The response. A non-streamed response is a copy whose usage is the part attributed to this
+                 request, a streamed response is a Subscription
+        """
+        key = self.key(arguments)
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self.flights[key] = flight
+            pump = self.__pump(key, flight, call, arguments) if arguments.get('stream') \
+                else self.__call(key, flight, call, arguments)
+            flight.task = asyncio.ensure_future(pump)
+        else:
+            metrics.COALESCED_REQUESTS.labels('stream' if arguments.get('stream') else 'non_stream').inc()
+
+        if arguments.get('stream'):
+            subscription = Subscription(self, key, flight)
+            flight.members.append(subscription)
+            try:
+                await subscription.wait_started()
+            except BaseException:
+                await subscription.aclose()
+                raise
+            return subscription
+
+        member = object()
+        flight.members.append(member)
+        try:
+            response = await asyncio.shield(flight.task)
+        finally:
+            self.leave(key, flight, member)
+        return self.__attribute_usage(response, flight, member)
+
+    def leave(self, key: str, flight: _Flight, member):
+        """
+        Removes a request from a call, cancelling the call if no request is waiting for it anymore.
+        """
+        flight.members.remove(member)
+        if len(flight.members) == 0:
+            if not flight.task.done():
+                flight.task.cancel()
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    async def __call(self, key: str, flight: _Flight, call, arguments: dict):
+        try:
+            return await call(**arguments)
+        finally:
+            flight.finish()
+            # Requests arriving after the response are sent again, their messages may have changed meanwhile
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    async def __pump(self, key: str, flight: _Flight, call, arguments: dict):
+        upstream = None
+        try:
+            upstream = await call(**arguments)
+            async for item in upstream:
+                flight.items.append(item)
+                self.__notify(flight)
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.finish()
+            self.__notify(flight)
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if upstream is not None and hasattr(upstream, 'aclose'):
+                await upstream.aclose()
+
+    @staticmethod
+    def __notify(flight: _Flight):
+        changed = flight.changed
+        flight.changed = asyncio.Event()
+        changed.set()
+
+    def __attribute_usage(self, response, flight: _Flight, member):
+        share, gets_remainder = flight.usage_share(member, self.usage_policy)
+        if share == 1.0 or 'usage' not in response:
+            return response
+        response = copy.copy(response)
+        usage = {}
+        for name, tokens in response['usage'].items():
+            usage[name] = int(tokens * share)
+            if gets_remainder:
+                usage[name] += tokens - usage[name] * len(flight.payers)
+        response['usage'] = usage
+        return response
+
+
+def usage_share(response) -> float:
+    """
+    Returns the fraction of the usage of a streamed response attributed to the request, 1 if it was not coalesced.
+    :param response: The streamed response
+    """
+    return response.usage_share if isinstance(response, Subscription) else 1.0
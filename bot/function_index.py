@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import math
+import re
+import time
+
+from ttl_cache import BoundedTTLCache
+
+# Words too common to tell functions apart
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'for', 'from', 'get', 'how', 'i', 'in', 'is',
+    'it', 'me', 'my', 'of', 'on', 'or', 'please', 'the', 'this', 'to', 'use', 'using', 'what', 'when', 'which',
+    'with', 'you', 'your'
+))
+
+# Functions used in a chat stay relevant for a while, e.g. for "and tomorrow?" after asking for the weather
+RECENCY_SECONDS = 30 * 60
+
+
+def _words(text: str) -> list[str]:
+    words = re.findall(r'[a-z0-9]+', text.replace('_', ' ').lower())
+    # Crude stemming, so that e.g. "songs" matches "song"
+    return [word[:-1] if len(word) > 3 and word.endswith('s') else word
+            for word in words if word not in STOP_WORDS]
+
+
+def _trigrams(word: str) -> set[str]:
+    padded = f' {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FunctionSpecIndex:
+    """
+    Local keyword and trigram index over the names, descriptions and parameters of the function specs,
+    to attach only the functions relevant to a query to a request.
+    Functions recently used in a chat are favoured.
+    """
+
+    def __init__(self, specs: list[dict], max_chats: int = 10000):
+        """
+        Builds the index.
+        :param specs: The function specs
+        :param max_chats: Maximum number of chats whose recently used functions are remembered
+        """
+        self.words: dict[str, set[str]] = {}  # {function name: words of its spec}
+        for spec in specs:
+            text = [spec['name'], spec.get('description', '')]
+            for name, parameter in spec.get('parameters', {}).get('properties', {}).items():
+                text += [name, parameter.get('description', '')]
+            # Two plugins may offer a function with the same name
+            self.words.setdefault(spec['name'], set()).update(_words(' '.join(text)))
+
+        # Words found in fewer specs tell more about the query
+        document_frequency: dict[str, int] = {}
+        for words in self.words.values():
+            for word in words:
+                document_frequency[word] = document_frequency.get(word, 0) + 1
+        self.idf = {word: math.log(1 + len(self.words) / count) for word, count in document_frequency.items()}
+        self.trigrams: dict[str, set[str]] = {}  # {trigram: words containing it}
+        for word in self.idf:
+            for trigram in _trigrams(word):
+                self.trigrams.setdefault(trigram, set()).add(word)
+        self.recent = BoundedTTLCache('function_recency', max_size=max_chats, ttl=RECENCY_SECONDS)
+
+    def record_use(self, chat_id, function_name: str):
+        """
+        Remembers that a function was used in a chat.
+        :param chat_id: The chat ID
+        :param function_name: The name of the function
+        """
+        recent = self.recent.get(chat_id, {})
+        recent[function_name] = time.monotonic()
+        self.recent.set(chat_id, recent)
+
+    def scores(self, query: str, chat_id=None) -> dict[str, float]:
+        """
+        Scores the relevance of every function to a query.
+        :param query: The query
+        :param chat_id: The chat ID, to favour the functions recently used in the chat
+        :return: The score of each function name, 0 if it is not relevant
+        """
+        query_words = {}  # {word of the index: weight of the match}
+        for word in set(_words(query)):
+            if word in self.idf:
+                query_words[word] = 1.0
+                continue
+            # Near matches, e.g. a typo or another form of the word
+            candidates = {}
+            trigrams = _trigrams(word)
+            for trigram in trigrams:
+                for candidate in self.trigrams.get(trigram, ()):
+                    candidates[candidate] = candidates.get(candidate, 0) + 1
+            for candidate, shared in candidates.items():
+                similarity = shared / len(trigrams | _trigrams(candidate))
+                if similarity >= 0.5:
+                    query_words[candidate] = max(query_words.get(candidate, 0.0), similarity)
+
+        scores = {name: sum(self.idf[word] * weight for word, weight in query_words.items() if word in words)
+                  for name, words in self.words.items()}
+
+        if chat_id is not None:
+            now = time.monotonic()
+            for name, used_at in self.recent.get(chat_id, {}).items():
+                if name in scores:
+                    scores[name] += max(0.0, 1 - (now - used_at) / RECENCY_SECONDS) * max(self.idf.values())
+        return scores
+
+    def select(self, query: str, chat_id=None, max_specs: int = 0) -> set[str] | None:
+        """
+        Selects the functions most relevant to a query.
+        :param query: The query
+        :param chat_id: The chat ID, to favour the functions recently used in the chat
+        :param max_specs: Maximum number of functions to select
+        :return: The names of the selected functions, or None if no function is relevant
+        """
+        scores = self.scores(query, chat_id)
+        ranked = sorted((name for name, score in scores.items() if score > 0), key=lambda name: -scores[name])
+        if len(ranked) == 0:
+            return None
+        return set(ranked[:max_specs])
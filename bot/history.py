@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+HISTORY_STRATEGIES = ('summarise', 'pack')
+
+
+def _units(messages: list) -> list[list]:
+    """
+    Groups messages into units that are kept or dropped together: a message and the function results
+    that follow it, so that a function result never loses the message that asked for it.
+    """
+    units = []
+    for message in messages:
+        if message['role'] == 'function' and len(units) > 0:
+            units[-1].append(message)
+        else:
+            units.append([message])
+    return units
+
+
+def pack_history(conversation: list, max_tokens: int, count_message_tokens, base_tokens: int = 3,
+                 max_messages: int | None = None) -> list:
+    """
+    Packs a conversation into a token budget without any API call: the system prompt and the latest user turn
+    are always kept, and the remaining budget is filled with the most recent messages, newest first,
+    until the next one does not fit.
+    :param conversation: The conversation, starting with the system prompt and ending with the latest user turn
+    :param max_tokens: The token budget of the packed conversation
+    :param count_message_tokens: Function counting the tokens of a message
+    :param base_tokens: The number of tokens added once to every request
+    :param max_messages: Maximum number of messages of the packed conversation, or None for no limit
+    :return: The packed conversation
+    """
+    if len(conversation) <= 1:
+        return list(conversation)
+    # The latest user turn: the last user message and the messages after it, e.g. function results
+    start = next((i for i in range(len(conversation) - 1, 0, -1) if conversation[i]['role'] == 'user'), 1)
+    head, middle, tail = conversation[:1], conversation[1:start], conversation[start:]
+
+    used_tokens = base_tokens + sum(count_message_tokens(message) for message in head + tail)
+    used_messages = len(head) + len(tail)
+    kept = []
+    for unit in reversed(_units(middle)):
+        unit_tokens = sum(count_message_tokens(message) for message in unit)
+        if used_tokens + unit_tokens > max_tokens or \
+                (max_messages is not None and used_messages + len(unit) > max_messages):
+            break
+        kept[:0] = unit
+        used_tokens += unit_tokens
+        used_messages += len(unit)
+    return head + kept + tail
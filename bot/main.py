@@ -5,28 +5,18 @@ from dotenv import load_dotenv
 
 from plugin_manager import PluginManager
 from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
+from scheduler import parse_weights
+from snapshot import Snapshot
+from state_backend import create_state_backend, InMemoryStateBackend
 from telegram_bot import ChatGPTTelegramBot
+from tracing import configure_tracing
 
 
-def main():
-    # Read .env file
-    load_dotenv()
-
-    # Setup logging
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
-    logging.getLogger("httpx").setLevel(logging.WARNING)
-
-    # Check if the required environment variables are set
-    required_values = ['TELEGRAM_BOT_TOKEN', 'OPENAI_API_KEY']
-    missing_values = [value for value in required_values if os.environ.get(value) is None]
-    if len(missing_values) > 0:
-        logging.error(f'The following environment values are missing in your .env: {", ".join(missing_values)}')
-        exit(1)
-
-    # Setup configurations
+def load_config() -> tuple[dict, dict, dict, dict, dict]:
+    """
+    Reads the bot configuration from the environment variables.
+    :return: The OpenAI, Telegram, plugin, tracing and state configurations
+    """
     model = os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo')
     functions_available = are_functions_available(model=model)
     max_tokens_default = default_max_tokens(model=model)
@@ -50,19 +40,22 @@ def main():
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
         'show_plugins_used': os.environ.get('SHOW_PLUGINS_USED', 'false').lower() == 'true',
         'whisper_prompt': os.environ.get('WHISPER_PROMPT', ''),
+        'coalesce_requests': os.environ.get('COALESCE_REQUESTS', 'true').lower() == 'true',
+        'coalesce_usage_policy': os.environ.get('COALESCE_USAGE_POLICY', 'full').lower(),
+        'response_cache': os.environ.get('RESPONSE_CACHE', 'false').lower() == 'true',
+        'response_cache_ttl': int(os.environ.get('RESPONSE_CACHE_TTL', 3600)),
+        'history_strategy': os.environ.get('HISTORY_STRATEGY', 'summarise').lower(),
+        'memory_index': os.environ.get('MEMORY_INDEX', 'false').lower() == 'true',
+        'memory_index_path': os.environ.get('MEMORY_INDEX_PATH', 'memory_index'),
+        'memory_index_max_results': int(os.environ.get('MEMORY_INDEX_MAX_RESULTS', 3)),
+        'memory_index_max_tokens': int(os.environ.get('MEMORY_INDEX_MAX_TOKENS', 500)),
+        'retry_max_attempts': int(os.environ.get('OPENAI_RETRY_MAX_ATTEMPTS', 3)),
+        'retry_base_seconds': float(os.environ.get('OPENAI_RETRY_BASE_SECONDS', 1.0)),
+        'retry_max_seconds': float(os.environ.get('OPENAI_RETRY_MAX_SECONDS', 20.0)),
+        'retry_budget_per_minute': int(os.environ.get('OPENAI_RETRY_BUDGET_PER_MINUTE', 0)),
+        'request_deadline_seconds': float(os.environ.get('OPENAI_REQUEST_DEADLINE_SECONDS', 60)),
     }
 
-    if openai_config['enable_functions'] and not functions_available:
-        logging.error(f'ENABLE_FUNCTIONS is set to true, but the model {model} does not support it. '
-                        f'Please set ENABLE_FUNCTIONS to false or use a model that supports it.')
-        exit(1)
-    if os.environ.get('MONTHLY_USER_BUDGETS') is not None:
-        logging.warning('The environment variable MONTHLY_USER_BUDGETS is deprecated. '
-                        'Please use USER_BUDGETS with BUDGET_PERIOD instead.')
-    if os.environ.get('MONTHLY_GUEST_BUDGET') is not None:
-        logging.warning('The environment variable MONTHLY_GUEST_BUDGET is deprecated. '
-                        'Please use GUEST_BUDGET with BUDGET_PERIOD instead.')
-
     telegram_config = {
         'token': os.environ['TELEGRAM_BOT_TOKEN'],
         'admin_user_ids': os.environ.get('ADMIN_USER_IDS', '-'),
@@ -83,16 +76,97 @@ def main():
         'image_prices': [float(i) for i in os.environ.get('IMAGE_PRICES', "0.016,0.018,0.02").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
+        'cancel_on_new_message': os.environ.get('CANCEL_ON_NEW_MESSAGE', 'false').lower() == 'true',
+        'membership_cache_ttl': int(os.environ.get('GROUP_MEMBERSHIP_CACHE_TTL', 300)),
+        'membership_lookup_concurrency': int(os.environ.get('GROUP_MEMBERSHIP_LOOKUP_CONCURRENCY', 5)),
+        'inline_query_cache_ttl': int(os.environ.get('INLINE_QUERY_CACHE_TTL', 3600)),
+        'inline_query_debounce_seconds': float(os.environ.get('INLINE_QUERY_DEBOUNCE_SECONDS', 0.5)),
+        'inline_query_cache_time': int(os.environ.get('INLINE_QUERY_CACHE_TIME', 10)),
+        'last_message_ttl': int(os.environ.get('LAST_MESSAGE_TTL', 86400)),
+        'metrics_host': os.environ.get('METRICS_HOST', '127.0.0.1'),
+        'metrics_port': int(os.environ.get('METRICS_PORT', 0)),
+        'scheduler_max_concurrency': int(os.environ.get('SCHEDULER_MAX_CONCURRENCY', 0)),
+        'scheduler_max_per_user': int(os.environ.get('SCHEDULER_MAX_PER_USER', 0)),
+        'scheduler_max_per_chat': int(os.environ.get('SCHEDULER_MAX_PER_CHAT', 0)),
+        'scheduler_weights': parse_weights(os.environ.get('SCHEDULER_WEIGHTS', 'admin:4,user:2,guest:1')),
+        'scheduler_max_pending': int(os.environ.get('SCHEDULER_MAX_PENDING', 0)),
     }
 
     plugin_config = {
-        'plugins': os.environ.get('PLUGINS', '').split(',')
+        'plugins': os.environ.get('PLUGINS', '').split(','),
+        'functions_max_specs': int(os.environ.get('FUNCTIONS_MAX_SPECS', 0)),
+    }
+
+    tracing_config = {
+        'sample_rate': float(os.environ.get('TRACING_SAMPLE_RATE', 0.0)),
+        'exporter': os.environ.get('TRACING_EXPORTER', 'jsonl').lower(),
+        'file': os.environ.get('TRACING_FILE', 'traces.jsonl'),
+        'buffer_size': int(os.environ.get('TRACING_BUFFER_SIZE', 1000)),
+    }
+
+    state_config = {
+        'backend': os.environ.get('STATE_BACKEND', 'memory').lower(),
+        'url': os.environ.get('STATE_BACKEND_URL', ''),
+        'key_prefix': os.environ.get('STATE_BACKEND_KEY_PREFIX', 'chatgpt-telegram-bot'),
+        'max_entries': {
+            'inline_queries': int(os.environ.get('INLINE_QUERY_CACHE_SIZE', 1000)),
+            'last_message': int(os.environ.get('LAST_MESSAGE_CACHE_SIZE', 10000)),
+            'responses': int(os.environ.get('RESPONSE_CACHE_SIZE', 1000)),
+        },
+        'snapshot_path': os.environ.get('SNAPSHOT_PATH', ''),
+        'snapshot_interval_minutes': float(os.environ.get('SNAPSHOT_INTERVAL_MINUTES', 5)),
     }
 
+    return openai_config, telegram_config, plugin_config, tracing_config, state_config
+
+
+def main():
+    # Read .env file
+    load_dotenv()
+
+    # Setup logging
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    # Check if the required environment variables are set
+    required_values = ['TELEGRAM_BOT_TOKEN', 'OPENAI_API_KEY']
+    missing_values = [value for value in required_values if os.environ.get(value) is None]
+    if len(missing_values) > 0:
+        logging.error(f'The following environment values are missing in your .env: {", ".join(missing_values)}')
+        exit(1)
+
+    # Setup configurations
+    openai_config, telegram_config, plugin_config, tracing_config, state_config = load_config()
+    model = openai_config['model']
+
+    if openai_config['enable_functions'] and not are_functions_available(model=model):
+        logging.error(f'ENABLE_FUNCTIONS is set to true, but the model {model} does not support it. '
+                        f'Please set ENABLE_FUNCTIONS to false or use a model that supports it.')
+        exit(1)
+    if os.environ.get('MONTHLY_USER_BUDGETS') is not None:
+        logging.warning('The environment variable MONTHLY_USER_BUDGETS is deprecated. '
+                        'Please use USER_BUDGETS with BUDGET_PERIOD instead.')
+    if os.environ.get('MONTHLY_GUEST_BUDGET') is not None:
+        logging.warning('The environment variable MONTHLY_GUEST_BUDGET is deprecated. '
+                        'Please use GUEST_BUDGET with BUDGET_PERIOD instead.')
+
+    configure_tracing(tracing_config)
+
     # Setup and run ChatGPT and Telegram bot
+    state = create_state_backend(state_config)
+    snapshot = None
+    if state_config['snapshot_path'] and isinstance(state, InMemoryStateBackend):
+        snapshot = Snapshot(state_config['snapshot_path'], tag=model,
+                            interval_minutes=state_config['snapshot_interval_minutes'])
+        snapshot.attach(state)
+    elif state_config['snapshot_path']:
+        logging.warning('SNAPSHOT_PATH is ignored, the state is already kept by the state backend')
     plugin_manager = PluginManager(config=plugin_config)
-    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
-    telegram_bot = ChatGPTTelegramBot(config=telegram_config, openai=openai_helper)
+    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager, state=state)
+    telegram_bot = ChatGPTTelegramBot(config=telegram_config, openai=openai_helper, state=state, snapshot=snapshot)
     telegram_bot.run()
 
 
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+import metrics
+
+
+class GroupMembershipCache:
+    """
+    TTL cache for group chat authorisation.
+    Remembers whether a group chat contains at least one allowed user (chat_id -> authorised)
+    as well as the individual membership lookups (chat_id, user_id -> is member).
+    """
+
+    def __init__(self, ttl: float = 300, max_concurrency: int = 5):
+        """
+        Initializes the cache.
+        :param ttl: Number of seconds a cached result stays valid
+        :param max_concurrency: Maximum number of concurrent membership lookups per chat
+        """
+        self.ttl = ttl
+        self.max_concurrency = max(1, max_concurrency)
+        self.authorised_chats: dict[int, tuple[bool, float]] = {}
+        self.memberships: dict[tuple[int, str], tuple[bool, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Ratio of authorisation checks that were answered from the cache
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    async def is_authorised(self, chat_id: int, user_ids: list[str], lookup) -> bool:
+        """
+        Checks if at least one of the given users is a member of the chat.
+        Cached results are returned immediately, misses are resolved with concurrent lookups
+        that stop as soon as one member is found.
+        :param chat_id: The group chat ID
+        :param user_ids: The IDs of the users that authorise a group chat
+        :param lookup: Coroutine function taking a user ID and returning whether they are a member
+        :return: Boolean indicating if the chat is authorised
+        """
+        authorised = self.__get(self.authorised_chats, chat_id)
+        if authorised is not None:
+            self.hits += 1
+            metrics.MEMBERSHIP_CACHE_LOOKUPS.labels('hit').inc()
+            return authorised
+
+        self.misses += 1
+        metrics.MEMBERSHIP_CACHE_LOOKUPS.labels('miss').inc()
+        start = time.monotonic()
+        authorised = await self.__resolve(chat_id, user_ids, lookup)
+        self.__set(self.authorised_chats, chat_id, authorised)
+        logging.info(f'Group membership lookup for chat {chat_id} took {(time.monotonic() - start) * 1000:.1f}ms '
+                     f'(cache hit rate: {self.hit_rate:.1%})')
+        return authorised
+
+    def invalidate(self, chat_id: int, user_id: int | str | None = None):
+        """
+        Drops the cached results for a chat, e.g. after a member joined or left.
+        :param chat_id: The group chat ID
+        :param user_id: The user whose membership changed, or None to drop all memberships of the chat
+        """
+        self.authorised_chats.pop(chat_id, None)
+        if user_id is not None:
+            self.memberships.pop((chat_id, str(user_id)), None)
+            return
+        for key in [key for key in self.memberships if key[0] == chat_id]:
+            self.memberships.pop(key, None)
+
+    async def __resolve(self, chat_id: int, user_ids: list[str], lookup) -> bool:
+        pending = []
+        for user_id in user_ids:
+            member = self.__get(self.memberships, (chat_id, user_id))
+            if member:
+                return True
+            if member is None:
+                pending.append(user_id)
+        if len(pending) == 0:
+            return False
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def _lookup(user_id: str) -> tuple[str, bool]:
+            async with semaphore:
+                is_member = await lookup(user_id)
+            self.__set(self.memberships, (chat_id, user_id), is_member)
+            return user_id, is_member
+
+        tasks = [asyncio.create_task(_lookup(user_id)) for user_id in pending]
+        error = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    user_id, is_member = await next_done
+                except Exception as e:
+                    error = error or e
+                    continue
+                if is_member:
+                    logging.info(f'{user_id} is a member. Allowing group chat message...')
+                    return True
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # Don't cache a negative result if some lookups failed
+        if error is not None:
+            raise error
+        return False
+
+    def __get(self, cache: dict, key) -> bool | None:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            cache.pop(key, None)
+            return None
+        return value
+
+    def __set(self, cache: dict, key, value: bool):
+        cache[key] = (value, time.monotonic() + self.ttl)
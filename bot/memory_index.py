@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import pathlib
+import re
+import time
+
+import metrics
+from ttl_cache import BoundedTTLCache
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def _terms(text: str) -> list[str]:
+    return re.findall(r'\w+', text.casefold())
+
+
+class _ChatIndex:
+    """
+    Inverted index of the past turns of one chat, loaded from its file.
+    """
+
+    def __init__(self):
+        self.turns: list[list[dict]] = []  # The messages of each turn
+        self.lengths: list[int] = []  # The number of terms of each turn
+        self.postings: dict[str, dict[int, int]] = {}  # {term: {turn: frequency of the term in the turn}}
+        self.offset = 0  # Size of the file read so far
+
+    def add(self, messages: list[dict]):
+        turn = len(self.turns)
+        terms = _terms(' '.join(message['content'] for message in messages))
+        self.turns.append(messages)
+        self.lengths.append(len(terms))
+        for term in terms:
+            postings = self.postings.setdefault(term, {})
+            postings[turn] = postings.get(turn, 0) + 1
+
+    def search(self, query: str) -> list[tuple[float, int]]:
+        """
+        Scores the turns containing the terms of the query with BM25.
+        :return: The score and index of the matching turns, the best first
+        """
+        if len(self.turns) == 0:
+            return []
+        average_length = sum(self.lengths) / len(self.turns)
+        scores: dict[int, float] = {}
+        for term in set(_terms(query)):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            idf = math.log(1 + (len(self.turns) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for turn, frequency in postings.items():
+                norm = K1 * (1 - B + B * self.lengths[turn] / average_length)
+                scores[turn] = scores.get(turn, 0.0) + idf * frequency * (K1 + 1) / (frequency + norm)
+        return sorted(((score, turn) for turn, score in scores.items()), reverse=True)
+
+
+class MemoryIndex:
+    """
+    Local long-term memory of the chats: the turns dropped from a conversation when it overflows are
+    appended to a JSON lines file per chat, and the past turns relevant to a new query are found with
+    a BM25 inverted index, without any embedding API.
+    The indexes of the recently used chats are kept in memory and follow the files, which may be shared
+    by several bot processes.
+    """
+
+    def __init__(self, path: str = 'memory_index', max_chats: int = 100):
+        """
+        Initializes the memory.
+        :param path: The directory of the files
+        :param max_chats: Maximum number of chats whose index is kept in memory
+        """
+        self.path = path
+        self.indexes = BoundedTTLCache('memory_index', max_size=max_chats)
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+
+    def __file(self, chat_id) -> str:
+        return os.path.join(self.path, f'{chat_id}.jsonl')
+
+    def __load(self, chat_id) -> _ChatIndex:
+        """
+        Returns the index of a chat, reading the turns added to its file since it was last read.
+        """
+        index = self.indexes.get(chat_id)
+        if index is None:
+            index = _ChatIndex()
+            self.indexes.set(chat_id, index)
+        file = self.__file(chat_id)
+        size = os.path.getsize(file) if os.path.isfile(file) else 0
+        if size < index.offset:
+            # The file was deleted or replaced by another process
+            index = _ChatIndex()
+            self.indexes.set(chat_id, index)
+        if size > index.offset:
+            with open(file, 'rb') as f:
+                f.seek(index.offset)
+                data = f.read(size - index.offset)
+            # A line still being written by another process is read next time
+            complete = data[:data.rfind(b'\n') + 1]
+            for line in complete.splitlines():
+                if line.strip():
+                    index.add(json.loads(line)['messages'])
+            index.offset += len(complete)
+        return index
+
+    def add(self, chat_id, messages: list[dict]):
+        """
+        Indexes the messages dropped from a conversation, grouped in turns starting with a user message.
+        :param chat_id: The chat ID
+        :param messages: The messages, oldest first
+        """
+        turns = []
+        for message in messages:
+            if message['role'] == 'system':
+                continue
+            if message['role'] == 'user' or len(turns) == 0:
+                turns.append([])
+            turns[-1].append({'role': message['role'], 'content': message.get('content') or ''})
+        if len(turns) == 0:
+            return
+
+        start = time.perf_counter()
+        now = time.time()
+        with open(self.__file(chat_id), 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps({'time': now, 'messages': turn}, ensure_ascii=False) + '\n' for turn in turns))
+        # Reading the file back also indexes the turns added by other processes in the meantime
+        self.__load(chat_id)
+        metrics.MEMORY_INDEX_SECONDS.labels('index').observe((time.perf_counter() - start) / len(turns))
+
+    def search(self, chat_id, query: str, max_results: int) -> list[list[dict]]:
+        """
+        Finds the past turns of a chat most relevant to a query.
+        :param chat_id: The chat ID
+        :param query: The query
+        :param max_results: Maximum number of turns
+        :return: The messages of the turns, the most relevant first
+        """
+        start = time.perf_counter()
+        index = self.__load(chat_id)
+        results = [index.turns[turn] for _, turn in index.search(query)[:max_results]]
+        metrics.MEMORY_INDEX_SECONDS.labels('search').observe(time.perf_counter() - start)
+        return results
+
+    def delete(self, chat_id):
+        """
+        Forgets all the past turns of a chat.
+        :param chat_id: The chat ID
+        """
+        self.indexes.pop(chat_id)
+        file = self.__file(chat_id)
+        if os.path.isfile(file):
+            os.remove(file)
@@ -0,0 +1,362 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import logging
+import math
+import time
+
+from telegram.request import HTTPXRequest
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """
+    Base class of all metrics. Metrics register themselves in the REGISTRY when created.
+    """
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple | list = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        REGISTRY.register(self)
+
+    def labels(self, *labelvalues):
+        """
+        Returns the child metric for the given label values
+        """
+        child = self.children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f'Metric {self.name} expects labels {self.labelnames}')
+            child = self.children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default_child(self):
+        return self.labels()
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for labelvalues, child in list(self.children.items()):
+            lines.extend(child.render(self.name, self.labelnames, labelvalues))
+        return lines
+
+
+class _ValueChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def render(self, name, labelnames, labelvalues) -> list[str]:
+        return [f'{name}{_format_labels(labelnames, labelvalues)} {_format_value(self.value)}']
+
+
+class _CounterChild(_ValueChild):
+    __slots__ = ()
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class _GaugeChild(_ValueChild):
+    __slots__ = ()
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ('upper_bounds', 'bucket_counts', 'sum', 'count')
+
+    def __init__(self, upper_bounds: tuple):
+        self.upper_bounds = upper_bounds
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """
+        Context manager observing the duration of the wrapped block, in seconds
+        """
+        return _Timer(self)
+
+    def render(self, name, labelnames, labelvalues) -> list[str]:
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.upper_bounds + (math.inf,), self.bucket_counts):
+            cumulative += bucket_count
+            le = f'le="{_format_value(upper_bound)}"'
+            lines.append(f'{name}_bucket{_format_labels(labelnames, labelvalues, le)} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labelnames, labelvalues)} {_format_value(self.sum)}')
+        lines.append(f'{name}_count{_format_labels(labelnames, labelvalues)} {self.count}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: _HistogramChild):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Counter(_Metric):
+    """
+    A monotonically increasing counter
+    """
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default_child().inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down
+    """
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1):
+        self._default_child().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default_child().dec(amount)
+
+    def set(self, value: float):
+        self._default_child().set(value)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations in cumulative buckets, along with their sum and count
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple | list = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value: float):
+        self._default_child().observe(value)
+
+    def time(self):
+        return self._default_child().time()
+
+
+class Registry:
+    """
+    Collection of all metrics exposed by the bot
+    """
+
+    def __init__(self):
+        self.metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        Renders all metrics in the Prometheus plain text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_UPDATES = Counter('chatgpt_bot_updates_total', 'Number of updates processed per handler', ['handler'])
+GROUP_MESSAGES_DISCARDED = Counter('chatgpt_bot_group_messages_discarded_total',
+                                   'Number of group messages discarded by the trigger filter')
+INLINE_QUERIES_SUPERSEDED = Counter('chatgpt_bot_inline_queries_superseded_total',
+                                    'Number of inline queries dropped because the user kept typing')
+MEMBERSHIP_CACHE_LOOKUPS = Counter('chatgpt_bot_membership_cache_lookups_total',
+                                   'Number of group authorisation checks by cache result', ['result'])
+OPENAI_FIRST_TOKEN_SECONDS = Histogram('chatgpt_bot_openai_time_to_first_token_seconds',
+                                       'Time until the first streamed token is received from OpenAI', ['model'])
+OPENAI_REQUEST_SECONDS = Histogram('chatgpt_bot_openai_request_duration_seconds',
+                                   'Total duration of chat completions, including function calls', ['model'])
+OPENAI_TOKENS = Histogram('chatgpt_bot_openai_tokens_per_request', 'Number of tokens used per chat request',
+                          ['model'], buckets=TOKEN_BUCKETS)
+OPENAI_RETRIES = Counter('chatgpt_bot_openai_retries_total',
+                         'Number of OpenAI requests retried, by operation and error', ['operation', 'error'])
+OPENAI_RETRIES_STOPPED = Counter('chatgpt_bot_openai_retries_stopped_total',
+                                 'Number of failed OpenAI requests not retried (attempts, deadline or budget reached, '
+                                 'or Retry-After too long), '
+                                 'by operation and reason', ['operation', 'reason'])
+SUMMARISATIONS = Counter('chatgpt_bot_summarisations_total', 'Number of chat history summarisations', ['model'])
+PLUGIN_CALL_SECONDS = Histogram('chatgpt_bot_plugin_call_duration_seconds', 'Duration of plugin function calls',
+                                ['function'])
+FUNCTION_SPEC_SELECTIONS = Counter('chatgpt_bot_function_spec_selections_total',
+                                   'Number of requests whose function specs were selected by relevance, '
+                                   'or all attached because none was relevant', ['result'])
+FUNCTION_SPEC_TOKENS_SAVED = Counter('chatgpt_bot_function_spec_tokens_saved_total',
+                                     'Number of prompt tokens saved by attaching only the relevant function specs',
+                                     ['model'])
+PLUGIN_CALL_ERRORS = Counter('chatgpt_bot_plugin_call_errors_total', 'Number of failed plugin function calls',
+                             ['function'])
+TELEGRAM_REQUEST_SECONDS = Histogram('chatgpt_bot_telegram_request_duration_seconds',
+                                     'Duration of Telegram Bot API requests', ['method'])
+TELEGRAM_RETRY_AFTER = Counter('chatgpt_bot_telegram_retry_after_total',
+                               'Number of Telegram Bot API requests rejected with RetryAfter', ['method'])
+MARKDOWN_REPAIRS = Counter('chatgpt_bot_markdown_repairs_total',
+                           'Number of messages whose Markdown was repaired locally, avoiding a plain text resend')
+MARKDOWN_FALLBACKS = Counter('chatgpt_bot_markdown_fallbacks_total',
+                             'Number of messages resent as plain text after Telegram rejected their Markdown')
+BUDGET_REJECTIONS = Counter('chatgpt_bot_budget_rejections_total',
+                            'Number of requests not sent because their prompt would exceed the budget of the user',
+                            ['model'])
+BUDGET_CUTOFFS = Counter('chatgpt_bot_budget_cutoffs_total',
+                         'Number of streamed answers stopped because they would exceed the budget of the user',
+                         ['model'])
+GENERATIONS_CANCELLED = Counter('chatgpt_bot_generations_cancelled_total',
+                                'Number of streamed answers stopped before the end, by reason', ['reason'])
+COALESCED_REQUESTS = Counter('chatgpt_bot_coalesced_requests_total',
+                             'Number of OpenAI requests that joined an identical request in flight', ['mode'])
+RESPONSE_CACHE_LOOKUPS = Counter('chatgpt_bot_response_cache_lookups_total',
+                                 'Number of response cache lookups by kind (chat, image) and result (hit, miss)',
+                                 ['kind', 'result'])
+CACHE_ENTRIES = Gauge('chatgpt_bot_cache_entries', 'Number of entries in bounded in-process caches', ['cache'])
+CACHE_EVICTIONS = Counter('chatgpt_bot_cache_evictions_total',
+                          'Number of entries dropped from bounded in-process caches', ['cache', 'reason'])
+MEMORY_INDEX_SECONDS = Histogram('chatgpt_bot_memory_index_duration_seconds',
+                                 'Duration of indexing a past turn in the long-term memory, or of a search',
+                                 ['operation'],
+                                 buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5))
+MEMORY_INDEX_RECALLS = Counter('chatgpt_bot_memory_index_recalled_turns_total',
+                               'Number of past turns added back to prompts from the long-term memory')
+SNAPSHOT_SECONDS = Histogram('chatgpt_bot_snapshot_duration_seconds', 'Duration of state snapshot writes')
+SNAPSHOT_RESTORED_ENTRIES = Counter('chatgpt_bot_snapshot_restored_entries_total',
+                                    'Number of state entries read back from the snapshot after a restart',
+                                    ['namespace'])
+SCHEDULER_QUEUE_DEPTH = Gauge('chatgpt_bot_scheduler_queue_depth',
+                              'Number of OpenAI requests waiting for a slot, by priority class', ['priority'])
+SCHEDULER_IN_FLIGHT = Gauge('chatgpt_bot_scheduler_in_flight',
+                            'Number of OpenAI requests holding a slot, by priority class', ['priority'])
+SCHEDULER_SHED_REQUESTS = Counter('chatgpt_bot_scheduler_shed_requests_total',
+                                  'Number of OpenAI requests refused because the bot was overloaded, by priority class',
+                                  ['priority'])
+SCHEDULER_WAIT_SECONDS = Histogram('chatgpt_bot_scheduler_wait_seconds',
+                                   'Time OpenAI requests waited for a slot, by priority class', ['priority'],
+                                   buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+TRANSCODING_SECONDS = Histogram('chatgpt_bot_transcoding_duration_seconds', 'Duration of audio transcoding to mp3')
+TRANSCRIPTION_SECONDS = Histogram('chatgpt_bot_transcription_duration_seconds', 'Duration of Whisper transcriptions')
+USAGE_FLUSH_SECONDS = Histogram('chatgpt_bot_usage_flush_duration_seconds', 'Duration of usage log file writes',
+                                buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+def count_updates(handler_name: str, callback):
+    """
+    Wraps a handler callback to count the updates it processes
+    """
+    counter = HANDLER_UPDATES.labels(handler_name)
+
+    async def _callback(update, context):
+        counter.inc()
+        return await callback(update, context)
+
+    return _callback
+
+
+class MetricsHTTPXRequest(HTTPXRequest):
+    """
+    HTTPXRequest that records the duration of every Telegram Bot API call and RetryAfter responses
+    """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        finally:
+            TELEGRAM_REQUEST_SECONDS.labels(api_method).observe(time.perf_counter() - start)
+        if code == 429:
+            TELEGRAM_RETRY_AFTER.labels(api_method).inc()
+        return code, payload
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Starts a minimal HTTP server exposing the metrics on /metrics
+    """
+
+    async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Skip the request headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/metrics', '/'):
+                status, body = '200 OK', REGISTRY.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode('latin-1') + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logging.warning(f'Failed to serve metrics: {str(e)}')
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(_handle, host, port)
+    logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
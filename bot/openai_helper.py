@@ -1,7 +1,10 @@
 from __future__ import annotations
+import asyncio
 import datetime
+import functools
 import logging
 import os
+import time
 
 import tiktoken
 
@@ -12,10 +15,26 @@ import json
 from datetime import date
 from calendar import monthrange
 
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
-
+import metrics
+import tracing
 from utils import is_direct_result
 from plugin_manager import PluginManager
+from state_backend import StateBackend, InMemoryStateBackend
+from response_cache import ResponseCache, normalise_query
+from coalescer import RequestCoalescer, usage_share
+from memory_index import MemoryIndex
+from chat_message import ChatMessage, from_dicts, to_dicts
+from history import HISTORY_STRATEGIES, pack_history
+from retry_policy import RetryPolicy
+
+# OpenAI deletes generated images after an hour
+IMAGE_URL_TTL = 50 * 60
+
+# Smallest answer worth requesting, the history is summarised or trimmed to leave at least this room
+MIN_COMPLETION_TOKENS = 256
+
+# Tokens added by the API around the function specs of a request
+FUNCTIONS_OVERHEAD_TOKENS = 12
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 GPT_3_MODELS = ("gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613")
@@ -80,47 +99,87 @@ def localized_text(key, bot_language):
             return key
 
 
+class BudgetExceededError(Exception):
+    """
+    Raised before sending a request whose prompt alone would exceed the remaining budget of the user.
+    """
+
+
 class OpenAIHelper:
     """
     ChatGPT helper class.
     """
 
-    def __init__(self, config: dict, plugin_manager: PluginManager):
+    def __init__(self, config: dict, plugin_manager: PluginManager, state: StateBackend | None = None):
         """
         Initializes the OpenAI helper class with the given configuration.
         :param config: A dictionary containing the GPT configuration
         :param plugin_manager: The plugin manager
+        :param state: The backend storing the conversations (namespace 'conversations', {chat_id: history})
+                      and their last update timestamps (namespace 'last_updated'), in-process if None
         """
+        if config.get('history_strategy', 'summarise') not in HISTORY_STRATEGIES:
+            raise ValueError(f"Unknown history strategy '{config['history_strategy']}', "
+                             f"expected one of {', '.join(HISTORY_STRATEGIES)}")
         openai.api_key = config['api_key']
         openai.proxy = config['proxy']
         self.config = config
         self.plugin_manager = plugin_manager
-        self.conversations: dict[int: list] = {}  # {chat_id: history}
-        self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
-
-    def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
+        self.state = state if state is not None else InMemoryStateBackend()
+        self.response_cache = ResponseCache(self.state, ttl=config['response_cache_ttl']) \
+            if config.get('response_cache', False) else None
+        self.__encoding = None
+        self.__function_tokens: dict[str, int] = {}  # {function spec as JSON: number of tokens}
+        self.coalescer = RequestCoalescer(usage_policy=config['coalesce_usage_policy']) \
+            if config.get('coalesce_requests', False) else None
+        self.memory_index = MemoryIndex(config['memory_index_path']) if config.get('memory_index', False) else None
+        self.retry_policy = RetryPolicy(max_attempts=config.get('retry_max_attempts', 3),
+                                        base_seconds=config.get('retry_base_seconds', 1.0),
+                                        max_seconds=config.get('retry_max_seconds', 20.0),
+                                        budget_per_minute=config.get('retry_budget_per_minute', 0),
+                                        deadline_seconds=config.get('request_deadline_seconds', 60))
+
+    async def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
         Gets the number of messages and tokens used in the conversation.
         :param chat_id: The chat ID
         :return: A tuple containing the number of messages and tokens used
         """
-        if chat_id not in self.conversations:
-            self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        conversation = await self.__load_history(chat_id)
+        if conversation is None:
+            conversation = await self.reset_chat_history(chat_id)
+        return len(conversation), self.__count_tokens(conversation)
 
-    async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
+    async def get_chat_response(self, chat_id: int, query: str, cacheable=False,
+                                budget_tokens: int | None = None) -> tuple[str, str]:
         """
         Gets a full response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
+        :param cacheable: Whether the answer can be served from (and stored in) the response cache
+                          when the conversation has no context yet
+        :param budget_tokens: Number of tokens the user can still afford, or None if unlimited.
+                              The length of the answer is limited to fit in it
         :return: The answer from the model and the number of tokens used
         """
+        cache_key = await self.__response_cache_key(chat_id, query) if cacheable else None
+        if cache_key is not None:
+            answer = await self.__get_cached_response(chat_id, query, cache_key)
+            if answer is not None:
+                return answer, '0'
+
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query)
-        if self.config['enable_functions']:
-            response, plugins_used = await self.__handle_function_call(chat_id, response)
-            if is_direct_result(response):
-                return response, '0'
+        start = time.perf_counter()
+        with self.retry_policy.deadline():
+            response, conversation = await self.__common_get_chat_response(chat_id, query,
+                                                                           budget_tokens=budget_tokens)
+            stored_length = len(conversation)
+            if self.config['enable_functions']:
+                response, plugins_used = await self.__handle_function_call(chat_id, conversation, response,
+                                                                           budget_tokens=budget_tokens)
+        if self.config['enable_functions'] and is_direct_result(response):
+            await self.__add_to_history(chat_id, conversation[stored_length:])
+            return response, '0'
 
         answer = ''
 
@@ -128,13 +187,16 @@ class OpenAIHelper:
             for index, choice in enumerate(response.choices):
                 content = choice['message']['content'].strip()
                 if index == 0:
-                    self.__add_to_history(chat_id, role="assistant", content=content)
+                    conversation.append(ChatMessage("assistant", content))
                 answer += f'{index + 1}\u20e3\n'
                 answer += content
                 answer += '\n\n'
         else:
             answer = response.choices[0]['message']['content'].strip()
-            self.__add_to_history(chat_id, role="assistant", content=answer)
+            conversation.append(ChatMessage("assistant", answer))
+        await self.__add_to_history(chat_id, conversation[stored_length:])
+        if cache_key is not None and len(plugins_used) == 0:
+            await self.response_cache.set(cache_key, answer.strip())
 
         bot_language = self.config['bot_language']
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
@@ -149,105 +211,199 @@ class OpenAIHelper:
         elif show_plugins_used:
             answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
+        model = self.config['model']
+        metrics.OPENAI_REQUEST_SECONDS.labels(model).observe(time.perf_counter() - start)
+        metrics.OPENAI_TOKENS.labels(model).observe(response.usage['total_tokens'])
         return answer, response.usage['total_tokens']
 
-    async def get_chat_response_stream(self, chat_id: int, query: str):
+    async def get_chat_response_stream(self, chat_id: int, query: str, cacheable=False,
+                                       cancel_event: asyncio.Event | None = None, budget_tokens: int | None = None):
         """
         Stream response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used, or 'not_finished'
+        :param cacheable: Whether the answer can be served from (and stored in) the response cache
+                          when the conversation has no context yet
+        :param cancel_event: Event set to stop the generation. The upstream stream is closed, the part of
+                             the answer received so far is kept and only the tokens consumed are counted
+        :param budget_tokens: Number of tokens the user can still afford, or None if unlimited. The length of
+                              the answer is limited to fit in it, and its tokens are counted as they arrive:
+                              the generation is stopped the same way before it exceeds the budget,
+                              with a note after the answer
+        :return: Each new part of the answer with 'not_finished', then the text to append after the answer
+                 (e.g. the usage footer) with the number of tokens used
         """
-        plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query, stream=True)
-        if self.config['enable_functions']:
-            response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
-            if is_direct_result(response):
-                yield response, '0'
+        cache_key = await self.__response_cache_key(chat_id, query) if cacheable else None
+        if cache_key is not None:
+            answer = await self.__get_cached_response(chat_id, query, cache_key)
+            if answer is not None:
+                # The whole answer at once, nothing is billed
+                yield answer, 'not_finished'
+                yield '', '0'
                 return
 
-        answer = ''
-        async for item in response:
-            if 'choices' not in item or len(item.choices) == 0:
-                continue
-            delta = item.choices[0].delta
-            if 'content' in delta and delta.content is not None:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
-        self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        plugins_used = ()
+        start = time.perf_counter()
+        first_token_received = False
+        # The deadline does not cover the stream itself, only the requests until it starts
+        with self.retry_policy.deadline():
+            response, conversation = await self.__common_get_chat_response(chat_id, query, stream=True,
+                                                                           budget_tokens=budget_tokens)
+            stored_length = len(conversation)
+            if self.config['enable_functions']:
+                response, plugins_used = await self.__handle_function_call(chat_id, conversation, response,
+                                                                           stream=True, budget_tokens=budget_tokens)
+        if self.config['enable_functions'] and is_direct_result(response):
+            await self.__add_to_history(chat_id, conversation[stored_length:])
+            yield response, '0'
+            return
+
+        parts = []
+        cancelled = False
+        budget_exceeded = False
+        if budget_tokens is not None:
+            encoding = self.__get_encoding()
+            # The answer is counted as an assistant message of the conversation
+            used_tokens = self.__count_tokens(conversation + [ChatMessage('assistant', '')])
+        try:
+            async for item in response:
+                if cancel_event is not None and cancel_event.is_set():
+                    cancelled = True
+                    break
+                if 'choices' not in item or len(item.choices) == 0:
+                    continue
+                delta = item.choices[0].delta
+                if 'content' in delta and delta.content:
+                    if not first_token_received:
+                        first_token_received = True
+                        metrics.OPENAI_FIRST_TOKEN_SECONDS.labels(self.config['model']).observe(
+                            time.perf_counter() - start)
+                    if budget_tokens is not None:
+                        used_tokens += len(encoding.encode(delta.content))
+                        # Stop before the answer exceeds the budget, the part that would exceed it is dropped
+                        if used_tokens > budget_tokens:
+                            cancelled = budget_exceeded = True
+                            metrics.BUDGET_CUTOFFS.labels(self.config['model']).inc()
+                            break
+                    parts.append(delta.content)
+                    yield delta.content, 'not_finished'
+        finally:
+            # Stops the generation if the stream was not read to the end
+            if hasattr(response, 'aclose'):
+                await response.aclose()
+        answer = ''.join(parts).strip()
+        conversation.append(ChatMessage("assistant", answer))
+        await self.__add_to_history(chat_id, conversation[stored_length:])
+        if cache_key is not None and len(plugins_used) == 0 and not cancelled:
+            await self.response_cache.set(cache_key, answer)
+        total_tokens = self.__count_tokens(conversation)
+        tokens_used = str(round(total_tokens * usage_share(response)))
+        metrics.OPENAI_REQUEST_SECONDS.labels(self.config['model']).observe(time.perf_counter() - start)
+        metrics.OPENAI_TOKENS.labels(self.config['model']).observe(total_tokens)
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
+        footer = ''
+        if budget_exceeded:
+            footer += f"\n\n✂️ _{localized_text('budget_cutoff', self.config['bot_language'])}_"
         if self.config['show_usage']:
-            answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
+            footer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
             if show_plugins_used:
-                answer += f"\n🔌 {', '.join(plugin_names)}"
+                footer += f"\n🔌 {', '.join(plugin_names)}"
         elif show_plugins_used:
-            answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+            footer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
-        yield answer, tokens_used
+        yield footer, tokens_used
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.error.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3)
-    )
-    async def __common_get_chat_response(self, chat_id: int, query: str, stream=False):
+    @tracing.traced('openai.chat_completion')
+    async def __common_get_chat_response(self, chat_id: int, query: str, stream=False,
+                                         budget_tokens: int | None = None):
         """
         Request a response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used
+        :param budget_tokens: Number of tokens the user can still afford, or None if unlimited
+        :return: The response from the model and a copy of the conversation history it was generated from,
+                 to which the messages of this request are appended until they are added to the stored history
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                self.reset_chat_history(chat_id)
-
-            self.last_updated[chat_id] = datetime.datetime.now()
-
-            self.__add_to_history(chat_id, role="user", content=query)
-
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
+            functions, function_tokens = self.__get_functions(chat_id, query) \
+                if self.config['enable_functions'] else ([], 0)
+
+            async with self.state.lock('conversations', chat_id):
+                conversation = await self.__load_history(chat_id)
+                if conversation is None or self.__max_age_reached(await self.state.get('last_updated', chat_id)):
+                    conversation = self.__new_history()
+
+                await self.state.set('last_updated', chat_id, time.time(), ttl=self.__state_ttl())
+
+                conversation = conversation + [ChatMessage("user", query)]
+
+                # Summarize (or pack) the chat history if it's too long to avoid excessive token usage
+                token_count = self.__count_tokens(conversation) + function_tokens
+                exceeded_max_tokens = token_count + self.__min_completion_tokens() > self.__max_model_tokens()
+                exceeded_max_history_size = len(conversation) > self.config['max_history_size']
+
+                history = None  # The history to summarise, if any
+                if (exceeded_max_tokens or exceeded_max_history_size) and self.memory_index is not None:
+                    conversation = self.__move_to_memory(chat_id, conversation)
+                elif (exceeded_max_tokens or exceeded_max_history_size) \
+                        and self.config.get('history_strategy', 'summarise') == 'pack':
+                    logging.info(f'Chat history for chat ID {chat_id} is too long. Packing...')
+                    conversation = self.__pack_history(conversation, function_tokens)
+                elif exceeded_max_tokens or exceeded_max_history_size:
+                    # Summarised below, without holding the lock during the request
+                    history = conversation[:-1]
+
+                if history is None:
+                    messages, max_tokens = await self.__prepare_request(chat_id, query, conversation,
+                                                                        function_tokens, budget_tokens)
+
+            if history is not None:
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
+                metrics.SUMMARISATIONS.labels(self.config['model']).inc()
                 try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
+                    with tracing.span('openai.summarise'):
+                        summary = await self.__summarise(history)
                     logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
+                    summarised = self.__new_history(history[0]['content']) + [ChatMessage("assistant", summary)]
                 except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    logging.warning(f'Error while summarising chat history: {str(e)}. Packing it instead...')
+                    summarised = self.__pack_history(conversation, function_tokens)[:-1]
+
+                async with self.state.lock('conversations', chat_id):
+                    stored = await self.__load_history(chat_id)
+                    if stored is not None and to_dicts(stored[:len(history)]) == to_dicts(history):
+                        # Keeps the messages added by concurrent requests while the summary was requested
+                        conversation = summarised + stored[len(history):] + [ChatMessage("user", query)]
+                    else:
+                        # The history was replaced meanwhile (e.g. reset or summarised by another request),
+                        # the summary of the previous one is dropped
+                        conversation = (stored or self.__new_history()) + [ChatMessage("user", query)]
+                    messages, max_tokens = await self.__prepare_request(chat_id, query, conversation,
+                                                                        function_tokens, budget_tokens)
+            conversation = list(messages)
 
             common_args = {
                 'model': self.config['model'],
-                'messages': self.conversations[chat_id],
+                'messages': conversation,
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
-                'max_tokens': self.config['max_tokens'],
+                'max_tokens': max_tokens,
                 'presence_penalty': self.config['presence_penalty'],
                 'frequency_penalty': self.config['frequency_penalty'],
                 'stream': stream
             }
 
-            if self.config['enable_functions']:
-                functions = self.plugin_manager.get_functions_specs()
-                if len(functions) > 0:
-                    common_args['functions'] = self.plugin_manager.get_functions_specs()
-                    common_args['function_call'] = 'auto'
+            if len(functions) > 0:
+                common_args['functions'] = functions
+                common_args['function_call'] = 'auto'
 
-            return await openai.ChatCompletion.acreate(**common_args)
+            with tracing.span('openai.request', model=self.config['model'], stream=stream):
+                return await self.__chat_completion(**common_args), conversation
 
-        except openai.error.RateLimitError as e:
+        except (openai.error.RateLimitError, BudgetExceededError) as e:
             raise e
 
         except openai.error.InvalidRequestError as e:
@@ -256,7 +412,29 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
-    async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
+    async def __prepare_request(self, chat_id, query: str, conversation: list, function_tokens: int,
+                                budget_tokens: int | None) -> tuple[list, int]:
+        """
+        Fits the conversation to the context window, stores it and plans the request. The conversation lock
+        must be held.
+        :param chat_id: The chat ID
+        :param query: The query of the user, the last message of the conversation
+        :param conversation: The conversation history
+        :param function_tokens: The number of tokens of the function specs of the request
+        :param budget_tokens: Number of tokens the user can still afford, or None if unlimited
+        :return: The messages of the request and its max_tokens
+        """
+        conversation = self.__fit_to_window(conversation, function_tokens)
+        # The past turns recalled from the memory are only added to this request, not to the history
+        messages = self.__recall(chat_id, query, conversation, function_tokens) \
+            if self.memory_index is not None else conversation
+        max_tokens = self.__plan_max_tokens(messages, function_tokens, budget_tokens)
+        await self.__save_history(chat_id, conversation)
+        return messages, max_tokens
+
+    @tracing.traced('openai.function_call')
+    async def __handle_function_call(self, chat_id, conversation, response, stream=False, times=0, plugins_used=(),
+                                     budget_tokens: int | None = None):
         function_name = ''
         arguments = ''
         if stream:
@@ -289,36 +467,62 @@ class OpenAIHelper:
                 return response, plugins_used
 
         logging.info(f'Calling function {function_name} with arguments {arguments}')
+        self.plugin_manager.record_function_use(chat_id, function_name)
         function_response = await self.plugin_manager.call_function(function_name, arguments)
 
         if function_name not in plugins_used:
             plugins_used += (function_name,)
 
         if is_direct_result(function_response):
-            self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name,
-                                                content=json.dumps({'result': 'Done, the content has been sent'
-                                                                              'to the user.'}))
+            result = json.dumps({'result': 'Done, the content has been sent to the user.'})
+            conversation.append(ChatMessage("function", result, name=function_name))
             return function_response, plugins_used
 
-        self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
-        response = await openai.ChatCompletion.acreate(
-            model=self.config['model'],
-            messages=self.conversations[chat_id],
-            functions=self.plugin_manager.get_functions_specs(),
-            function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
-            stream=stream
-        )
-        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
+        conversation.append(ChatMessage("function", function_response, name=function_name))
+        query = next((message['content'] for message in reversed(conversation) if message['role'] == 'user'), '')
+        functions, function_tokens = self.__get_functions(chat_id, query)
+        with tracing.span('openai.request', model=self.config['model'], stream=stream):
+            response = await self.__chat_completion(
+                model=self.config['model'],
+                messages=conversation,
+                functions=functions,
+                function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
+                # Each round is a request of its own, sized to the budget of the user before it is sent
+                max_tokens=self.__plan_max_tokens(conversation, function_tokens, budget_tokens),
+                stream=stream
+            )
+        return await self.__handle_function_call(chat_id, conversation, response, stream, times + 1, plugins_used,
+                                                 budget_tokens=budget_tokens)
+
+    async def __chat_completion(self, **kwargs):
+        """
+        Sends a chat completion request, sharing the upstream call with identical requests in flight
+        if request coalescing is enabled. Transient errors are retried as per the retry policy.
+        :return: The response, or the stream of the response
+        """
+        kwargs['messages'] = to_dicts(kwargs['messages'])
+        call = functools.partial(self.retry_policy.call, 'chat', openai.ChatCompletion.acreate)
+        if self.coalescer is None:
+            return await call(**kwargs)
+        return await self.coalescer.request(kwargs, call)
 
-    async def generate_image(self, prompt: str) -> tuple[str, str]:
+    async def generate_image(self, prompt: str) -> tuple[str, str, bool]:
         """
         Generates an image from the given prompt using DALL·E model.
         :param prompt: The prompt to send to the model
-        :return: The image URL and the image size
+        :return: The image URL, the image size and whether the image was served from the response cache
         """
         bot_language = self.config['bot_language']
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.key('image', self.config['image_size'], normalise_query(prompt))
+            image_url = await self.response_cache.get(cache_key)
+            if image_url is not None:
+                return image_url, self.config['image_size'], True
         try:
-            response = await openai.Image.acreate(
+            response = await self.retry_policy.call(
+                'image',
+                openai.Image.acreate,
                 prompt=prompt,
                 n=1,
                 size=self.config['image_size']
@@ -331,7 +535,9 @@ class OpenAIHelper:
                     f"⚠️\n{localized_text('try_again', bot_language)}."
                 )
 
-            return response['data'][0]['url'], self.config['image_size']
+            if cache_key is not None:
+                await self.response_cache.set(cache_key, response['data'][0]['url'], ttl=IMAGE_URL_TTL)
+            return response['data'][0]['url'], self.config['image_size'], False
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
@@ -339,50 +545,126 @@ class OpenAIHelper:
         """
         Transcribes the audio file using the Whisper model.
         """
-        try:
+        async def _transcribe():
+            # The file is read again by every attempt
             with open(filename, "rb") as audio:
-                prompt_text = self.config['whisper_prompt']
-                result = await openai.Audio.atranscribe("whisper-1", audio, prompt=prompt_text)
-                return result.text
+                return await openai.Audio.atranscribe("whisper-1", audio, prompt=self.config['whisper_prompt'])
+
+        try:
+            result = await self.retry_policy.call('transcription', _transcribe)
+            return result.text
         except Exception as e:
             logging.exception(e)
             raise Exception(f"⚠️ _{localized_text('error', self.config['bot_language'])}._ ⚠️\n{str(e)}") from e
 
-    def reset_chat_history(self, chat_id, content=''):
+    async def reset_chat_history(self, chat_id, content='', forget_memory=False) -> list:
         """
         Resets the conversation history.
+        :param forget_memory: Whether to also forget the past turns of the chat kept in the long-term memory
+        :return: The new conversation history
+        """
+        conversation = self.__new_history(content)
+        async with self.state.lock('conversations', chat_id):
+            await self.__save_history(chat_id, conversation)
+        if forget_memory and self.memory_index is not None:
+            self.memory_index.delete(chat_id)
+        return conversation
+
+    def __new_history(self, content='') -> list:
+        """
+        Creates a conversation history containing only the system prompt.
+        :param content: The system prompt, the assistant prompt if empty
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "system", "content": content}]
+        return [ChatMessage("system", content)]
 
-    def __max_age_reached(self, chat_id) -> bool:
+    async def __response_cache_key(self, chat_id, query) -> str | None:
         """
-        Checks if the maximum conversation age has been reached.
+        Builds the response cache key of a query, if the answer does not depend on the conversation.
         :param chat_id: The chat ID
+        :param query: The query
+        :return: The key, or None if the response cache is disabled or the conversation has context
+        """
+        if self.response_cache is None:
+            return None
+        conversation = await self.__load_history(chat_id)
+        if conversation is None or self.__max_age_reached(await self.state.get('last_updated', chat_id)):
+            system_prompt = self.config['assistant_prompt']
+        elif len(conversation) == 1:
+            system_prompt = conversation[0]['content']
+        else:
+            return None
+        # Answers are only shared between close temperatures
+        temperature_bucket = round(self.config['temperature'] * 4) / 4
+        return ResponseCache.key('chat', self.config['model'], system_prompt, normalise_query(query),
+                                 temperature_bucket, self.config['n_choices'])
+
+    async def __get_cached_response(self, chat_id, query, cache_key) -> str | None:
+        """
+        Gets a cached answer and adds it to the conversation history as if the model had answered.
+        :param chat_id: The chat ID
+        :param query: The query
+        :param cache_key: The response cache key of the query
+        :return: The cached answer, or None
+        """
+        answer = await self.response_cache.get(cache_key)
+        if answer is None:
+            return None
+        async with self.state.lock('conversations', chat_id):
+            conversation = await self.__load_history(chat_id)
+            if conversation is None or self.__max_age_reached(await self.state.get('last_updated', chat_id)):
+                conversation = self.__new_history()
+            await self.state.set('last_updated', chat_id, time.time(), ttl=self.__state_ttl())
+            await self.__save_history(chat_id, conversation + [ChatMessage("user", query),
+                                                               ChatMessage("assistant", answer)])
+        return answer
+
+    def __max_age_seconds(self) -> float:
+        return self.config['max_conversation_age_minutes'] * 60
+
+    def __state_ttl(self) -> float:
+        # Expired conversations are reset when they are used again, the backend can drop them a while after that
+        return self.__max_age_seconds() * 2
+
+    def __max_age_reached(self, last_updated: float | None) -> bool:
+        """
+        Checks if the maximum conversation age has been reached.
+        :param last_updated: The timestamp of the last update of the conversation
         :return: A boolean indicating whether the maximum conversation age has been reached
         """
-        if chat_id not in self.last_updated:
+        if last_updated is None:
             return False
-        last_updated = self.last_updated[chat_id]
-        now = datetime.datetime.now()
-        max_age_minutes = self.config['max_conversation_age_minutes']
-        return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
+        return last_updated < time.time() - self.__max_age_seconds()
+
+    async def __save_history(self, chat_id, conversation: list):
+        """
+        Stores the conversation history. The conversation lock must be held.
+        :param chat_id: The chat ID
+        :param conversation: The conversation history
+        """
+        await self.state.set('conversations', chat_id, conversation, ttl=self.__state_ttl())
 
-    def __add_function_call_to_history(self, chat_id, function_name, content):
+    async def __load_history(self, chat_id) -> list[ChatMessage] | None:
         """
-        Adds a function call to the conversation history
+        Gets the stored conversation history, as records also if the backend stores them as dicts.
+        :param chat_id: The chat ID
+        :return: The conversation history, or None if there is none
         """
-        self.conversations[chat_id].append({"role": "function", "name": function_name, "content": content})
+        conversation = await self.state.get('conversations', chat_id)
+        return from_dicts(conversation) if conversation is not None else None
 
-    def __add_to_history(self, chat_id, role, content):
+    async def __add_to_history(self, chat_id, messages: list):
         """
-        Adds a message to the conversation history.
+        Adds messages to the stored conversation history, keeping the messages added by concurrent requests.
         :param chat_id: The chat ID
-        :param role: The role of the message sender
-        :param content: The message content
+        :param messages: The messages to add, e.g. the function calls and the answer of a request
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        async with self.state.lock('conversations', chat_id):
+            conversation = await self.__load_history(chat_id)
+            if conversation is None:
+                conversation = self.__new_history()
+            await self.__save_history(chat_id, conversation + messages)
 
     async def __summarise(self, conversation) -> str:
         """
@@ -394,7 +676,9 @@ class OpenAIHelper:
             {"role": "assistant", "content": "Summarize this conversation in 700 characters or less"},
             {"role": "user", "content": str(conversation)}
         ]
-        response = await openai.ChatCompletion.acreate(
+        response = await self.retry_policy.call(
+            'summary',
+            openai.ChatCompletion.acreate,
             model=self.config['model'],
             messages=messages,
             temperature=0.4
@@ -415,6 +699,135 @@ class OpenAIHelper:
             f"Max tokens for model {self.config['model']} is not implemented yet."
         )
 
+    def __move_to_memory(self, chat_id, conversation: list) -> list:
+        """
+        Moves the oldest turns of a conversation that is too long to the long-term memory,
+        keeping the system prompt and the most recent half of the history.
+        :return: The conversation without the moved turns
+        """
+        start = min(len(conversation) - 1, max(1, len(conversation) - self.config['max_history_size'] // 2))
+        # Keep whole turns, starting with a user message
+        while conversation[start]['role'] != 'user':
+            start += 1
+        logging.info(f'Chat history for chat ID {chat_id} is too long. Moving {start - 1} messages to memory...')
+        self.memory_index.add(chat_id, conversation[1:start])
+        return conversation[:1] + conversation[start:]
+
+    def __recall(self, chat_id, query: str, conversation: list, function_tokens: int) -> list:
+        """
+        Adds the past turns of the chat most relevant to the query, found in the long-term memory,
+        after the system prompt of a request, within MEMORY_INDEX_MAX_TOKENS and the context window.
+        :return: The messages of the request
+        """
+        turns = self.memory_index.search(chat_id, query, self.config['memory_index_max_results'])
+        if len(turns) == 0:
+            return conversation
+        available = self.__max_model_tokens() - self.__count_tokens(conversation) - function_tokens \
+            - self.__min_completion_tokens()
+        budget = min(self.config['memory_index_max_tokens'], available)
+        content = 'Earlier messages of this conversation that may be relevant:'
+        recalled = 0
+        for turn in turns:
+            text = content + '\n\n' + '\n'.join(f"{message['role']}: {message['content']}" for message in turn)
+            if self.__count_tokens([{'role': 'system', 'content': text}]) > budget:
+                break
+            content = text
+            recalled += 1
+        if recalled == 0:
+            return conversation
+        metrics.MEMORY_INDEX_RECALLS.inc(recalled)
+        return conversation[:1] + [{'role': 'system', 'content': content}] + conversation[1:]
+
+    def __min_completion_tokens(self) -> int:
+        return min(self.config['max_tokens'], MIN_COMPLETION_TOKENS)
+
+    def __fit_to_window(self, conversation: list, function_tokens: int) -> list:
+        """
+        Drops the oldest messages after the system prompt until the prompt leaves room for an answer
+        in the context window of the model.
+        """
+        window = self.__max_model_tokens() - self.__min_completion_tokens() - function_tokens
+        if self.__count_tokens(conversation) <= window:
+            return conversation
+        return pack_history(conversation, window, self.__count_message_tokens)
+
+    def __pack_history(self, conversation: list, function_tokens: int) -> list:
+        """
+        Keeps the most recent messages of a conversation that is too long, within MAX_HISTORY_SIZE
+        and the context window of the model minus the room of a full answer.
+        """
+        window = self.__max_model_tokens() - self.config['max_tokens'] - function_tokens
+        return pack_history(conversation, window, self.__count_message_tokens,
+                            max_messages=self.config['max_history_size'])
+
+    def __plan_max_tokens(self, conversation: list, function_tokens: int, budget_tokens: int | None = None) -> int:
+        """
+        Sizes the answer of a request to what is left of the context window of the model and of the budget
+        of the user, before sending it.
+        :param conversation: The messages of the request
+        :param function_tokens: The number of tokens of the function specs of the request
+        :param budget_tokens: Number of tokens the user can still afford, or None if unlimited
+        :return: The max_tokens of the request
+        """
+        prompt_tokens = self.__count_tokens(conversation) + function_tokens
+        available = self.__max_model_tokens() - prompt_tokens
+        if available <= 0:
+            raise ValueError(f'The prompt ({prompt_tokens} tokens) does not fit in the context window of the model')
+        max_tokens = min(self.config['max_tokens'], available)
+
+        if budget_tokens is not None:
+            # Every choice may be as long as max_tokens
+            affordable = (budget_tokens - prompt_tokens) // self.config['n_choices']
+            if affordable < self.__min_completion_tokens():
+                metrics.BUDGET_REJECTIONS.labels(self.config['model']).inc()
+                raise BudgetExceededError(localized_text('budget_insufficient', self.config['bot_language']))
+            max_tokens = min(max_tokens, affordable)
+        return max_tokens
+
+    def __get_functions(self, chat_id, query: str) -> tuple[list, int]:
+        """
+        Gets the function specs to attach to a request, and counts their tokens.
+        :param chat_id: The chat ID
+        :param query: The query of the user the specs are selected for
+        :return: The function specs and their number of tokens
+        """
+        functions = self.plugin_manager.get_functions_specs(query=query, chat_id=chat_id)
+        function_tokens = self.__count_function_tokens(functions)
+        all_functions = self.plugin_manager.get_functions_specs()
+        if len(functions) < len(all_functions):
+            saved_tokens = self.__count_function_tokens(all_functions) - function_tokens
+            metrics.FUNCTION_SPEC_TOKENS_SAVED.labels(self.config['model']).inc(saved_tokens)
+            logging.debug(f'Attached {len(functions)} of {len(all_functions)} function specs, '
+                          f'saving {saved_tokens} tokens')
+        return functions, function_tokens
+
+    def __count_function_tokens(self, functions: list) -> int:
+        """
+        Counts the number of tokens the function specs add to a request. The count of each spec is cached.
+        :param functions: The function specs
+        :return: The number of tokens
+        """
+        if len(functions) == 0:
+            return 0
+        num_tokens = FUNCTIONS_OVERHEAD_TOKENS
+        for function in functions:
+            spec = json.dumps(function, sort_keys=True)
+            if spec not in self.__function_tokens:
+                self.__function_tokens[spec] = len(self.__get_encoding().encode(spec))
+            num_tokens += self.__function_tokens[spec]
+        return num_tokens
+
+    def __get_encoding(self):
+        """
+        Returns the tokenizer of the model, loaded once.
+        """
+        if self.__encoding is None:
+            try:
+                self.__encoding = tiktoken.encoding_for_model(self.config['model'])
+            except KeyError:
+                self.__encoding = tiktoken.get_encoding("cl100k_base")
+        return self.__encoding
+
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
     def __count_tokens(self, messages) -> int:
         """
@@ -422,11 +835,22 @@ class OpenAIHelper:
         :param messages: the messages to send
         :return: the number of tokens required
         """
+        num_tokens = sum(self.__count_message_tokens(message) for message in messages)
+        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        return num_tokens
+
+    def __count_message_tokens(self, message: dict) -> int:
+        """
+        Counts the number of tokens of a message. The count is cached in the message record, as
+        the whole history is counted again for every request.
+        :param message: the message
+        :return: the number of tokens
+        """
+        if isinstance(message, ChatMessage) and message.tokens is not None:
+            return message.tokens
+
         model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("gpt-3.5-turbo")
+        encoding = self.__get_encoding()
 
         if model in GPT_3_MODELS + GPT_3_16K_MODELS:
             tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
@@ -436,12 +860,11 @@ class OpenAIHelper:
             tokens_per_name = 1
         else:
             raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":
-                    num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += tokens_per_name
+        if isinstance(message, ChatMessage):
+            message.tokens = num_tokens
         return num_tokens
@@ -1,5 +1,11 @@
+from __future__ import annotations
+
 import json
+import time
 
+import metrics
+import tracing
+from function_index import FunctionSpecIndex
 from plugins.gtts_text_to_speech import GTTSTextToSpeech
 from plugins.dice import DicePlugin
 from plugins.youtube_audio_extractor import YouTubeAudioExtractorPlugin
@@ -40,12 +46,31 @@ class PluginManager:
             'webshot': WebshotPlugin,
         }
         self.plugins = [plugin_mapping[plugin]() for plugin in enabled_plugins if plugin in plugin_mapping]
+        self.max_specs = config.get('functions_max_specs', 0)
+        self.index = FunctionSpecIndex(self.get_functions_specs())
 
-    def get_functions_specs(self):
+    def get_functions_specs(self, query: str | None = None, chat_id=None):
         """
         Return the list of function specs that can be called by the model
+        :param query: The query of the user. If given and FUNCTIONS_MAX_SPECS is set, only the specs
+                      most relevant to it are returned, or all of them if none is relevant
+        :param chat_id: The chat ID, to favour the functions recently used in the chat
+        """
+        specs = [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
+        if query is None or self.max_specs <= 0 or len(specs) <= self.max_specs:
+            return specs
+        selected = self.index.select(query, chat_id, self.max_specs)
+        if selected is None:
+            metrics.FUNCTION_SPEC_SELECTIONS.labels('fallback').inc()
+            return specs
+        metrics.FUNCTION_SPEC_SELECTIONS.labels('selected').inc()
+        return [spec for spec in specs if spec['name'] in selected]
+
+    def record_function_use(self, chat_id, function_name):
+        """
+        Remembers that a function was called in a chat, to select its spec again for the next queries
         """
-        return [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
+        self.index.record_use(chat_id, function_name)
 
     async def call_function(self, function_name, arguments):
         """
@@ -54,7 +79,18 @@ class PluginManager:
         plugin = self.__get_plugin_by_function_name(function_name)
         if not plugin:
             return json.dumps({'error': f'Function {function_name} not found'})
-        return json.dumps(await plugin.execute(function_name, **json.loads(arguments)), default=str)
+        start = time.perf_counter()
+        try:
+            with tracing.span('plugin.call', function=function_name):
+                result = await plugin.execute(function_name, **json.loads(arguments))
+        except Exception:
+            metrics.PLUGIN_CALL_ERRORS.labels(function_name).inc()
+            raise
+        finally:
+            metrics.PLUGIN_CALL_SECONDS.labels(function_name).observe(time.perf_counter() - start)
+        if isinstance(result, dict) and 'error' in result:
+            metrics.PLUGIN_CALL_ERRORS.labels(function_name).inc()
+        return json.dumps(result, default=str)
 
     def get_plugin_source_name(self, function_name) -> str:
         """
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+
+import metrics
+from state_backend import StateBackend
+
+
+def normalise_query(query: str) -> str:
+    """
+    Normalises a query so that prompts differing only in case, whitespace or final punctuation share an answer.
+    :param query: The query
+    :return: The normalised query
+    """
+    return ' '.join(query.casefold().split()).rstrip(' ?!.')
+
+
+class ResponseCache:
+    """
+    Cache of the answers (or image URLs) to identical prompts on stateless paths,
+    stored in the state backend so that all workers share it.
+    """
+
+    def __init__(self, state: StateBackend, ttl: float):
+        """
+        Initializes the cache.
+        :param state: The state backend storing the answers (namespace 'responses')
+        :param ttl: Number of seconds an answer is reused
+        """
+        self.state = state
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        """
+        Ratio of lookups that were answered from the cache
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    @staticmethod
+    def key(kind: str, *parts) -> str:
+        """
+        Builds the key of a prompt.
+        :param kind: The kind of answer, 'chat' or 'image'
+        :param parts: Everything the answer depends on, e.g. the model, system prompt, normalised query
+                      and temperature bucket
+        :return: The key
+        """
+        return f'{kind}:' + hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        """
+        Gets a cached answer and counts the lookup.
+        :param key: The key of the prompt
+        :return: The cached answer, or None
+        """
+        kind = key.split(':', 1)[0]
+        answer = await self.state.get('responses', key)
+        if answer is None:
+            self.misses += 1
+            metrics.RESPONSE_CACHE_LOOKUPS.labels(kind, 'miss').inc()
+            return None
+        self.hits += 1
+        metrics.RESPONSE_CACHE_LOOKUPS.labels(kind, 'hit').inc()
+        logging.info(f'Answered a {kind} prompt from the response cache (hit ratio: {self.hit_ratio:.1%})')
+        return answer
+
+    async def set(self, key: str, answer: str, ttl: float | None = None):
+        """
+        Stores an answer.
+        :param key: The key of the prompt
+        :param answer: The answer
+        :param ttl: Number of seconds the answer is reused, capped by the TTL of the cache
+        """
+        await self.state.set('responses', key, answer, ttl=min(ttl, self.ttl) if ttl is not None else self.ttl)
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import contextlib
+import email.utils
+import logging
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+
+import openai
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception
+
+import metrics
+
+# Deadline of the user request being handled (time.monotonic()), or None
+_deadline: ContextVar = ContextVar('openai_deadline', default=None)
+# A call is not retried if the server asks to wait longer than this many times the longest wait
+MAX_HINT_FACTOR = 3
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Checks if an OpenAI error is worth retrying: rate limits, timeouts, connection errors and server errors.
+    """
+    if isinstance(error, openai.error.RateLimitError):
+        # An exhausted quota does not come back within a few seconds
+        return error.code != 'insufficient_quota'
+    if isinstance(error, (openai.error.Timeout, openai.error.APIConnectionError,
+                          openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    Reads the number of seconds to wait before retrying from the headers of an OpenAI error
+    (Retry-After in seconds or as a date, or retry-after-ms).
+    :return: The number of seconds, or None if the server did not send any hint
+    """
+    headers = {str(name).lower(): value for name, value in (getattr(error, 'headers', None) or {}).items()}
+    try:
+        if 'retry-after-ms' in headers:
+            return max(0.0, float(headers['retry-after-ms']) / 1000)
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Retry policy shared by all OpenAI calls. Transient errors are retried after a decorrelated jitter
+    exponential backoff, or after the delay asked by the server if it is longer. Retries stop after a number
+    of attempts, when the server asks to wait much longer than the longest wait,
+    when the deadline of the user request would be exceeded, or when the retries of the last
+    minute, all calls included, used up the retry budget: while OpenAI is down, every request fails fast
+    instead of all of them retrying at once.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_seconds: float = 1.0, max_seconds: float = 20.0,
+                 budget_per_minute: int = 0, deadline_seconds: float = 60):
+        """
+        Initializes the retry policy.
+        :param max_attempts: Maximum number of attempts of a call, the first one included
+        :param base_seconds: The shortest wait between two attempts
+        :param max_seconds: The longest wait between two attempts, unless the server asks for a longer one.
+                            A call is not retried if the server asks to wait more than MAX_HINT_FACTOR times longer
+        :param budget_per_minute: Maximum number of retries in a minute, all calls included, 0 for no limit
+        :param deadline_seconds: Time after which the calls of a user request are no longer retried,
+                                 0 for no deadline
+        """
+        self.max_attempts = max_attempts
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.budget_per_minute = budget_per_minute
+        self.deadline_seconds = deadline_seconds
+        self.retries: deque[float] = deque()  # Times of the retries of the last minute
+
+    @contextlib.contextmanager
+    def deadline(self):
+        """
+        Starts the deadline of a user request: the calls made in the context share it.
+        Does nothing if a deadline was already started, e.g. by the caller.
+        """
+        if self.deadline_seconds <= 0 or _deadline.get() is not None:
+            yield
+            return
+        token = _deadline.set(time.monotonic() + self.deadline_seconds)
+        try:
+            yield
+        finally:
+            _deadline.reset(token)
+
+    async def call(self, operation: str, function, *args, **kwargs):
+        """
+        Calls an OpenAI function, retrying it on transient errors.
+        A call made outside of a user request gets a deadline of its own.
+        :param operation: The name of the call, for the logs and metrics (e.g. 'chat', 'image')
+        :param function: The coroutine function to call
+        :return: The result of the function
+        """
+        deadline = _deadline.get()
+        if deadline is None and self.deadline_seconds > 0:
+            deadline = time.monotonic() + self.deadline_seconds
+        attempts = _Attempts(self, operation, deadline)
+        retrying = AsyncRetrying(reraise=True, retry=retry_if_exception(is_transient),
+                                 stop=attempts.stop, wait=attempts.wait)
+        return await retrying(function, *args, **kwargs)
+
+    def take_budget(self) -> bool:
+        """
+        Counts a retry in the retry budget.
+        :return: False if the budget of the last minute is used up
+        """
+        if self.budget_per_minute <= 0:
+            return True
+        now = time.monotonic()
+        while len(self.retries) > 0 and self.retries[0] <= now - 60:
+            self.retries.popleft()
+        if len(self.retries) >= self.budget_per_minute:
+            return False
+        self.retries.append(now)
+        return True
+
+
+class _Attempts:
+    """
+    Decides whether, and after how long, a failed call is retried.
+    """
+
+    def __init__(self, policy: RetryPolicy, operation: str, deadline: float | None):
+        self.policy = policy
+        self.operation = operation
+        self.deadline = deadline
+        self.sleep = policy.base_seconds
+
+    def stop(self, retry_state: RetryCallState) -> bool:
+        error = retry_state.outcome.exception()
+        if retry_state.attempt_number >= self.policy.max_attempts:
+            metrics.OPENAI_RETRIES_STOPPED.labels(self.operation, 'attempts').inc()
+            return True
+
+        # Decorrelated jitter: random between the base and three times the previous wait
+        sleep = min(self.policy.max_seconds, random.uniform(self.policy.base_seconds, self.sleep * 3))
+        hint = retry_after(error)
+        if hint is not None and hint > self.policy.max_seconds * MAX_HINT_FACTOR:
+            # Waiting that long would hold the slot of the request, the user is better told to try again
+            metrics.OPENAI_RETRIES_STOPPED.labels(self.operation, 'hint').inc()
+            return True
+        if hint is not None:
+            sleep = max(sleep, hint)
+        if self.deadline is not None and time.monotonic() + sleep >= self.deadline:
+            metrics.OPENAI_RETRIES_STOPPED.labels(self.operation, 'deadline').inc()
+            return True
+        if not self.policy.take_budget():
+            metrics.OPENAI_RETRIES_STOPPED.labels(self.operation, 'budget').inc()
+            return True
+
+        self.sleep = sleep
+        metrics.OPENAI_RETRIES.labels(self.operation, type(error).__name__).inc()
+        logging.warning(f'OpenAI {self.operation} request failed ({type(error).__name__}: {error}), '
+                        f'retrying in {sleep:.1f}s (attempt {retry_state.attempt_number + 1} '
+                        f'of {self.policy.max_attempts})')
+        return False
+
+    def wait(self, _: RetryCallState) -> float:
+        return self.sleep
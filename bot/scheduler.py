@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+
+import metrics
+
+PRIORITY_CLASSES = ('admin', 'user', 'guest')
+
+
+def parse_weights(value: str) -> dict[str, float]:
+    """
+    Parses the weights of the priority classes, e.g. 'admin:4,user:2,guest:1'.
+    :param value: The weights, classes that are not listed get a weight of 1
+    :return: The weight of each class
+    """
+    weights = {priority: 1.0 for priority in PRIORITY_CLASSES}
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        priority, _, weight = item.partition(':')
+        if priority not in PRIORITY_CLASSES or float(weight) <= 0:
+            raise ValueError(f"Invalid scheduler weight '{item}', expected <class>:<weight> with a class in "
+                             f"{', '.join(PRIORITY_CLASSES)} and a positive weight")
+        weights[priority] = float(weight)
+    return weights
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a request is refused because too many requests are already queued or in flight.
+    """
+
+
+class _Request:
+    """
+    A request waiting for a slot.
+    """
+    __slots__ = ('user_id', 'chat_id', 'priority', 'start', 'finish', 'future', 'enqueued_at')
+
+    def __init__(self, user_id, chat_id, priority: str, start: float, finish: float):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.priority = priority
+        self.start = start
+        self.finish = finish
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+
+class FairScheduler:
+    """
+    Schedules the OpenAI work of the users (chat answers, transcriptions, images) so that one user or one busy
+    chat cannot take every slot: the number of requests in flight is capped globally, per user and per chat,
+    and the waiting requests get the free slots by weighted fair queuing between the users.
+    Every user gets a share of the slots proportional to the weight of their priority class, whatever
+    the number of requests they send.
+    Past a bound on the requests queued and in flight, new requests are refused at once instead of piling up
+    while OpenAI is slow.
+    """
+
+    def __init__(self, max_concurrency: int = 0, max_per_user: int = 0, max_per_chat: int = 0,
+                 weights: dict[str, float] | None = None, max_pending: int = 0):
+        """
+        Initializes the scheduler.
+        :param max_concurrency: Maximum number of requests in flight, 0 for no limit
+        :param max_per_user: Maximum number of requests in flight per user, 0 for no limit
+        :param max_per_chat: Maximum number of requests in flight per chat, 0 for no limit
+        :param weights: The weight of each priority class, 1 for the classes that are not listed
+        :param max_pending: Maximum number of requests queued or in flight, the next ones raise an OverloadedError.
+                            0 for no limit
+        """
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.max_per_chat = max_per_chat
+        self.weights = weights or {}
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self.user_in_flight: dict[object, int] = {}
+        self.chat_in_flight: dict[object, int] = {}
+        self.waiting: list[_Request] = []
+        # Virtual time of the fair queue, and the virtual finish time of the last request of each user
+        self.virtual_time = 0.0
+        self.user_finish: dict[object, float] = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, chat_id, priority: str = 'user'):
+        """
+        Waits for a slot and holds it while the context is active.
+        :param user_id: The user ID
+        :param chat_id: The chat ID
+        :param priority: The priority class of the user, one of PRIORITY_CLASSES
+        :raises OverloadedError: If too many requests are already queued or in flight
+        """
+        await self.__acquire(user_id, chat_id, priority)
+        try:
+            yield
+        finally:
+            self.__release(user_id, chat_id, priority)
+
+    def __can_run(self, user_id, chat_id) -> bool:
+        return (self.max_concurrency <= 0 or self.in_flight < self.max_concurrency) \
+            and (self.max_per_user <= 0 or self.user_in_flight.get(user_id, 0) < self.max_per_user) \
+            and (self.max_per_chat <= 0 or self.chat_in_flight.get(chat_id, 0) < self.max_per_chat)
+
+    async def __acquire(self, user_id, chat_id, priority: str):
+        if 0 < self.max_pending <= self.in_flight + len(self.waiting):
+            metrics.SCHEDULER_SHED_REQUESTS.labels(priority).inc()
+            raise OverloadedError(f'{self.in_flight} requests in flight and {len(self.waiting)} queued')
+
+        # A user whose previous requests are done starts at the current virtual time,
+        # a user with requests queued is served after them
+        start = max(self.virtual_time, self.user_finish.get(user_id, 0.0))
+        finish = start + 1 / self.weights.get(priority, 1.0)
+        self.user_finish[user_id] = finish
+
+        if len(self.waiting) == 0 and self.__can_run(user_id, chat_id):
+            self.virtual_time = start
+            self.__start(user_id, chat_id, priority)
+            metrics.SCHEDULER_WAIT_SECONDS.labels(priority).observe(0)
+            return
+
+        request = _Request(user_id, chat_id, priority, start, finish)
+        self.waiting.append(request)
+        metrics.SCHEDULER_QUEUE_DEPTH.labels(priority).inc()
+        # Another request may be able to run, e.g. if this one is only blocked by its user cap
+        self.__dispatch()
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled():
+                # The slot was given to the request just before it was cancelled
+                self.__release(user_id, chat_id, priority)
+            else:
+                # __dispatch may have dropped the request already, if it ran after the cancellation
+                if request in self.waiting:
+                    self.waiting.remove(request)
+                    metrics.SCHEDULER_QUEUE_DEPTH.labels(priority).dec()
+                self.__forget_user(user_id)
+            raise
+        metrics.SCHEDULER_WAIT_SECONDS.labels(priority).observe(time.perf_counter() - request.enqueued_at)
+
+    def __start(self, user_id, chat_id, priority: str):
+        self.in_flight += 1
+        self.user_in_flight[user_id] = self.user_in_flight.get(user_id, 0) + 1
+        self.chat_in_flight[chat_id] = self.chat_in_flight.get(chat_id, 0) + 1
+        metrics.SCHEDULER_IN_FLIGHT.labels(priority).inc()
+
+    def __release(self, user_id, chat_id, priority: str):
+        self.in_flight -= 1
+        self.user_in_flight[user_id] -= 1
+        if self.user_in_flight[user_id] == 0:
+            del self.user_in_flight[user_id]
+        self.chat_in_flight[chat_id] -= 1
+        if self.chat_in_flight[chat_id] == 0:
+            del self.chat_in_flight[chat_id]
+        metrics.SCHEDULER_IN_FLIGHT.labels(priority).dec()
+        self.__forget_user(user_id)
+        self.__dispatch()
+
+    def __forget_user(self, user_id):
+        # Keeps the virtual finish times of the active users only
+        if user_id not in self.user_in_flight and all(request.user_id != user_id for request in self.waiting):
+            self.user_finish.pop(user_id, None)
+
+    def __dispatch(self):
+        """
+        Gives the free slots to the waiting requests that can run, the smallest virtual finish time first.
+        """
+        while len(self.waiting) > 0:
+            # A request cancelled in the same loop iteration is still queued, its slot would be lost
+            for request in [request for request in self.waiting if request.future.done()]:
+                self.waiting.remove(request)
+                metrics.SCHEDULER_QUEUE_DEPTH.labels(request.priority).dec()
+            runnable = [request for request in self.waiting if self.__can_run(request.user_id, request.chat_id)]
+            if len(runnable) == 0:
+                return
+            request = min(runnable, key=lambda r: r.finish)
+            self.waiting.remove(request)
+            metrics.SCHEDULER_QUEUE_DEPTH.labels(request.priority).dec()
+            self.virtual_time = max(self.virtual_time, request.start)
+            self.__start(request.user_id, request.chat_id, request.priority)
+            request.future.set_result(None)
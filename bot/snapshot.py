@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+
+import metrics
+from chat_message import ChatMessage
+from state_backend import InMemoryStateBackend
+
+SNAPSHOT_VERSION = 2
+HEADER_SIZE = 64  # The header line is written last, over the space kept for it at the start of the file
+
+
+def _to_json(value):
+    if isinstance(value, ChatMessage):
+        # The token count is kept, so that the history does not have to be counted again after a restart
+        return {**value.to_dict(), 'tokens': value.tokens}
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def _without_tokens(value: dict) -> dict:
+    value.pop('tokens', None)
+    return value
+
+
+class Snapshot:
+    """
+    Snapshot of the in-memory state (conversations, last updates, cached answers, inline queries...)
+    so that a restart does not lose it.
+    The file starts with a header pointing to the index of the entries, which follows the JSON line of every entry.
+    On startup, only the index is read: an entry is read when its key is first used, so a restart takes milliseconds
+    and the state is only loaded for the chats that come back.
+    """
+
+    def __init__(self, path: str, tag: str = '', interval_minutes: float = 0):
+        """
+        Initializes the snapshot.
+        :param path: The path of the snapshot file
+        :param tag: The model whose token counts are stored. They are dropped if the snapshot was written for
+                    another model
+        :param interval_minutes: Number of minutes between checkpoints, 0 to only write the snapshot on shutdown
+        """
+        self.path = path
+        self.tag = tag
+        self.interval_minutes = interval_minutes
+        self.pending: dict[tuple[str, object], tuple[int, int, float | None]] = {}  # {(namespace, key): entry}
+        self.file = None
+        self.object_hook = None
+
+    def open(self):
+        """
+        Reads the index of the snapshot file, if there is one.
+        """
+        if not os.path.isfile(self.path):
+            return
+        start = time.perf_counter()
+        try:
+            file = open(self.path, 'rb')
+            header = json.loads(file.readline())
+            if header.get('version') != SNAPSHOT_VERSION:
+                logging.warning(f'Ignoring snapshot {self.path} written by another version of the bot')
+                file.close()
+                return
+            file.seek(header['index'])
+            index = json.loads(file.readline())
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f'Ignoring unreadable snapshot {self.path}: {e}')
+            return
+        now = time.time()
+        for namespace, key, offset, length, expiry in index['entries']:
+            if expiry is None or expiry > now:
+                self.pending[(namespace, key)] = (offset, length, expiry)
+        self.file = file
+        self.object_hook = None if index.get('tag') == self.tag else _without_tokens
+        logging.info(f'Opened snapshot {self.path} with {len(self.pending)} entries '
+                     f'in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    def attach(self, backend: InMemoryStateBackend):
+        """
+        Opens the snapshot and makes the backend read the entries it does not have from it.
+        :param backend: The in-memory state backend
+        """
+        self.open()
+        backend.fallback = self
+
+    def load(self, namespace: str, key) -> tuple[object, float | None] | None:
+        """
+        Reads an entry of the snapshot, once: later changes are made in the backend.
+        :param namespace: The namespace of the entry
+        :param key: The key of the entry
+        :return: The value and its remaining time to live, or None if the snapshot has no such entry
+        """
+        entry = self.pending.pop((namespace, key), None)
+        if entry is None:
+            return None
+        offset, length, expiry = entry
+        ttl = expiry - time.time() if expiry is not None else None
+        if ttl is not None and ttl <= 0:
+            return None
+        self.file.seek(offset)
+        record = json.loads(self.file.read(length), object_hook=self.object_hook)
+        metrics.SNAPSHOT_RESTORED_ENTRIES.labels(namespace).inc()
+        return record['value'], ttl
+
+    def discard(self, namespace: str, key):
+        """
+        Forgets an entry of the snapshot, e.g. because the backend got a new value.
+        :param namespace: The namespace of the entry
+        :param key: The key of the entry
+        """
+        self.pending.pop((namespace, key), None)
+
+    def write(self, backend: InMemoryStateBackend):
+        """
+        Writes the state of the backend, and the entries of the previous snapshot that were not used yet,
+        to the snapshot file. The previous file is replaced once the new one is complete.
+        Each entry is written to the file as soon as it is encoded, only the index is kept in memory.
+        :param backend: The in-memory state backend
+        """
+        start = time.perf_counter()
+        now = time.time()
+        entries = []
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(b' ' * (HEADER_SIZE - 1) + b'\n')
+
+            def add(namespace, key, line: bytes, expiry):
+                entries.append([namespace, key, file.tell(), len(line), expiry])
+                file.write(line)
+
+            for namespace, cache in backend.namespaces.items():
+                for key, value, ttl in cache.live_items():
+                    expiry = now + ttl if ttl is not None else None
+                    line = json.dumps({'value': value}, default=_to_json, ensure_ascii=False).encode() + b'\n'
+                    add(namespace, key, line, expiry)
+            for (namespace, key), (entry_offset, length, expiry) in self.pending.items():
+                if expiry is None or expiry > now:
+                    self.file.seek(entry_offset)
+                    line = self.file.read(length)
+                    if self.object_hook is not None:
+                        record = json.loads(line, object_hook=self.object_hook)
+                        line = json.dumps(record, ensure_ascii=False).encode() + b'\n'
+                    add(namespace, key, line, expiry)
+
+            index_offset = file.tell()
+            file.write(json.dumps({'tag': self.tag, 'created': now, 'entries': entries}).encode() + b'\n')
+            header = json.dumps({'version': SNAPSHOT_VERSION, 'index': index_offset}).encode()
+            file.seek(0)
+            file.write(header.ljust(HEADER_SIZE - 1))
+        os.replace(temporary_path, self.path)
+
+        # The entries not used yet are now read from the new file. The others are in the backend,
+        # they must not come back from the snapshot once the backend dropped them
+        pending = set(self.pending)
+        self.close()
+        self.pending = {}
+        if len(pending) > 0:
+            self.open()
+            self.pending = {name: entry for name, entry in self.pending.items() if name in pending}
+        metrics.SNAPSHOT_SECONDS.observe(time.perf_counter() - start)
+        logging.info(f'Wrote snapshot {self.path} with {len(entries)} entries '
+                     f'in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    def close(self):
+        """
+        Closes the snapshot file.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import json
+
+import redis.asyncio as redis
+
+from ttl_cache import BoundedTTLCache
+
+
+def to_json(value):
+    """
+    Converts the values that are not JSON types but have a JSON form, e.g. chat messages, for json.dumps.
+    """
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class StateBackend:
+    """
+    Storage for the state that has to be shared by all bot workers:
+    conversations, usage, last messages and inline queries.
+    Values are stored by namespace and key and must be JSON serialisable, or have a to_dict() method
+    returning their JSON form.
+    """
+
+    async def get(self, namespace: str, key, default=None):
+        """
+        Gets a value.
+        :param namespace: The namespace of the value, e.g. 'conversations'
+        :param key: The key of the value, e.g. a chat ID
+        :param default: The value to return if the key does not exist or has expired
+        :return: The stored value or the default
+        """
+        raise NotImplementedError
+
+    async def set(self, namespace: str, key, value, ttl: float | None = None):
+        """
+        Stores a value.
+        :param namespace: The namespace of the value
+        :param key: The key of the value
+        :param value: The value to store
+        :param ttl: Number of seconds after which the value expires, or None to keep it
+        """
+        raise NotImplementedError
+
+    async def delete(self, namespace: str, key):
+        """
+        Deletes a value if it exists.
+        :param namespace: The namespace of the value
+        :param key: The key of the value
+        """
+        raise NotImplementedError
+
+    async def pop(self, namespace: str, key, default=None):
+        """
+        Deletes a value and returns it, atomically: only one worker gets the value.
+        :param namespace: The namespace of the value
+        :param key: The key of the value
+        :param default: The value to return if the key does not exist or has expired
+        :return: The stored value or the default
+        """
+        raise NotImplementedError
+
+    def lock(self, namespace: str, key):
+        """
+        Returns an asynchronous context manager holding an exclusive lock on a key,
+        to read, modify and store a value without losing the changes of another worker.
+        :param namespace: The namespace of the value
+        :param key: The key of the value
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """
+        Releases the resources of the backend.
+        """
+
+
+class InMemoryStateBackend(StateBackend):
+    """
+    Keeps the state in the process. Only suitable for a single bot process.
+    Values are stored by reference, a value that is changed in place is also changed in the backend.
+    """
+
+    def __init__(self, max_entries: dict[str, int] | None = None):
+        """
+        Initializes the backend.
+        :param max_entries: Maximum number of values per namespace, the least recently used values are dropped
+                            beyond it. Namespaces that are not listed are not limited
+        """
+        self.max_entries = max_entries or {}
+        self.namespaces: dict[str, BoundedTTLCache] = {}
+        self.locks: dict[tuple[str, object], list] = {}  # {(namespace, key): [lock, number of users]}
+        # Source of the values the backend does not have yet, e.g. a snapshot written before a restart,
+        # with load(namespace, key) -> (value, ttl) | None and discard(namespace, key)
+        self.fallback = None
+
+    def namespace(self, namespace: str) -> BoundedTTLCache:
+        """
+        Returns the cache holding the values of a namespace, e.g. to read its eviction stats.
+        :param namespace: The namespace
+        """
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = BoundedTTLCache(namespace, max_size=self.max_entries.get(namespace))
+        return self.namespaces[namespace]
+
+    def __restore(self, namespace: str, key):
+        if self.fallback is None or key in self.namespace(namespace):
+            return
+        restored = self.fallback.load(namespace, key)
+        if restored is not None:
+            value, ttl = restored
+            self.namespace(namespace).set(key, value, ttl=ttl)
+
+    async def get(self, namespace: str, key, default=None):
+        self.__restore(namespace, key)
+        return self.namespace(namespace).get(key, default)
+
+    async def set(self, namespace: str, key, value, ttl: float | None = None):
+        if self.fallback is not None:
+            self.fallback.discard(namespace, key)
+        self.namespace(namespace).set(key, value, ttl=ttl)
+
+    async def delete(self, namespace: str, key):
+        if self.fallback is not None:
+            self.fallback.discard(namespace, key)
+        self.namespace(namespace).pop(key)
+
+    async def pop(self, namespace: str, key, default=None):
+        self.__restore(namespace, key)
+        return self.namespace(namespace).pop(key, default)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, namespace: str, key):
+        name = (namespace, key)
+        entry = self.locks.setdefault(name, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[name]
+
+
+class RedisStateBackend(StateBackend):
+    """
+    Keeps the state in Redis (or any server speaking its protocol), so that several bot processes
+    or replicas can share it. Values are stored as JSON.
+    """
+
+    def __init__(self, url: str, prefix: str = 'chatgpt-telegram-bot', lock_timeout: float = 120):
+        """
+        Initializes the backend.
+        :param url: The Redis URL, e.g. redis://localhost:6379/0
+        :param prefix: The prefix of all keys
+        :param lock_timeout: Number of seconds after which a lock held by a crashed worker is released
+        """
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+
+    def __key(self, namespace: str, key) -> str:
+        return f'{self.prefix}:{namespace}:{key}'
+
+    async def get(self, namespace: str, key, default=None):
+        value = await self.client.get(self.__key(namespace, key))
+        return json.loads(value) if value is not None else default
+
+    async def set(self, namespace: str, key, value, ttl: float | None = None):
+        await self.client.set(self.__key(namespace, key), json.dumps(value, default=to_json),
+                              px=int(ttl * 1000) if ttl is not None else None)
+
+    async def delete(self, namespace: str, key):
+        await self.client.delete(self.__key(namespace, key))
+
+    async def pop(self, namespace: str, key, default=None):
+        async with self.client.pipeline(transaction=True) as pipeline:
+            pipeline.get(self.__key(namespace, key))
+            pipeline.delete(self.__key(namespace, key))
+            value, _ = await pipeline.execute()
+        return json.loads(value) if value is not None else default
+
+    def lock(self, namespace: str, key):
+        return self.client.lock(f'{self.prefix}:lock:{namespace}:{key}', timeout=self.lock_timeout)
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_state_backend(config: dict) -> StateBackend:
+    """
+    Creates the state backend.
+    :param config: A dictionary containing the state configuration
+    :return: The state backend
+    """
+    if config['backend'] == 'memory':
+        return InMemoryStateBackend(max_entries=config['max_entries'])
+    if config['backend'] == 'redis':
+        if not config['url']:
+            raise ValueError('STATE_BACKEND_URL is required for the redis state backend')
+        return RedisStateBackend(config['url'], prefix=config['key_prefix'])
+    raise ValueError(f"Unknown state backend '{config['backend']}', expected 'memory' or 'redis'")
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
 import logging
 import os
 
@@ -9,16 +10,26 @@ from telegram import BotCommandScopeAllGroupChats, Update, constants
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle
 from telegram import InputTextMessageContent, BotCommand
 from telegram.error import RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
-    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext
+    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext, ChatMemberHandler
 
 from pydub import AudioSegment
 
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
     edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
     get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
-    cleanup_intermediate_files, split_into_chunks_nostream
-from openai_helper import OpenAIHelper, localized_text
+    cleanup_intermediate_files, split_into_chunks_nostream, MarkdownChunker, get_remaining_budget_tokens, \
+    get_priority_class
+import metrics
+import tracing
+from membership_cache import GroupMembershipCache
+from openai_helper import OpenAIHelper, BudgetExceededError, localized_text
+from scheduler import FairScheduler, OverloadedError
+from snapshot import Snapshot
+from state_backend import StateBackend
+from telegram_markdown import prepare_markdown
+from trigger_filter import GroupTriggerFilter
 from usage_tracker import UsageTracker
 
 
@@ -27,20 +38,28 @@ class ChatGPTTelegramBot:
     Class representing a ChatGPT Telegram Bot.
     """
 
-    def __init__(self, config: dict, openai: OpenAIHelper):
+    def __init__(self, config: dict, openai: OpenAIHelper, state: StateBackend | None = None,
+                 snapshot: Snapshot | None = None):
         """
         Initializes the bot with the given configuration and GPT bot object.
         :param config: A dictionary containing the bot configuration
         :param openai: OpenAIHelper object
+        :param state: The backend storing the usage, last messages and inline queries shared by all workers,
+                      the one of the OpenAIHelper if None
+        :param snapshot: The snapshot of the in-memory state, written periodically and on shutdown, or None
         """
         self.config = config
         self.openai = openai
+        self.state = state if state is not None else openai.state
+        self.snapshot = snapshot
+        self.snapshot_task = None
         bot_language = self.config['bot_language']
         self.commands = [
             BotCommand(command='help', description=localized_text('help_description', bot_language)),
             BotCommand(command='reset', description=localized_text('reset_description', bot_language)),
             BotCommand(command='stats', description=localized_text('stats_description', bot_language)),
-            BotCommand(command='resend', description=localized_text('resend_description', bot_language))
+            BotCommand(command='resend', description=localized_text('resend_description', bot_language)),
+            BotCommand(command='cancel', description=localized_text('cancel_description', bot_language))
         ]
         # If imaging is enabled, add the "image" command to the list
         if self.config.get('enable_image_generation', False):
@@ -51,9 +70,19 @@ class ChatGPTTelegramBot:
         )] + self.commands
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
-        self.usage = {}
-        self.last_message = {}
-        self.inline_queries_cache = {}
+        self.busy_message = localized_text('busy', bot_language)
+        self.usage = {}  # Local usage trackers, refreshed from the state backend
+        self.trigger_filter = GroupTriggerFilter(self.config['group_trigger_keyword'])
+        self.membership_cache = GroupMembershipCache(ttl=self.config['membership_cache_ttl'],
+                                                     max_concurrency=self.config['membership_lookup_concurrency'])
+        self.inline_query_timers: dict[int, asyncio.Future] = {}  # {user_id: debounce timer of the last query}
+        self.generations: dict[int, list[tuple[int, asyncio.Event]]] = {}  # {chat_id: [(user_id, cancel event)]}
+        self.metrics_server = None
+        self.scheduler = FairScheduler(max_concurrency=self.config['scheduler_max_concurrency'],
+                                       max_per_user=self.config['scheduler_max_per_user'],
+                                       max_per_chat=self.config['scheduler_max_per_chat'],
+                                       weights=self.config['scheduler_weights'],
+                                       max_pending=self.config['scheduler_max_pending'])
 
     async def help(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -77,7 +106,7 @@ class ChatGPTTelegramBot:
         """
         Returns token usage statistics for current day and month.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, membership_cache=self.membership_cache):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             f'is not allowed to request their usage statistics')
             await self.send_disallowed_message(update, context)
@@ -87,8 +116,7 @@ class ChatGPTTelegramBot:
                      f'requested their usage statistics')
 
         user_id = update.message.from_user.id
-        if user_id not in self.usage:
-            self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+        await self.load_usage(user_id, update.message.from_user.name)
 
         tokens_today, tokens_month = self.usage[user_id].get_current_token_usage()
         images_today, images_month = self.usage[user_id].get_current_image_count()
@@ -97,7 +125,7 @@ class ChatGPTTelegramBot:
         current_cost = self.usage[user_id].get_current_cost()
 
         chat_id = update.effective_chat.id
-        chat_messages, chat_token_length = self.openai.get_conversation_stats(chat_id)
+        chat_messages, chat_token_length = await self.openai.get_conversation_stats(chat_id)
         remaining_budget = get_remaining_budget(self.config, self.usage, update)
         bot_language = self.config['bot_language']
         
@@ -161,14 +189,15 @@ class ChatGPTTelegramBot:
         """
         Resend the last request
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, membership_cache=self.membership_cache):
             logging.warning(f'User {update.message.from_user.name}  (id: {update.message.from_user.id})'
                             f' is not allowed to resend the message')
             await self.send_disallowed_message(update, context)
             return
 
         chat_id = update.effective_chat.id
-        if chat_id not in self.last_message:
+        last_message = await self.state.pop('last_message', chat_id)
+        if last_message is None:
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id})'
                             f' does not have anything to resend')
             await update.effective_message.reply_text(
@@ -177,11 +206,11 @@ class ChatGPTTelegramBot:
             )
             return
 
-        # Update message text, clear self.last_message and send the request to prompt
+        # Update message text and send the request to prompt
         logging.info(f'Resending the last prompt from user: {update.message.from_user.name} '
                      f'(id: {update.message.from_user.id})')
         with update.message._unfrozen() as message:
-            message.text = self.last_message.pop(chat_id)
+            message.text = last_message
 
         await self.prompt(update=update, context=context)
 
@@ -189,7 +218,7 @@ class ChatGPTTelegramBot:
         """
         Resets the conversation.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, membership_cache=self.membership_cache):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             f'is not allowed to reset the conversation')
             await self.send_disallowed_message(update, context)
@@ -199,13 +228,48 @@ class ChatGPTTelegramBot:
                      f'(id: {update.message.from_user.id})...')
 
         chat_id = update.effective_chat.id
+        self.cancel_generations(chat_id, reason='reset')
         reset_content = message_text(update.message)
-        self.openai.reset_chat_history(chat_id=chat_id, content=reset_content)
+        await self.openai.reset_chat_history(chat_id=chat_id, content=reset_content, forget_memory=True)
         await update.effective_message.reply_text(
             message_thread_id=get_thread_id(update),
             text=localized_text('reset_done', self.config['bot_language'])
         )
 
+    async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Stops the answers being generated in the chat.
+        """
+        if not await is_allowed(self.config, update, context, membership_cache=self.membership_cache):
+            logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
+                            f'is not allowed to cancel answers')
+            await self.send_disallowed_message(update, context)
+            return
+
+        cancelled = self.cancel_generations(update.effective_chat.id, reason='command')
+        logging.info(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
+                     f'cancelled {cancelled} answer(s)')
+        await update.effective_message.reply_text(
+            message_thread_id=get_thread_id(update),
+            text=localized_text('cancel_done' if cancelled > 0 else 'cancel_nothing', self.config['bot_language'])
+        )
+
+    def cancel_generations(self, chat_id: int, user_id: int | None = None, reason: str = 'command') -> int:
+        """
+        Stops the answers being streamed in a chat.
+        :param chat_id: The chat ID
+        :param user_id: Only stop the answers to this user, or None to stop all of them
+        :param reason: Why the answers are stopped ('command', 'reset' or 'superseded'), for the metrics
+        :return: The number of answers stopped
+        """
+        cancelled = 0
+        for owner_id, cancel_event in self.generations.get(chat_id, []):
+            if (user_id is None or owner_id == user_id) and not cancel_event.is_set():
+                cancel_event.set()
+                cancelled += 1
+                metrics.GENERATIONS_CANCELLED.labels(reason).inc()
+        return cancelled
+
     async def image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Generates an image for the given prompt using DALL·E APIs
@@ -227,24 +291,37 @@ class ChatGPTTelegramBot:
 
         async def _generate():
             try:
-                image_url, image_size = await self.openai.generate_image(prompt=image_query)
+                async with self.scheduler.slot(update.message.from_user.id, update.effective_chat.id,
+                                               get_priority_class(self.config, update.message.from_user.id)):
+                    image_url, image_size, cached = await self.openai.generate_image(prompt=image_query)
                 await update.effective_message.reply_photo(
                     reply_to_message_id=get_reply_to_message_id(self.config, update),
                     photo=image_url
                 )
-                # add image request to users usage tracker
+                # add image request to users usage tracker, unless it was served from the response cache
                 user_id = update.message.from_user.id
-                self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
-                # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
-                    self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
+                if not cached:
+                    async with self.track_usage(user_id, update.message.from_user.name):
+                        self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
+                        # add guest chat request to guest usage tracker
+                        if str(user_id) not in self.config['allowed_user_ids'].split(',') \
+                                and 'guests' in self.usage:
+                            self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
+
+            except OverloadedError as e:
+                logging.warning(f'Refused image generation request: {e}')
+                await update.effective_message.reply_text(
+                    message_thread_id=get_thread_id(update),
+                    reply_to_message_id=get_reply_to_message_id(self.config, update),
+                    text=self.busy_message
+                )
 
             except Exception as e:
                 logging.exception(e)
                 await update.effective_message.reply_text(
                     message_thread_id=get_thread_id(update),
                     reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    text=f"{localized_text('image_fail', self.config['bot_language'])}: {str(e)}",
+                    text=prepare_markdown(f"{localized_text('image_fail', self.config['bot_language'])}: {str(e)}"),
                     parse_mode=constants.ParseMode.MARKDOWN
                 )
 
@@ -275,7 +352,7 @@ class ChatGPTTelegramBot:
                 await update.effective_message.reply_text(
                     message_thread_id=get_thread_id(update),
                     reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    text=(
+                    text=prepare_markdown(
                         f"{localized_text('media_download_fail', bot_language)[0]}: "
                         f"{str(e)}. {localized_text('media_download_fail', bot_language)[1]}"
                     ),
@@ -284,8 +361,9 @@ class ChatGPTTelegramBot:
                 return
 
             try:
-                audio_track = AudioSegment.from_file(filename)
-                audio_track.export(filename_mp3, format="mp3")
+                with metrics.TRANSCODING_SECONDS.time():
+                    audio_track = AudioSegment.from_file(filename)
+                    audio_track.export(filename_mp3, format="mp3")
                 logging.info(f'New transcribe request received from user {update.message.from_user.name} '
                              f'(id: {update.message.from_user.id})')
 
@@ -301,18 +379,20 @@ class ChatGPTTelegramBot:
                 return
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            priority = get_priority_class(self.config, user_id)
 
             try:
-                transcript = await self.openai.transcribe(filename_mp3)
+                async with self.scheduler.slot(user_id, chat_id, priority):
+                    with metrics.TRANSCRIPTION_SECONDS.time():
+                        transcript = await self.openai.transcribe(filename_mp3)
 
                 transcription_price = self.config['transcription_price']
-                self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
-
                 allowed_user_ids = self.config['allowed_user_ids'].split(',')
-                if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                    self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                async with self.track_usage(user_id, update.message.from_user.name):
+                    self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                    if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+                        self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds,
+                                                                       transcription_price)
 
                 # check if transcript starts with any of the prefixes
                 response_to_transcription = any(transcript.lower().startswith(prefix.lower()) if prefix else False
@@ -328,16 +408,20 @@ class ChatGPTTelegramBot:
                         await update.effective_message.reply_text(
                             message_thread_id=get_thread_id(update),
                             reply_to_message_id=get_reply_to_message_id(self.config, update) if index == 0 else None,
-                            text=transcript_chunk,
+                            text=prepare_markdown(transcript_chunk),
                             parse_mode=constants.ParseMode.MARKDOWN
                         )
                 else:
                     # Get the response of the transcript
-                    response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
+                    budget_tokens = get_remaining_budget_tokens(self.config, self.usage, update)
+                    async with self.scheduler.slot(user_id, chat_id, priority):
+                        response, total_tokens = await self.openai.get_chat_response(
+                            chat_id=chat_id, query=transcript, cacheable=True, budget_tokens=budget_tokens)
 
-                    self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
-                    if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                        self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
+                    async with self.track_usage(user_id, update.message.from_user.name):
+                        self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
+                        if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+                            self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
                     transcript_output = (
@@ -350,16 +434,24 @@ class ChatGPTTelegramBot:
                         await update.effective_message.reply_text(
                             message_thread_id=get_thread_id(update),
                             reply_to_message_id=get_reply_to_message_id(self.config, update) if index == 0 else None,
-                            text=transcript_chunk,
+                            text=prepare_markdown(transcript_chunk),
                             parse_mode=constants.ParseMode.MARKDOWN
                         )
 
+            except OverloadedError as e:
+                logging.warning(f'Refused transcription request: {e}')
+                await update.effective_message.reply_text(
+                    message_thread_id=get_thread_id(update),
+                    reply_to_message_id=get_reply_to_message_id(self.config, update),
+                    text=self.busy_message
+                )
+
             except Exception as e:
                 logging.exception(e)
                 await update.effective_message.reply_text(
                     message_thread_id=get_thread_id(update),
                     reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    text=f"{localized_text('transcribe_fail', bot_language)}: {str(e)}",
+                    text=prepare_markdown(f"{localized_text('transcribe_fail', bot_language)}: {str(e)}"),
                     parse_mode=constants.ParseMode.MARKDOWN
                 )
             finally:
@@ -370,6 +462,7 @@ class ChatGPTTelegramBot:
 
         await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
 
+    @tracing.traced('prompt', root=True)
     async def prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         React to incoming messages and respond accordingly.
@@ -377,16 +470,11 @@ class ChatGPTTelegramBot:
         if update.edited_message or not update.message or update.message.via_bot:
             return
 
-        if not await self.check_allowed_and_within_budget(update, context):
-            return
-
-        logging.info(
-            f'New message received from user {update.message.from_user.name} (id: {update.message.from_user.id})')
         chat_id = update.effective_chat.id
         user_id = update.message.from_user.id
         prompt = message_text(update.message)
-        self.last_message[chat_id] = prompt
 
+        # Check the trigger keyword first, it doesn't require any API call or file access
         if is_group_chat(update):
             trigger_keyword = self.config['group_trigger_keyword']
 
@@ -405,6 +493,16 @@ class ChatGPTTelegramBot:
                     logging.warning('Message does not start with trigger keyword, ignoring...')
                     return
 
+        if not await self.check_allowed_and_within_budget(update, context):
+            return
+
+        logging.info(
+            f'New message received from user {update.message.from_user.name} (id: {update.message.from_user.id})')
+        await self.state.set('last_message', chat_id, message_text(update.message),
+                             ttl=self.config['last_message_ttl'])
+
+        priority = get_priority_class(self.config, user_id)
+        cancel_event = None
         try:
             total_tokens = 0
 
@@ -414,87 +512,99 @@ class ChatGPTTelegramBot:
                     message_thread_id=get_thread_id(update)
                 )
 
-                stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
-
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
-                        continue
-
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
+                if self.config['cancel_on_new_message']:
+                    self.cancel_generations(chat_id, user_id, reason='superseded')
+                cancel_event = asyncio.Event()
+                self.generations.setdefault(chat_id, []).append((user_id, cancel_event))
+
+                # The previous generation is cancelled before waiting for a slot, it may hold the last one
+                async with self.scheduler.slot(user_id, chat_id, priority):
+                    budget_tokens = get_remaining_budget_tokens(self.config, self.usage, update)
+                    stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt,
+                                                                           cancel_event=cancel_event,
+                                                                           budget_tokens=budget_tokens)
+                    chunker = MarkdownChunker()
+                    prev_length = 0
+                    sent_message = None
+                    replied = False
+                    backoff = 0
+
+                    async for delta, tokens in stream_response:
+                        finished = tokens != 'not_finished'
+                        if finished:
+                            if is_direct_result(delta):
+                                return await handle_direct_result(self.config, update, delta)
+                            total_tokens = int(tokens)
+                            if cancel_event.is_set():
+                                # Stopped, the messages keep the part of the answer sent so far
+                                break
+
+                        # Complete the current message with each finalised chunk and continue in a new one
+                        for chunk in chunker.finish(delta) if finished else chunker.append(delta):
                             try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
+                                if sent_message is not None:
+                                    await edit_message_with_retry(context, chat_id, str(sent_message.message_id), chunk)
+                                else:
+                                    await update.effective_message.reply_text(
+                                        message_thread_id=get_thread_id(update),
+                                        reply_to_message_id=get_reply_to_message_id(self.config,
+                                                                                    update) if not replied else None,
+                                        text=chunk
+                                    )
                             except:
                                 pass
+                            replied = True
+                            sent_message = None
+
+                        content = chunker.tail
+                        if len(content.strip()) == 0:
+                            continue
+
+                        cutoff = get_stream_cutoff_values(update, content)
+                        cutoff += backoff
+
+                        if sent_message is None:
                             try:
                                 sent_message = await update.effective_message.reply_text(
                                     message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
+                                    reply_to_message_id=get_reply_to_message_id(self.config,
+                                                                                update) if not replied else None,
+                                    text=content,
                                 )
+                                replied = True
+                                prev_length = len(content)
                             except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
+                                continue
 
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
+                        elif len(content) - prev_length > cutoff or finished:
+                            prev_length = len(content)
 
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
+                            try:
+                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
+                                                              text=content, markdown=finished)
 
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
+                            except RetryAfter as e:
+                                backoff += 5
+                                await asyncio.sleep(e.retry_after)
+                                continue
 
-                        except Exception:
-                            backoff += 5
-                            continue
+                            except TimedOut:
+                                backoff += 5
+                                await asyncio.sleep(0.5)
+                                continue
 
-                        await asyncio.sleep(0.01)
+                            except Exception:
+                                backoff += 5
+                                continue
 
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
+                            await asyncio.sleep(0.01)
 
             else:
                 async def _reply():
                     nonlocal total_tokens
-                    response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=prompt)
+                    budget_tokens = get_remaining_budget_tokens(self.config, self.usage, update)
+                    response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=prompt,
+                                                                                 budget_tokens=budget_tokens)
 
                     if is_direct_result(response):
                         return await handle_direct_result(self.config, update, response)
@@ -508,10 +618,11 @@ class ChatGPTTelegramBot:
                                 message_thread_id=get_thread_id(update),
                                 reply_to_message_id=get_reply_to_message_id(self.config,
                                                                             update) if index == 0 else None,
-                                text=chunk,
+                                text=prepare_markdown(chunk),
                                 parse_mode=constants.ParseMode.MARKDOWN
                             )
                         except Exception:
+                            metrics.MARKDOWN_FALLBACKS.inc()
                             try:
                                 await update.effective_message.reply_text(
                                     message_thread_id=get_thread_id(update),
@@ -522,19 +633,43 @@ class ChatGPTTelegramBot:
                             except Exception as exception:
                                 raise exception
 
-                await wrap_with_indicator(update, context, _reply, constants.ChatAction.TYPING)
+                async with self.scheduler.slot(user_id, chat_id, priority):
+                    await wrap_with_indicator(update, context, _reply, constants.ChatAction.TYPING)
+
+            async with self.track_usage(user_id, update.message.from_user.name):
+                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
 
-            add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+        except BudgetExceededError as e:
+            logging.warning(f'User {update.message.from_user.name} (id: {user_id}) cannot afford the prompt')
+            await update.effective_message.reply_text(
+                message_thread_id=get_thread_id(update),
+                reply_to_message_id=get_reply_to_message_id(self.config, update),
+                text=str(e)
+            )
+
+        except OverloadedError as e:
+            logging.warning(f'Refused message from user {update.message.from_user.name} (id: {user_id}): {e}')
+            await update.effective_message.reply_text(
+                message_thread_id=get_thread_id(update),
+                reply_to_message_id=get_reply_to_message_id(self.config, update),
+                text=self.busy_message
+            )
 
         except Exception as e:
             logging.exception(e)
             await update.effective_message.reply_text(
                 message_thread_id=get_thread_id(update),
                 reply_to_message_id=get_reply_to_message_id(self.config, update),
-                text=f"{localized_text('chat_fail', self.config['bot_language'])} {str(e)}",
+                text=prepare_markdown(f"{localized_text('chat_fail', self.config['bot_language'])} {str(e)}"),
                 parse_mode=constants.ParseMode.MARKDOWN
             )
 
+        finally:
+            if cancel_event is not None:
+                self.generations[chat_id].remove((user_id, cancel_event))
+                if len(self.generations[chat_id]) == 0:
+                    del self.generations[chat_id]
+
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Handle the inline query. This is run when you type: @botusername <query>
@@ -542,16 +677,43 @@ class ChatGPTTelegramBot:
         query = update.inline_query.query
         if len(query) < 3:
             return
+        if not await self.debounce_inline_query(update.inline_query.from_user.id):
+            metrics.INLINE_QUERIES_SUPERSEDED.inc()
+            return
         if not await self.check_allowed_and_within_budget(update, context, is_inline=True):
             return
 
         callback_data_suffix = "gpt:"
         result_id = str(uuid4())
-        self.inline_queries_cache[result_id] = query
+        await self.state.set('inline_queries', result_id, query, ttl=self.config['inline_query_cache_ttl'])
         callback_data = f'{callback_data_suffix}{result_id}'
 
         await self.send_inline_query_result(update, result_id, message_content=query, callback_data=callback_data)
 
+    async def debounce_inline_query(self, user_id: int) -> bool:
+        """
+        Waits until the user stops typing: inline queries are sent on every keystroke, only the query
+        that did not change for the debounce window is answered. A new query from the same user
+        cancels the wait of the previous one.
+        :param user_id: The user ID
+        :return: Boolean indicating if the query should be answered, False if a newer query superseded it
+        """
+        delay = self.config['inline_query_debounce_seconds']
+        if delay <= 0:
+            return True
+        previous = self.inline_query_timers.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        timer = asyncio.ensure_future(asyncio.sleep(delay))
+        self.inline_query_timers[user_id] = timer
+        try:
+            await asyncio.wait([timer])
+        finally:
+            timer.cancel()
+            if self.inline_query_timers.get(user_id) is timer:
+                del self.inline_query_timers[user_id]
+        return not timer.cancelled()
+
     async def send_inline_query_result(self, update: Update, result_id, message_content, callback_data=""):
         """
         Send inline query result
@@ -575,10 +737,13 @@ class ChatGPTTelegramBot:
                 reply_markup=reply_markup
             )
 
-            await update.inline_query.answer([inline_query_result], cache_time=0)
+            # The results only depend on the query and the user, Telegram can reuse them for a while
+            await update.inline_query.answer([inline_query_result], cache_time=self.config['inline_query_cache_time'],
+                                             is_personal=True)
         except Exception as e:
             logging.error(f'An error occurred while generating the result card for inline query {e}')
 
+    @tracing.traced('inline_query_callback', root=True)
     async def handle_callback_inline_query(self, update: Update, context: CallbackContext):
         """
         Handle the callback query from the inline query result
@@ -598,11 +763,10 @@ class ChatGPTTelegramBot:
                 unique_id = callback_data.split(':')[1]
                 total_tokens = 0
 
-                # Retrieve the prompt from the cache
-                query = self.inline_queries_cache.get(unique_id)
-                if query:
-                    self.inline_queries_cache.pop(unique_id)
-                else:
+                # Retrieve the prompt from the state backend. It is not removed, Telegram may show the same
+                # cached result card again until it expires
+                query = await self.state.get('inline_queries', unique_id)
+                if not query:
                     error_message = (
                         f'{localized_text("error", bot_language)}. '
                         f'{localized_text("try_again", bot_language)}'
@@ -613,98 +777,125 @@ class ChatGPTTelegramBot:
                     return
 
                 unavailable_message = localized_text("function_unavailable_in_inline_mode", bot_language)
-                if self.config['stream']:
-                    stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
-                    i = 0
-                    prev = ''
-                    backoff = 0
-                    async for content, tokens in stream_response:
-                        if is_direct_result(content):
-                            cleanup_intermediate_files(content)
-                            await edit_message_with_retry(context, chat_id=None,
-                                                          message_id=inline_message_id,
-                                                          text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
-                                                          is_inline=True)
-                            return
-
-                        if len(content.strip()) == 0:
-                            continue
-
-                        cutoff = get_stream_cutoff_values(update, content)
-                        cutoff += backoff
+                # Inline answers are kept in the conversation of the user
+                async with self.scheduler.slot(user_id, user_id, get_priority_class(self.config, user_id)):
+                    budget_tokens = get_remaining_budget_tokens(self.config, self.usage, update, user_id=user_id)
+                    if self.config['stream']:
+                        stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query,
+                                                                               cacheable=True,
+                                                                               budget_tokens=budget_tokens)
+                        chunker = MarkdownChunker()
+                        i = 0
+                        prev_length = 0
+                        backoff = 0
+                        async for delta, tokens in stream_response:
+                            finished = tokens != 'not_finished'
+                            if finished:
+                                if is_direct_result(delta):
+                                    cleanup_intermediate_files(delta)
+                                    await edit_message_with_retry(
+                                        context, chat_id=None, message_id=inline_message_id,
+                                        text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}', is_inline=True)
+                                    return
+                                total_tokens = int(tokens)
+                                chunker.finish(delta)
+                            else:
+                                chunker.append(delta)
+
+                            # Only the first chunk is shown, no chunking allowed in inline mode
+                            content = chunker.chunks[0] if len(chunker.chunks) > 0 else chunker.tail
+                            if len(content.strip()) == 0:
+                                continue
 
-                        if i == 0:
-                            try:
+                            cutoff = get_stream_cutoff_values(update, content)
+                            cutoff += backoff
+
+                            if i == 0:
+                                try:
+                                    await edit_message_with_retry(context, chat_id=None,
+                                                                  message_id=inline_message_id,
+                                                                  text=f'{query}\n\n{answer_tr}:\n{content}',
+                                                                  is_inline=True)
+                                    prev_length = len(content)
+                                except:
+                                    continue
+
+                            elif len(content) - prev_length > cutoff or finished:
+                                prev_length = len(content)
+                                try:
+                                    use_markdown = finished
+                                    divider = '_' if use_markdown else ''
+                                    text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
+
+                                    # We only want to send the first 4096 characters.
+                                    # No chunking allowed in inline mode.
+                                    text = text[:4096]
+
+                                    await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                                  text=text, markdown=use_markdown, is_inline=True)
+
+                                except RetryAfter as e:
+                                    backoff += 5
+                                    await asyncio.sleep(e.retry_after)
+                                    continue
+                                except TimedOut:
+                                    backoff += 5
+                                    await asyncio.sleep(0.5)
+                                    continue
+                                except Exception:
+                                    backoff += 5
+                                    continue
+
+                                await asyncio.sleep(0.01)
+
+                            i += 1
+
+                    else:
+                        async def _send_inline_query_response():
+                            nonlocal total_tokens
+                            # Edit the current message to indicate that the answer is being processed
+                            await context.bot.edit_message_text(inline_message_id=inline_message_id,
+                                                                text=f'{query}\n\n_{answer_tr}:_\n{loading_tr}',
+                                                                parse_mode=constants.ParseMode.MARKDOWN)
+
+                            logging.info(f'Generating response for inline query by {name}')
+                            response, total_tokens = await self.openai.get_chat_response(chat_id=user_id, query=query,
+                                                                                         cacheable=True,
+                                                                                         budget_tokens=budget_tokens)
+
+                            if is_direct_result(response):
+                                cleanup_intermediate_files(response)
                                 await edit_message_with_retry(context, chat_id=None,
                                                               message_id=inline_message_id,
-                                                              text=f'{query}\n\n{answer_tr}:\n{content}',
+                                                              text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
                                                               is_inline=True)
-                            except:
-                                continue
-
-                        elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                            prev = content
-                            try:
-                                use_markdown = tokens != 'not_finished'
-                                divider = '_' if use_markdown else ''
-                                text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
-
-                                # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                                text = text[:4096]
-
-                                await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
-                                                              text=text, markdown=use_markdown, is_inline=True)
-
-                            except RetryAfter as e:
-                                backoff += 5
-                                await asyncio.sleep(e.retry_after)
-                                continue
-                            except TimedOut:
-                                backoff += 5
-                                await asyncio.sleep(0.5)
-                                continue
-                            except Exception:
-                                backoff += 5
-                                continue
+                                return
 
-                            await asyncio.sleep(0.01)
+                            text_content = f'{query}\n\n_{answer_tr}:_\n{response}'
 
-                        i += 1
-                        if tokens != 'not_finished':
-                            total_tokens = int(tokens)
-
-                else:
-                    async def _send_inline_query_response():
-                        nonlocal total_tokens
-                        # Edit the current message to indicate that the answer is being processed
-                        await context.bot.edit_message_text(inline_message_id=inline_message_id,
-                                                            text=f'{query}\n\n_{answer_tr}:_\n{loading_tr}',
-                                                            parse_mode=constants.ParseMode.MARKDOWN)
+                            # We only want to send the first 4096 characters. No chunking allowed in inline mode.
+                            text_content = text_content[:4096]
 
-                        logging.info(f'Generating response for inline query by {name}')
-                        response, total_tokens = await self.openai.get_chat_response(chat_id=user_id, query=query)
+                            # Edit the original message with the generated content
+                            await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                          text=text_content, is_inline=True)
 
-                        if is_direct_result(response):
-                            cleanup_intermediate_files(response)
-                            await edit_message_with_retry(context, chat_id=None,
-                                                          message_id=inline_message_id,
-                                                          text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
-                                                          is_inline=True)
-                            return
+                        await wrap_with_indicator(update, context, _send_inline_query_response,
+                                                  constants.ChatAction.TYPING, is_inline=True)
 
-                        text_content = f'{query}\n\n_{answer_tr}:_\n{response}'
+                async with self.track_usage(user_id, name):
+                    add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
 
-                        # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                        text_content = text_content[:4096]
-
-                        # Edit the original message with the generated content
-                        await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
-                                                      text=text_content, is_inline=True)
-
-                    await wrap_with_indicator(update, context, _send_inline_query_response,
-                                              constants.ChatAction.TYPING, is_inline=True)
+        except BudgetExceededError as e:
+            logging.warning(f'User {name} (id: {user_id}) cannot afford the inline query')
+            await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                          text=f"{query}\n\n_{answer_tr}:_\n{str(e)}", is_inline=True)
 
-                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+        except OverloadedError as e:
+            logging.warning(f'Refused inline query from user {name} (id: {user_id}): {e}')
+            await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                          text=f"{query}\n\n_{answer_tr}:_\n{self.busy_message}",
+                                          is_inline=True)
 
         except Exception as e:
             logging.error(f'Failed to respond to an inline query via button callback: {e}')
@@ -714,6 +905,16 @@ class ChatGPTTelegramBot:
                                           text=f"{query}\n\n_{answer_tr}:_\n{localized_answer} {str(e)}",
                                           is_inline=True)
 
+    async def handle_chat_member_update(self, update: Update, _: ContextTypes.DEFAULT_TYPE):
+        """
+        Invalidates cached group memberships when a member joins or leaves a chat.
+        """
+        chat_member_updated = update.chat_member or update.my_chat_member
+        if chat_member_updated is None or update.effective_chat is None:
+            return
+        self.membership_cache.invalidate(update.effective_chat.id, chat_member_updated.new_chat_member.user.id)
+
+    @tracing.traced('auth')
     async def check_allowed_and_within_budget(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
                                               is_inline=False) -> bool:
         """
@@ -726,10 +927,12 @@ class ChatGPTTelegramBot:
         name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
         user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
 
-        if not await is_allowed(self.config, update, context, is_inline=is_inline):
+        if not await is_allowed(self.config, update, context, is_inline=is_inline,
+                                membership_cache=self.membership_cache):
             logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
             await self.send_disallowed_message(update, context, is_inline)
             return False
+        await self.load_usage(user_id, name)
         if not is_within_budget(self.config, self.usage, update, is_inline=is_inline):
             logging.warning(f'User {name} (id: {user_id}) reached their usage limit')
             await self.send_budget_reached_message(update, context, is_inline)
@@ -737,6 +940,43 @@ class ChatGPTTelegramBot:
 
         return True
 
+    async def load_usage(self, user_id: int, user_name: str):
+        """
+        Refreshes the usage trackers of a user and of the guests with the usage stored in the state backend,
+        creating the tracker of the user if needed.
+        :param user_id: The user ID
+        :param user_name: The user name
+        """
+        if user_id not in self.usage:
+            self.usage[user_id] = UsageTracker(user_id, user_name)
+        usage = await self.state.get('usage', user_id)
+        if usage is not None:
+            self.usage[user_id].usage = usage
+        guests_usage = await self.state.get('usage', 'guests')
+        if guests_usage is not None:
+            if 'guests' not in self.usage:
+                self.usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
+            self.usage['guests'].usage = guests_usage
+
+    @contextlib.asynccontextmanager
+    async def track_usage(self, user_id: int, user_name: str):
+        """
+        Locks and refreshes the usage of a user (and of the guests if the user is a guest), then stores it
+        back in the state backend, so that the usage added by other workers in the meantime is not lost.
+        :param user_id: The user ID
+        :param user_name: The user name
+        """
+        is_guest = str(user_id) not in self.config['allowed_user_ids'].split(',')
+        async with contextlib.AsyncExitStack() as stack:
+            await stack.enter_async_context(self.state.lock('usage', user_id))
+            if is_guest:
+                await stack.enter_async_context(self.state.lock('usage', 'guests'))
+            await self.load_usage(user_id, user_name)
+            yield
+            await self.state.set('usage', user_id, self.usage[user_id].usage)
+            if is_guest and 'guests' in self.usage:
+                await self.state.set('usage', 'guests', self.usage['guests'].usage)
+
     async def send_disallowed_message(self, update: Update, _: ContextTypes.DEFAULT_TYPE, is_inline=False):
         """
         Sends the disallowed message to the user.
@@ -770,6 +1010,39 @@ class ChatGPTTelegramBot:
         """
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
+        self.trigger_filter.bot_id = application.bot.id
+        if self.config['metrics_port']:
+            self.metrics_server = await metrics.start_metrics_server(self.config['metrics_host'],
+                                                                     self.config['metrics_port'])
+        if self.snapshot is not None and self.snapshot.interval_minutes > 0:
+            self.snapshot_task = asyncio.create_task(self.checkpoint_state())
+
+    async def checkpoint_state(self):
+        """
+        Writes the snapshot of the in-memory state every SNAPSHOT_INTERVAL_MINUTES, so that a crash only loses
+        the changes made since the last checkpoint
+        """
+        while True:
+            await asyncio.sleep(self.snapshot.interval_minutes * 60)
+            try:
+                self.snapshot.write(self.state)
+            except Exception as e:
+                logging.exception(f'Failed to write the state snapshot: {e}')
+
+    async def post_shutdown(self, _: Application) -> None:
+        """
+        Post shutdown hook for the bot.
+        """
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        if self.snapshot is not None:
+            if self.snapshot_task is not None:
+                self.snapshot_task.cancel()
+            self.snapshot.write(self.state)
+            self.snapshot.close()
+        await self.state.close()
+        tracing.close_tracing()
 
     def run(self):
         """
@@ -777,31 +1050,38 @@ class ChatGPTTelegramBot:
         """
         application = ApplicationBuilder() \
             .token(self.config['token']) \
-            .proxy_url(self.config['proxy']) \
-            .get_updates_proxy_url(self.config['proxy']) \
+            .request(metrics.MetricsHTTPXRequest(connection_pool_size=256, proxy_url=self.config['proxy'])) \
+            .get_updates_request(HTTPXRequest(proxy_url=self.config['proxy'])) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
             .concurrent_updates(True) \
             .build()
 
-        application.add_handler(CommandHandler('reset', self.reset))
-        application.add_handler(CommandHandler('help', self.help))
-        application.add_handler(CommandHandler('image', self.image))
-        application.add_handler(CommandHandler('start', self.help))
-        application.add_handler(CommandHandler('stats', self.stats))
-        application.add_handler(CommandHandler('resend', self.resend))
+        count = metrics.count_updates
+        application.add_handler(CommandHandler('reset', count('reset', self.reset)))
+        application.add_handler(CommandHandler('help', count('help', self.help)))
+        application.add_handler(CommandHandler('image', count('image', self.image)))
+        application.add_handler(CommandHandler('start', count('start', self.help)))
+        application.add_handler(CommandHandler('stats', count('stats', self.stats)))
+        application.add_handler(CommandHandler('resend', count('resend', self.resend)))
+        application.add_handler(CommandHandler('cancel', count('cancel', self.cancel)))
         application.add_handler(CommandHandler(
-            'chat', self.prompt, filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
+            'chat', count('chat', self.prompt), filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
         )
         application.add_handler(MessageHandler(
             filters.AUDIO | filters.VOICE | filters.Document.AUDIO |
             filters.VIDEO | filters.VIDEO_NOTE | filters.Document.VIDEO,
-            self.transcribe))
-        application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.prompt))
-        application.add_handler(InlineQueryHandler(self.inline_query, chat_types=[
+            count('transcribe', self.transcribe)))
+        application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND) & self.trigger_filter,
+                                               count('prompt', self.prompt)))
+        application.add_handler(InlineQueryHandler(count('inline_query', self.inline_query), chat_types=[
             constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.PRIVATE
         ]))
-        application.add_handler(CallbackQueryHandler(self.handle_callback_inline_query))
+        application.add_handler(CallbackQueryHandler(count('inline_callback', self.handle_callback_inline_query)))
+        application.add_handler(ChatMemberHandler(count('chat_member', self.handle_chat_member_update),
+                                                  ChatMemberHandler.ANY_CHAT_MEMBER))
 
         application.add_error_handler(error_handler)
 
-        application.run_polling()
+        # chat_member updates are only delivered when explicitly requested
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import re
+
+import metrics
+
+_MARKER = re.compile(r'\\?[_*`\[]')
+_UNESCAPED_MARKER = re.compile(r'(?<!\\)([_*`\[])')
+
+
+def repair_markdown(text: str) -> str:
+    """
+    Makes a text safe to send with Telegram's legacy Markdown parse mode, so the request is accepted
+    the first time instead of being resent as plain text.
+    Follows the way Telegram parses legacy Markdown: an entity starts at any unescaped _, *, `, ``` or [
+    and ends at the next matching marker, without nesting. A code block that is never closed is closed at the end
+    of the text, markers of other entities that are never closed are escaped.
+    :param text: The text to repair
+    :return: The repaired text, or the text itself if it was valid
+    """
+    escapes = []
+    closing = ''
+    visible = False
+    position = 0
+    size = len(text)
+    while position < size:
+        match = _MARKER.search(text, position)
+        start = match.start() if match is not None else size
+        visible = visible or (start > position and not text[position:start].isspace())
+        if match is None:
+            break
+        if len(match.group()) == 2:
+            # Escaped marker
+            visible = True
+            position = match.end()
+            continue
+
+        marker = text[start]
+        is_pre = text.startswith('```', start)
+        if is_pre:
+            end = text.find('```', start + 3)
+            next_position = end + 3
+            content_start = _pre_content_start(text, start + 3, end if end >= 0 else size)
+        elif marker == '[':
+            content_start, end = start + 1, text.find(']', start + 1)
+            next_position = end + 1
+            if end >= 0 and text.startswith('(', end + 1):
+                # Telegram reads the URL up to the closing parenthesis, or up to the end of the text
+                url_end = text.find(')', end + 2)
+                end = end if url_end >= 0 else -1
+                next_position = url_end + 1
+        else:
+            content_start, end = start + 1, text.find(marker, start + 1)
+            next_position = end + 1
+
+        if end < 0 and is_pre and '`' not in text[start + 3:]:
+            # Close a code block that is still open at the end of the text, e.g. in a truncated answer.
+            # Without whitespace in the block, a line break before the closing fence would turn its text into
+            # the language of the block.
+            closing = '\n```' if content_start > start + 3 or any(c.isspace() for c in text[start + 3:]) else '```'
+            visible = visible or (content_start < size and not text[content_start:].isspace())
+            break
+        if end < 0:
+            escapes.append(start)
+            visible = True
+            position = start + 1
+            continue
+        visible = visible or (end > content_start and not text[content_start:end].isspace())
+        position = next_position
+
+    if not visible:
+        # Telegram rejects messages that are empty once the entities are parsed, e.g. '**'
+        repaired = _UNESCAPED_MARKER.sub(r'\\\1', text)
+        return text if repaired == text else repaired
+    if len(escapes) == 0 and len(closing) == 0:
+        return text
+    parts = []
+    previous = 0
+    for escape in escapes:
+        parts.append(text[previous:escape])
+        parts.append('\\')
+        previous = escape
+    parts.append(text[previous:])
+    parts.append(closing)
+    return ''.join(parts)
+
+
+def _pre_content_start(text: str, position: int, end: int) -> int:
+    """
+    Returns where the text of a code block starts, after its language and first line break
+    :param text: The text
+    :param position: The position after the opening fence
+    :param end: The position of the closing fence, or the end of the text
+    """
+    language_end = position
+    while language_end < end and not text[language_end].isspace() and text[language_end] != '`':
+        language_end += 1
+    # The language is only read if it is followed by whitespace
+    content_start = language_end if language_end < end and text[language_end].isspace() else position
+    if text.startswith('\n', content_start):
+        content_start += 1
+    return content_start
+
+
+def prepare_markdown(text: str) -> str:
+    """
+    Repairs a text before sending it with the legacy Markdown parse mode, counting the repairs
+    (each one a plain text resend avoided).
+    :param text: The text to send
+    :return: The text to send with the Markdown parse mode
+    """
+    repaired = repair_markdown(text)
+    if repaired is not text:
+        metrics.MARKDOWN_REPAIRS.inc()
+    return repaired
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import collections
+import functools
+import json
+import logging
+import random
+import time
+from contextvars import ContextVar
+from uuid import uuid4
+
+from telegram import Update
+
+_NOT_SAMPLED = object()
+_current_span: ContextVar = ContextVar('current_span', default=None)
+
+
+class Span:
+    """
+    A timed operation within a trace
+    """
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'start_time', 'start', 'error')
+
+    def __init__(self, trace_id: str, parent_id: str | None, name: str, attributes: dict):
+        self.trace_id = trace_id
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_dict(self, duration: float) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_time': self.start_time,
+            'duration_ms': round(duration * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class JsonlSpanExporter:
+    """
+    Appends finished spans to a local JSONL file. The writes are buffered and flushed at most once every
+    flush_seconds, so exporting a span does not block the event loop on a disk write
+    """
+
+    def __init__(self, path: str, flush_seconds: float = 1.0):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.flush_seconds = flush_seconds
+        self.last_flush = time.monotonic()
+
+    def export(self, span: dict):
+        self.file.write(json.dumps(span, default=str) + '\n')
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_seconds:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        self.file.close()
+
+
+class RingBufferSpanExporter:
+    """
+    Keeps the most recent finished spans in memory
+    """
+
+    def __init__(self, size: int = 1000):
+        self.spans = collections.deque(maxlen=size)
+
+    def export(self, span: dict):
+        self.spans.append(span)
+
+    def get_spans(self, trace_id: str | None = None) -> list[dict]:
+        return [span for span in self.spans if trace_id is None or span['trace_id'] == trace_id]
+
+
+class Tracer:
+    """
+    Creates spans and decides which traces are sampled
+    """
+
+    def __init__(self, sample_rate: float = 0.0, exporter=None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 and self.exporter is not None
+
+    def export(self, span: Span, duration: float):
+        try:
+            self.exporter.export(span.to_dict(duration))
+        except Exception as e:
+            logging.warning(f'Failed to export span {span.name}: {str(e)}')
+
+
+class _SpanScope:
+    __slots__ = ('name', 'attributes', 'root', 'span', 'token')
+
+    def __init__(self, name: str, attributes: dict, root: bool):
+        self.name = name
+        self.attributes = attributes
+        self.root = root
+        self.span = None
+        self.token = None
+
+    def __enter__(self) -> Span | None:
+        if not tracer.enabled:
+            return None
+        parent = _current_span.get()
+        if parent is _NOT_SAMPLED:
+            return None
+        if parent is None:
+            # Spans outside of a trace are not recorded, the sampling decision is made at the root
+            if not self.root:
+                return None
+            if random.random() >= tracer.sample_rate:
+                self.token = _current_span.set(_NOT_SAMPLED)
+                return None
+            self.span = Span(uuid4().hex, None, self.name, self.attributes)
+        else:
+            self.span = Span(parent.trace_id, parent.span_id, self.name, self.attributes)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, _):
+        if self.token is not None:
+            _current_span.reset(self.token)
+        if self.span is not None:
+            if exc is not None:
+                self.span.error = f'{exc_type.__name__}: {str(exc)}'
+            tracer.export(self.span, time.perf_counter() - self.span.start)
+        return False
+
+
+tracer = Tracer()
+
+
+def configure_tracing(config: dict):
+    """
+    Configures the global tracer.
+    :param config: A dictionary containing the tracing configuration
+    """
+    tracer.sample_rate = config['sample_rate']
+    if tracer.sample_rate <= 0:
+        tracer.exporter = None
+        return
+    if config['exporter'] == 'memory':
+        tracer.exporter = RingBufferSpanExporter(config['buffer_size'])
+    else:
+        tracer.exporter = JsonlSpanExporter(config['file'])
+    logging.info(f'Tracing enabled with sample rate {tracer.sample_rate} ({config["exporter"]} exporter)')
+
+
+def close_tracing():
+    """
+    Stops recording spans, and writes the spans still buffered by the exporter.
+    """
+    exporter = tracer.exporter
+    tracer.exporter = None
+    if isinstance(exporter, JsonlSpanExporter):
+        exporter.close()
+
+
+def span(name: str, **attributes) -> _SpanScope:
+    """
+    Context manager recording a span within the current trace, if any
+    """
+    return _SpanScope(name, attributes, root=False)
+
+
+def start_trace(name: str, **attributes) -> _SpanScope:
+    """
+    Context manager recording a span, starting a new (possibly sampled) trace if none is active
+    """
+    return _SpanScope(name, attributes, root=True)
+
+
+def current_trace_id() -> str | None:
+    current = _current_span.get()
+    return current.trace_id if isinstance(current, Span) else None
+
+
+def traced(name: str, root: bool = False):
+    """
+    Decorator recording a span for each call of the decorated coroutine function.
+    With root=True, a new trace is started if none is active, tagged with the update being handled.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return await func(*args, **kwargs)
+            attributes = {}
+            update = next((arg for arg in args if isinstance(arg, Update)), None)
+            if update is not None:
+                attributes['update_id'] = update.update_id
+                if update.effective_chat is not None:
+                    attributes['chat_id'] = update.effective_chat.id
+            with _SpanScope(name, attributes, root=root):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
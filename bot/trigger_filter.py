@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import logging
+
+from telegram import Message, constants
+from telegram.ext.filters import MessageFilter
+
+import metrics
+from utils import message_text
+
+
+class GroupTriggerFilter(MessageFilter):
+    """
+    Cheap filter for group chat messages that are not addressed to the bot.
+    Private chat messages pass through, as do group messages that start with the trigger keyword
+    or reply to the bot. Everything else is discarded before any auth, budget or network check.
+    """
+
+    def __init__(self, trigger_keyword: str):
+        """
+        Initializes the filter.
+        :param trigger_keyword: The group trigger keyword, an empty keyword lets every message through
+        """
+        super().__init__(name='GroupTriggerFilter')
+        self.trigger_keyword = trigger_keyword.lower()
+        self.bot_id: int | None = None
+        self.discarded = 0
+
+    def filter(self, message: Message) -> bool:
+        if not self.trigger_keyword or message.chat.type not in (
+                constants.ChatType.GROUP, constants.ChatType.SUPERGROUP):
+            return True
+
+        if message_text(message).lower().startswith(self.trigger_keyword):
+            return True
+
+        reply_to_message = message.reply_to_message
+        if reply_to_message is not None and reply_to_message.from_user is not None \
+                and reply_to_message.from_user.id == self.bot_id:
+            return True
+
+        self.discarded += 1
+        metrics.GROUP_MESSAGES_DISCARDED.inc()
+        if self.discarded % 100 == 0:
+            logging.info(f'Discarded {self.discarded} group messages without trigger keyword so far')
+        return False
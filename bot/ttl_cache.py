@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class BoundedTTLCache:
+    """
+    Dictionary bounded in size and in time, for state that is only needed for a while,
+    e.g. the inline query waiting for its button to be pressed.
+    When the cache is full, the least recently used entry is evicted. Expired entries are dropped
+    when they are read, and from the oldest one when a new entry is added.
+    """
+
+    def __init__(self, name: str, max_size: int | None = None, ttl: float | None = None):
+        """
+        Initializes the cache.
+        :param name: The name of the cache, used as label of the metrics
+        :param max_size: Maximum number of entries, or None for no limit
+        :param ttl: Default number of seconds an entry stays valid, or None to keep it
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()  # {key: (value, expiry)}
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.__expired_counter = metrics.CACHE_EVICTIONS.labels(name, 'expired')
+        self.__evicted_counter = metrics.CACHE_EVICTIONS.labels(name, 'size')
+        self.__size_gauge = metrics.CACHE_ENTRIES.labels(name)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key) -> bool:
+        return self.__lookup(key) is not None
+
+    def get(self, key, default=None):
+        """
+        Gets the value of a key and marks it as recently used.
+        :param key: The key
+        :param default: The value to return if the key does not exist or has expired
+        """
+        entry = self.__lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value, ttl: float | None = None):
+        """
+        Stores a value, evicting the least recently used entry if the cache is full.
+        :param key: The key
+        :param value: The value
+        :param ttl: Number of seconds the entry stays valid, the default TTL of the cache if None
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        now = time.monotonic()
+        self.entries[key] = (value, now + ttl if ttl is not None else None)
+        self.entries.move_to_end(key)
+        self.__purge(now)
+        while self.max_size is not None and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+            self.__evicted_counter.inc()
+        self.__size_gauge.set(len(self.entries))
+
+    def pop(self, key, default=None):
+        """
+        Removes a key and returns its value.
+        :param key: The key
+        :param default: The value to return if the key does not exist or has expired
+        """
+        entry = self.__lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        del self.entries[key]
+        self.__size_gauge.set(len(self.entries))
+        return entry[0]
+
+    def live_items(self):
+        """
+        Iterates over the entries that have not expired, without marking them as used.
+        :return: The key, value and remaining number of seconds (None if it does not expire) of each entry
+        """
+        now = time.monotonic()
+        for key, (value, expiry) in list(self.entries.items()):
+            if expiry is None:
+                yield key, value, None
+            elif expiry > now:
+                yield key, value, expiry - now
+
+    def stats(self) -> dict:
+        """
+        Returns the size of the cache and the number of hits, misses, expired and evicted entries.
+        """
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'expirations': self.expirations, 'evictions': self.evictions}
+
+    def __lookup(self, key) -> tuple | None:
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.entries[key]
+            self.__expire()
+            return None
+        return entry
+
+    def __purge(self, now: float):
+        while len(self.entries) > 0:
+            key, (_, expiry) = next(iter(self.entries.items()))
+            if expiry is None or expiry > now:
+                break
+            del self.entries[key]
+            self.__expire()
+
+    def __expire(self):
+        self.expirations += 1
+        self.__expired_counter.inc()
+        self.__size_gauge.set(len(self.entries))
@@ -1,8 +1,11 @@
 import os.path
 import pathlib
 import json
+import time
 from datetime import date
 
+import metrics
+
 
 def year_month(date_str):
     # extract string of year-month from date, eg: '2023-03'
@@ -86,8 +89,7 @@ class UsageTracker:
             self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
 
         # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.__write_usage_file()
 
     def get_current_token_usage(self):
         """Get token amounts used for today and this month
@@ -131,8 +133,7 @@ class UsageTracker:
             self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
 
         # write updated image number to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.__write_usage_file()
 
     def get_current_image_count(self):
         """Get number of images requested for today and this month.
@@ -171,8 +172,7 @@ class UsageTracker:
             self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
 
         # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.__write_usage_file()
 
     def add_current_costs(self, request_cost):
         """
@@ -216,6 +216,13 @@ class UsageTracker:
         return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
 
     # general functions
+    def __write_usage_file(self):
+        """Writes the usage data to the user file"""
+        start = time.perf_counter()
+        with open(self.user_file, "w") as outfile:
+            json.dump(self.usage, outfile)
+        metrics.USAGE_FLUSH_SECONDS.observe(time.perf_counter() - start)
+
     def get_current_cost(self):
         """Get total USD amount of all requests of the current day and month
 
@@ -5,12 +5,15 @@ import itertools
 import json
 import logging
 import os
-import re
 
 import telegram
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
+import metrics
+import tracing
+from membership_cache import GroupMembershipCache
+from telegram_markdown import prepare_markdown
 from usage_tracker import UsageTracker
 
 
@@ -83,34 +86,134 @@ def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
     """
     return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
 
+
+class MarkdownChunker:
+    """
+    Incrementally splits a (streamed) Markdown answer into chunks of at most a given size, in a single pass.
+    Chunks are cut at paragraph or line boundaries where possible. Long code blocks are split by closing
+    the fence at the end of a chunk and reopening it, with its language tag, at the start of the next one.
+    Finalised chunks never change, so only the open tail has to be re-rendered after each delta,
+    keeping the work per answer linear in its length.
+    """
+
+    def __init__(self, chunk_size: int = 4096):
+        """
+        Initializes the chunker.
+        :param chunk_size: The maximum size of a chunk
+        """
+        self.chunk_size = chunk_size
+        self.chunks: list[str] = []
+        self.__set_tail('')
+
+    @property
+    def tail(self) -> str:
+        """
+        The text after the last finalised chunk
+        """
+        if self.__tail is None:
+            self.__tail = ''.join(self.__parts)
+            self.__parts = [self.__tail]
+        return self.__tail
+
+    def append(self, text: str) -> list[str]:
+        """
+        Appends a delta to the open tail.
+        :param text: The streamed delta
+        :return: The chunks that were finalised by this delta, if any
+        """
+        # Chunks never start with whitespace
+        if self.__length == 0:
+            text = text.lstrip()
+        if len(text) == 0:
+            return []
+        self.__parts.append(text)
+        self.__length += len(text)
+        self.__tail = None
+        return self.__flush()
+
+    def finish(self, suffix: str = '') -> list[str]:
+        """
+        Strips trailing whitespace from the answer and appends a suffix, e.g. the usage footer.
+        :param suffix: Text appended after the answer
+        :return: The chunks that were finalised, if any
+        """
+        self.__set_tail(self.tail.rstrip() + suffix)
+        return self.__flush()
+
+    def __set_tail(self, tail: str):
+        self.__parts = [tail]
+        self.__length = len(tail)
+        self.__tail = tail
+
+    def __flush(self) -> list[str]:
+        finalised = []
+        while self.__length > self.chunk_size:
+            chunk, rest = self.__cut(self.tail)
+            finalised.append(chunk)
+            self.__set_tail(rest)
+        self.chunks.extend(finalised)
+        return finalised
+
+    def __cut(self, text: str) -> tuple[str, str]:
+        """
+        Ends a chunk, closing and reopening a code block that is open at the cut.
+        :return: The chunk and the remaining text
+        """
+        limit = self.chunk_size
+        half = limit // 2
+        closing = '\n```'
+
+        def in_code(position: int) -> bool:
+            return text.count('```', 0, position) % 2 == 1
+
+        # The cut only depends on the first limit + 1 characters, so streamed and complete answers are split alike.
+        # Prefer the last paragraph break outside of code in the second half of the chunk
+        end = text.rfind('\n\n', half, limit + 1)
+        while end >= 0 and in_code(end):
+            end = text.rfind('\n\n', half, end + 1)
+        # ...then the last line break outside of code
+        if end < 0:
+            end = text.rfind('\n', half, limit + 1)
+            while end >= 0 and in_code(end):
+                end = text.rfind('\n', half, end)
+        # ...then any line break that leaves room to close the code block, if it doesn't just open one
+        if end < 0:
+            end = text.rfind('\n', 0, limit + 1)
+            while end > 0 and in_code(end) and \
+                    (end + len(closing) > limit or text.find('\n', text.rfind('```', 0, end), end) < 0):
+                end = text.rfind('\n', 0, end)
+        if end > 0:
+            chunk, rest = text[:end], text[end + 1:]
+        else:
+            # No line fits, split the line, preferably at a space
+            end = limit - len(closing) if in_code(limit) else limit
+            space = text.rfind(' ', half, end)
+            end = space + 1 if space > 0 else end
+            if in_code(end) and end + len(closing) > limit:
+                end = limit - len(closing)
+            chunk, rest = text[:end], text[end:]
+
+        if not in_code(end):
+            return chunk, rest.lstrip()
+        # Reopen the code block with its language tag, e.g. ```python. If the fence line goes on past the cut,
+        # the text after the fence is code written on the same line, not a tag
+        fence = text.rfind('```', 0, end)
+        line_end = text.find('\n', fence)
+        opening = text[fence:line_end].split(maxsplit=1)[0] if 0 <= line_end < end else '```'
+        if len(opening) > 20 or '`' in opening[3:]:
+            opening = '```'
+        return chunk + closing, f'{opening}\n{rest}'
+
+
 def split_into_chunks_nostream(text: str, chunk_size: int = 4096) -> list[str]:
     """
-    Splits a string into chunks of a given size, keeping Markdown code blocks intact.
-    """
-    chunks = []
-    start = 0
-    
-    for match in re.finditer(r"```.*?```", text, re.DOTALL):
-        code_start, code_end = match.span()
-        
-        # Add the text before the code block, if any
-        pre_code_text = text[start:code_start]
-        while len(pre_code_text) > 0:
-            chunk, pre_code_text = pre_code_text[:chunk_size], pre_code_text[chunk_size:]
-            chunks.append(chunk)
-        
-        # Add the entire code block as one chunk
-        chunks.append(text[code_start:code_end])
-        
-        start = code_end
-    
-    # Add remaining chunks after the last code block
-    remaining_text = text[start:]
-    while len(remaining_text) > 0:
-        chunk, remaining_text = remaining_text[:chunk_size], remaining_text[chunk_size:]
-        chunks.append(chunk)
-    
-    return chunks
+    Splits a string into chunks of a given size, preferring paragraph and line boundaries
+    and splitting long Markdown code blocks into several complete code blocks.
+    """
+    chunker = MarkdownChunker(chunk_size)
+    chunker.append(text)
+    chunker.finish()
+    return chunker.chunks + [chunker.tail] if len(chunker.tail) > 0 else chunker.chunks
 
 
 async def wrap_with_indicator(update: Update, context: CallbackContext, coroutine,
@@ -130,10 +233,11 @@ async def wrap_with_indicator(update: Update, context: CallbackContext, coroutin
             pass
 
 
+@tracing.traced('telegram.edit_message')
 async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: int | None,
                                   message_id: str, text: str, markdown: bool = True, is_inline: bool = False):
     """
-    Edit a message with retry logic in case of failure (e.g. broken markdown)
+    Edit a message with retry logic in case of failure (e.g. markdown that couldn't be repaired)
     :param context: The context to use
     :param chat_id: The chat id to edit the message in
     :param message_id: The message id to edit
@@ -147,12 +251,14 @@ async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: i
             chat_id=chat_id,
             message_id=int(message_id) if not is_inline else None,
             inline_message_id=message_id if is_inline else None,
-            text=text,
+            text=prepare_markdown(text) if markdown else text,
             parse_mode=constants.ParseMode.MARKDOWN if markdown else None,
         )
     except telegram.error.BadRequest as e:
         if str(e).startswith("Message is not modified"):
             return
+        if markdown:
+            metrics.MARKDOWN_FALLBACKS.inc()
         try:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
@@ -176,9 +282,11 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.error(f'Exception while handling an update: {context.error}')
 
 
-async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False) -> bool:
+async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False,
+                     membership_cache: GroupMembershipCache | None = None) -> bool:
     """
     Checks if the user is allowed to use the bot.
+    Group chat memberships of allowed users are looked up concurrently and cached in membership_cache, if given.
     """
     if config['allowed_user_ids'] == '*':
         return True
@@ -194,12 +302,13 @@ async def is_allowed(config, update: Update, context: CallbackContext, is_inline
     # Check if it's a group a chat with at least one authorized member
     if not is_inline and is_group_chat(update):
         admin_user_ids = config['admin_user_ids'].split(',')
-        for user in itertools.chain(allowed_user_ids, admin_user_ids):
-            if not user.strip():
-                continue
-            if await is_user_in_group(update, context, user):
-                logging.info(f'{user} is a member. Allowing group chat message...')
-                return True
+        user_ids = [user.strip() for user in itertools.chain(allowed_user_ids, admin_user_ids)
+                    if user.strip() and user.strip() != '-']
+        if membership_cache is None:
+            membership_cache = GroupMembershipCache(ttl=0)
+        if await membership_cache.is_authorised(update.message.chat_id, user_ids,
+                                                lambda user: is_user_in_group(update, context, user)):
+            return True
         logging.info(f'Group chat messages from user {name} '
                      f'(id: {user_id}) are not allowed')
     return False
@@ -224,6 +333,20 @@ def is_admin(config, user_id: int, log_no_admin=False) -> bool:
     return False
 
 
+def get_priority_class(config, user_id: int) -> str:
+    """
+    Get the priority class of the user for the scheduling of the OpenAI requests.
+    :param config: The bot configuration object
+    :param user_id: The user ID
+    :return: 'admin' for the admins, 'user' for the allowed users, 'guest' for the others
+    """
+    if is_admin(config, user_id):
+        return 'admin'
+    if config['allowed_user_ids'] == '*' or str(user_id) in config['allowed_user_ids'].split(','):
+        return 'user'
+    return 'guest'
+
+
 def get_user_budget(config, user_id) -> float | None:
     """
     Get the user's budget based on their user ID and the bot configuration.
@@ -254,13 +377,15 @@ def get_user_budget(config, user_id) -> float | None:
     return None
 
 
-def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+def get_remaining_budget(config, usage, update: Update, is_inline=False, user_id: int | None = None) -> float:
     """
     Calculate the remaining budget for a user based on their current usage.
     :param config: The bot configuration object
     :param usage: The usage tracker object
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
+    :param user_id: The user ID, if the update has no message or inline query (e.g. an inline button callback).
+                    Defaults to the sender of the message or inline query
     :return: The remaining budget for the user as a float
     """
     # Mapping of budget period to cost period
@@ -270,10 +395,10 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
         "all-time": "cost_all_time"
     }
 
-    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
+    if user_id is None:
+        user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+        usage[user_id] = UsageTracker(user_id, update.effective_user.name)
 
     # Get budget for users
     user_budget = get_user_budget(config, user_id)
@@ -289,6 +414,23 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
     return config['guest_budget'] - cost
 
 
+def get_remaining_budget_tokens(config, usage, update: Update, is_inline=False,
+                                user_id: int | None = None) -> int | None:
+    """
+    Calculate the number of chat tokens a user can still afford with their remaining budget.
+    :param config: The bot configuration object
+    :param usage: The usage tracker object
+    :param update: Telegram update object
+    :param is_inline: Boolean flag for inline queries
+    :param user_id: The user ID, defaults to the sender of the message or inline query
+    :return: The number of tokens, or None if the budget is unlimited
+    """
+    remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline, user_id=user_id)
+    if remaining_budget == float('inf') or config['token_price'] <= 0:
+        return None
+    return max(0, int(remaining_budget / config['token_price'] * 1000))
+
+
 def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     """
     Checks if the user reached their usage limit.
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The bot modules import each other by name, as when the bot is started from the bot directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bot'))
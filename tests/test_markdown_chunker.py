@@ -0,0 +1,48 @@
+"""
+Tests of the splitting of long Markdown answers into Telegram messages.
+"""
+import random
+
+from utils import MarkdownChunker, split_into_chunks_nostream
+
+
+def test_short_text_is_one_chunk():
+    assert split_into_chunks_nostream('Hello *world*\n\n') == ['Hello *world*']
+
+
+def test_splits_at_paragraphs():
+    paragraphs = [f'Paragraph {i} ' + 'word ' * 30 for i in range(20)]
+    chunks = split_into_chunks_nostream('\n\n'.join(paragraphs), chunk_size=500)
+    assert all(len(chunk) <= 500 for chunk in chunks)
+    assert '\n\n'.join(chunks) == '\n\n'.join(paragraphs).rstrip()
+
+
+def test_reopens_code_block_with_its_language():
+    code = '\n'.join(f'print({i})' for i in range(200))
+    chunks = split_into_chunks_nostream(f'Here:\n```python\n{code}\n```\nDone', chunk_size=300)
+    assert len(chunks) > 2
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    for chunk in chunks[1:-1]:
+        assert chunk.startswith('```python\n') and chunk.endswith('\n```')
+    assert chunks[0].endswith('\n```') and chunks[-1].endswith('```\nDone')
+
+
+def test_code_on_the_fence_line_is_not_a_language():
+    chunks = split_into_chunks_nostream('Here:\n```' + 'a = 1; ' * 700 + '\n```')
+    assert [chunk[:10] for chunk in chunks] == ['Here:', '```a = 1; ', '```\na = 1;']
+    assert all(chunk.endswith('\n```') for chunk in chunks[1:])
+
+
+def test_streamed_and_complete_answers_are_split_alike():
+    rng = random.Random(1234)
+    text = ''.join(rng.choice(['word ', 'word\n', '\n\n', '```py\n', 'x = 1\n']) for _ in range(3000))
+    chunker = MarkdownChunker(chunk_size=400)
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 20)
+        chunker.append(text[position:position + size])
+        position += size
+    chunker.finish()
+    streamed = chunker.chunks + [chunker.tail] if len(chunker.tail) > 0 else chunker.chunks
+    assert streamed == split_into_chunks_nostream(text, chunk_size=400)
+    assert all(len(chunk) <= 400 for chunk in streamed)
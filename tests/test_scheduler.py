@@ -0,0 +1,73 @@
+"""
+Tests of the fair scheduler of the OpenAI requests.
+"""
+import asyncio
+
+import pytest
+
+from scheduler import FairScheduler, OverloadedError
+
+
+def test_caps_and_shedding():
+    async def test():
+        scheduler = FairScheduler(max_concurrency=2, max_per_user=1, max_pending=3)
+        release = asyncio.Event()
+        started = []
+
+        async def request(user_id):
+            async with scheduler.slot(user_id, user_id):
+                started.append(user_id)
+                await release.wait()
+
+        tasks = [asyncio.create_task(request(user_id)) for user_id in (1, 1, 2)]
+        await asyncio.sleep(0)
+        # The second request of user 1 waits for the first one, user 2 is not blocked by it
+        assert started == [1, 2]
+        with pytest.raises(OverloadedError):
+            async with scheduler.slot(3, 3):
+                pass
+        release.set()
+        await asyncio.gather(*tasks)
+        assert started == [1, 2, 1]
+        assert scheduler.in_flight == 0 and scheduler.waiting == [] and scheduler.user_finish == {}
+
+    asyncio.run(test())
+
+
+def test_cancelled_in_the_same_iteration_as_a_release():
+    async def test():
+        scheduler = FairScheduler(max_concurrency=1)
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot(1, 1):
+                await release.wait()
+
+        async def waiter():
+            async with scheduler.slot(2, 2):
+                pass
+
+        holding = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        assert len(scheduler.waiting) == 1
+
+        # The holder releases its slot while the cancelled waiter is still queued
+        release.set()
+        waiting.cancel()
+        await holding
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler.in_flight == 0
+        assert scheduler.user_in_flight == {} and scheduler.chat_in_flight == {}
+        assert scheduler.waiting == [] and scheduler.user_finish == {}
+
+        # The slot is not lost
+        async def take_slot():
+            async with scheduler.slot(3, 3):
+                assert scheduler.in_flight == 1
+
+        await asyncio.wait_for(take_slot(), timeout=1)
+
+    asyncio.run(test())
@@ -0,0 +1,227 @@
+"""
+Tests of the Redis state backend against a stand-in Redis server (fakeredis), shared by all the clients of a test
+like a real server is shared by the bot workers.
+"""
+import asyncio
+
+import openai
+import pytest
+import tiktoken
+from openai.openai_object import OpenAIObject
+
+from chat_message import ChatMessage
+from openai_helper import OpenAIHelper
+from plugin_manager import PluginManager
+from state_backend import RedisStateBackend
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def connect(server, prefix='test') -> RedisStateBackend:
+    """
+    Creates a backend whose client is connected to the stand-in server.
+    """
+    backend = RedisStateBackend('redis://localhost:6379/0', prefix=prefix)
+    backend.client = fakeredis.FakeAsyncRedis(server=server)
+    return backend
+
+
+def run_with_backend(server, test, prefix='test'):
+    async def _run():
+        backend = connect(server, prefix=prefix)
+        try:
+            return await test(backend)
+        finally:
+            await backend.close()
+
+    return asyncio.run(_run())
+
+
+def test_get_set_delete(server):
+    async def test(backend):
+        assert await backend.get('conversations', 1) is None
+        assert await backend.get('conversations', 1, default=[]) == []
+        await backend.set('conversations', 1, [ChatMessage('user', 'Hello'), {'role': 'assistant', 'content': 'Hi'}])
+        assert await backend.get('conversations', 1) == [{'role': 'user', 'content': 'Hello'},
+                                                         {'role': 'assistant', 'content': 'Hi'}]
+        # Namespaces and keys do not collide
+        assert await backend.get('conversations', 2) is None
+        assert await backend.get('last_message', 1) is None
+        await backend.delete('conversations', 1)
+        assert await backend.get('conversations', 1) is None
+
+    run_with_backend(server, test)
+
+
+def test_pop(server):
+    async def test(backend):
+        await backend.set('inline_queries', 'abc', 'What is the weather like?')
+        assert await backend.pop('inline_queries', 'abc') == 'What is the weather like?'
+        assert await backend.pop('inline_queries', 'abc') is None
+        assert await backend.pop('inline_queries', 'abc', default='') == ''
+
+    run_with_backend(server, test)
+
+
+def test_ttl_expiry(server):
+    async def test(backend):
+        await backend.set('last_message', 1, 'expires', ttl=0.2)
+        await backend.set('last_message', 2, 'stays')
+        assert await backend.get('last_message', 1) == 'expires'
+        await asyncio.sleep(0.4)
+        assert await backend.get('last_message', 1) is None
+        assert await backend.get('last_message', 2) == 'stays'
+
+    run_with_backend(server, test)
+
+
+def test_prefixes_are_isolated(server):
+    async def test(backend):
+        await backend.set('usage', 1, {'cost': 1})
+        other = connect(server, prefix='other')
+        try:
+            assert await other.get('usage', 1) is None
+        finally:
+            await other.close()
+
+    run_with_backend(server, test, prefix='isolated')
+
+
+def test_lock(server):
+    async def test(backend):
+        events = []
+
+        async def worker(name):
+            async with backend.lock('conversations', 1):
+                events.append(f'{name} start')
+                await asyncio.sleep(0.05)
+                events.append(f'{name} end')
+
+        await asyncio.gather(worker('a'), worker('b'))
+        # The second worker only enters once the first one left
+        assert events in (['a start', 'a end', 'b start', 'b end'], ['b start', 'b end', 'a start', 'a end'])
+        assert await backend.client.exists('test:lock:conversations:1') == 0
+
+        # Locks of other keys do not wait for each other
+        async def enter_other_lock():
+            async with backend.lock('conversations', 2):
+                pass
+
+        async with backend.lock('conversations', 1):
+            await asyncio.wait_for(enter_other_lock(), timeout=1)
+
+    run_with_backend(server, test)
+
+
+OPENAI_CONFIG = {
+    'api_key': 'sk-test', 'proxy': None, 'model': 'gpt-3.5-turbo', 'max_tokens': 100, 'n_choices': 1,
+    'temperature': 1.0, 'presence_penalty': 0.0, 'frequency_penalty': 0.0, 'max_history_size': 15,
+    'max_conversation_age_minutes': 180, 'assistant_prompt': 'You are a helpful assistant.',
+    'enable_functions': False, 'bot_language': 'en', 'show_usage': False, 'show_plugins_used': False,
+}
+
+
+def require_tiktoken():
+    try:
+        tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        pytest.skip(f'tiktoken encoding not available ({type(e).__name__})')
+
+
+def completion(content: str) -> OpenAIObject:
+    return OpenAIObject.construct_from({
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 20, 'completion_tokens': 2, 'total_tokens': 22},
+    })
+
+
+def test_openai_helper_conversation(server, monkeypatch):
+    require_tiktoken()
+    requests = []
+
+    async def acreate(**kwargs):
+        requests.append(kwargs)
+        return completion(f'Answer {len(requests)}')
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+    config = OPENAI_CONFIG
+
+    async def test(backend):
+        helper = OpenAIHelper(config, PluginManager({'plugins': []}), state=backend)
+        answer, _ = await helper.get_chat_response(chat_id=42, query='Hello')
+        assert answer == 'Answer 1'
+
+        # Another worker sharing the server continues the same conversation
+        other = connect(server, prefix='test')
+        try:
+            other_helper = OpenAIHelper(config, PluginManager({'plugins': []}), state=other)
+            answer, _ = await other_helper.get_chat_response(chat_id=42, query='And then?')
+            assert answer == 'Answer 2'
+        finally:
+            await other.close()
+
+        assert [message['content'] for message in requests[1]['messages']] == \
+               ['You are a helpful assistant.', 'Hello', 'Answer 1', 'And then?']
+        assert await backend.get('conversations', 42) == [
+            {'role': 'system', 'content': 'You are a helpful assistant.'},
+            {'role': 'user', 'content': 'Hello'},
+            {'role': 'assistant', 'content': 'Answer 1'},
+            {'role': 'user', 'content': 'And then?'},
+            {'role': 'assistant', 'content': 'Answer 2'},
+        ]
+        assert (await helper.get_conversation_stats(42))[0] == 5
+
+    run_with_backend(server, test)
+
+
+def test_summary_does_not_hold_the_conversation_lock(server, monkeypatch):
+    require_tiktoken()
+    summary_started = asyncio.Event()
+    finish_summary = asyncio.Event()
+
+    async def acreate(**kwargs):
+        if kwargs['messages'][0]['content'].startswith('Summarize'):
+            summary_started.set()
+            await finish_summary.wait()
+            return completion('Summary')
+        return completion('Answer')
+
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+    config = {**OPENAI_CONFIG, 'max_history_size': 4}
+
+    def message(role, content):
+        return {'role': role, 'content': content}
+
+    async def test(backend):
+        helper = OpenAIHelper(config, PluginManager({'plugins': []}), state=backend)
+        await backend.set('conversations', 42, [
+            message('system', 'You are a helpful assistant.'), message('user', 'First'),
+            message('assistant', 'Answer'), message('user', 'Second'), message('assistant', 'Answer'),
+        ])
+        request = asyncio.create_task(helper.get_chat_response(chat_id=42, query='Third'))
+        await asyncio.wait_for(summary_started.wait(), timeout=1)
+
+        # Another request of the chat is answered while the summary is requested
+        async def answer_other_request():
+            async with backend.lock('conversations', 42):
+                conversation = await backend.get('conversations', 42)
+                await backend.set('conversations', 42,
+                                  conversation + [message('user', 'Meanwhile'), message('assistant', 'Noted')])
+
+        await asyncio.wait_for(answer_other_request(), timeout=1)
+        finish_summary.set()
+        answer, _ = await request
+
+        assert answer == 'Answer'
+        assert await backend.get('conversations', 42) == [
+            message('system', 'You are a helpful assistant.'), message('assistant', 'Summary'),
+            message('user', 'Meanwhile'), message('assistant', 'Noted'),
+            message('user', 'Third'), message('assistant', 'Answer'),
+        ]
+
+    run_with_backend(server, test)